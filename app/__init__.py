@@ -1,155 +1,82 @@
-from flask import Flask, render_template, jsonify, request, make_response, abort, send_file
-from flask_sqlalchemy import SQLAlchemy
+"""
+The customer API. create_app() builds a configured Flask app; importing 'app'
+from this package (from app import app) lazily creates a default one configured
+from the environment, which is what run.py, manage.py and the tests use
+"""
 import os
-import datetime
-import csv
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL') or 'postgres://localhost/customer_api'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-if os.environ.get('ENV') == 'prod':
-    app.config['DEBUG'] = False
-else:
-    app.config['DEBUG'] = True
-db = SQLAlchemy(app)
-from app.models import Customer, Category, Product, Order
+import json
+from flask import Flask
+from app.routing import RoutingSQLAlchemy, router, pool_options, replica_uris
 
+db = RoutingSQLAlchemy()
 
-@app.errorhandler(404)
-def page_not_found(e):
-    return render_template('404.html'), 404
+from app import models, search  # noqa: F401 (registers the models and search's session listeners)
+from app.cache import cache
+from app import analytics, changes, exports, instrumentation, warmup
+from app.admission import admission
+from app.views import api
 
-@app.route("/", methods=['GET'])
-def root():
-    return "This is the root of the app, you probablly are looking for /api"
+instrumentation.metrics.add_source(cache.metric_families)
+instrumentation.metrics.add_source(router.metric_families)
+instrumentation.metrics.add_source(admission.metric_families)
+instrumentation.metrics.add_source(changes.metric_families)
 
 
-@app.route("/api/", methods=['GET'])
-def index():
-    """Just tell the user the app is running and the routes avaliable"""
-    return render_template('index.html')
+def configure(app, environ):
+    """Settings read from environment variables"""
+    app.config['SQLALCHEMY_DATABASE_URI'] = environ.get('DATABASE_URL') or 'postgres://localhost/customer_api'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = pool_options(environ)
+    app.config['SQLALCHEMY_REPLICA_URIS'] = replica_uris(environ)
+    if environ.get('ENV') == 'prod':
+        app.config['DEBUG'] = False
+    else:
+        app.config['DEBUG'] = True
+    app.config['RESPONSE_CACHE'] = environ.get('RESPONSE_CACHE', 'on') != 'off'
+    app.config['RESPONSE_CACHE_SIZE'] = int(environ.get('RESPONSE_CACHE_SIZE') or 256)
+    app.config['RESPONSE_CACHE_TTL'] = int(environ.get('RESPONSE_CACHE_TTL') or 30)
+    app.config['BULK_BATCH_SIZE'] = int(environ.get('BULK_BATCH_SIZE') or 5000)
+    app.config['SQL_N_PLUS_ONE_THRESHOLD'] = int(environ.get('SQL_N_PLUS_ONE_THRESHOLD') or 10)
+    app.config['ANALYTICS_ENGINE'] = environ.get('ANALYTICS_ENGINE') or 'sql'
+    app.config['ADMISSION_CONTROL'] = environ.get('ADMISSION_CONTROL', 'on') != 'off'
+    app.config['ADMISSION_LIMITS'] = json.loads(environ.get('ADMISSION_LIMITS') or '{}')
+    app.config['WARM_UP'] = environ.get('WARM_UP', 'off') != 'off'
+    app.config['SEARCH_BACKEND'] = environ.get('SEARCH_BACKEND') or 'auto'
 
 
-@app.route("/api/customers", methods=['GET'])
-def customers():
+def create_app(config=None, environ=None):
     """
-    Provides  JSON of all customers with thteir associated IDs (so you can look up someone easy during testing the API
+    Build the app from the environment (or 'environ'), with 'config' applied on
+    top, and run the warm-up if WARM_UP is set
     """
-    customers = [repr(customer) for customer in Customer.query.all()]
-    return jsonify(customers)
+    app = Flask(__name__)
+    configure(app, os.environ if environ is None else environ)
+    app.config.update(config or {})
+    db.init_app(app)
+    router.init_app(app)
+    cache.init_app(app)
+    exports.jobs.init_app(app)
+    analytics.store.init_app(app)
+    admission.init_app(app)
+    changes.init_app(app)
+    instrumentation.init_app(app)
+    warmup.init_app(app)
+    app.register_blueprint(api)
+    if app.config['WARM_UP']:
+        warmup.warm_up(app)
+    return app
 
 
-@app.route("/api/customers/<id>", methods=['GET'])
-def customers_orders(id):
-    """
-    Provide JSON of a customer's orders and their corresponding items
-    """
-    customer = Customer.query.filter_by(id=id).first()
-    if not customer:
-        abort(404)
-    orders = customer.orders
-    results = []
-    for order in orders:
-        for item in order.order_items:
-            results.append({
-                'order.id': item.order_id, 
-                'product.id': item.product_id, 
-                'name': item.product.name, 
-                'quantity': item.quantity
-                })
-    return jsonify(results)
-
-
-@app.route("/api/products/categories", methods=['GET'])
-def customer_categories():
-    """
-    Return JSON of the quantity of items purchased in a particular 
-    category by a certain customer who placed order
-    """
-    results = []
-    customers = Customer.query.all()
-    for customer in customers:
-        category_quantities = {}
-        for order in customer.orders:
-             for item in order.order_items:
-                for category in item.product.categories:
-                    if category in category_quantities:
-                        category_quantities[category] += item.quantity
-                    else:
-                        category_quantities[category] = item.quantity
-        for category in category_quantities:
-            results.append({'id': customer.id, 'name': customer.name, 'category_id': category.id, 'category': category.name, 'quantity': category_quantities[category]})
-    return jsonify(results)
+_default_app = None
 
 
-@app.route("/api/products", methods=['GET'])
-def products():
-    """
-    Provide JSON of all current products that can be ordered and their product.ids
-    """
-    if request.method == 'GET':
-        results = {product.id: [product.name, repr(product.categories)] for product in Product.query.all()}
-        return jsonify(results)
-
-
-@app.route("/api/orders", methods=["GET"])
-@app.route("/api/orders/<start_date>/<end_date>/", methods=['GET'])
-@app.route("/api/orders/<start_date>/<end_date>/<interval>", methods=['GET'])
-@app.route("/api/orders/<start_date>/<end_date>/<interval>/<export>", methods=['GET'])
-def orders_by_date(start_date=None, end_date=None, interval=None, export=None):
-    """
-    Provide a GET request with 'start_date' and 'end_date' 
-    keys in yyyy-mm-dd format and an optional 'interval' key of day, week, or month
-    and returns list of all products sold in time interval, and how many by day/week/month
-    """
-    if request.method == 'GET':
-        if all(param is None for param in [start_date, end_date, interval]):
-            orders = Order.query.all()
-            results = [
-                [order.customer_id, 
-                repr(order.customers), 
-                order.date.strftime('%Y-%m-%d'), 
-                repr(order.order_items)] for order in orders
-            ]
-            return jsonify(results)
-        try:
-            start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d')
-            end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d')
-        except ValueError:
-            return make_response(jsonify(
-                error='Invalid date format, use YYYY-MM-DD (2000-11-20 for Nov 20, 2001)'),
-                400)
-        if interval is not None and interval not in ['day', 'month', 'year']:
-            return make_response(jsonify(error='Invalid interval format (use day, month, or year).'), 400)
-        delta = end_date-start_date
-        if delta.total_seconds() < 0:
-            return make_response(jsonify(error='Invalid date range, ending date cannot be before starting date.'), 400)
-        orders = Order.query.filter(Order.date.between(start_date, end_date)).all()
-        items_quantities = {}
-        for order in orders:
-            for item in order.order_items:
-                items_quantities[item.product.name] = items_quantities.get(item.product.name, 0) + item.quantity
-        if interval == 'day':
-            results = {key: value/delta.days for key,value in items_quantities.items()}
-        elif interval == 'month':
-            results = {key: value/(int(delta.days/30)) for key,value in items_quantities.items()}
-        elif interval == 'year': 
-            results = {key: value/int(delta.days/365.25) for key,value in items_quantities.items()}
-        else:
-            results = [
-                [order.customer_id, 
-                repr(order.customers), 
-                order.date.strftime('%Y-%m-%d'), 
-                repr(order.order_items)] for order in orders
-            ]
-        if export == "export":
-            with open('app/static/items_per_period.csv', 'w', newline='') as csvfile:
-                fieldnames = ['item', 'frequency_bought_per_{}'.format(interval)]
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                for item in results.keys():
-                    writer.writerow({'item': item, 'frequency_bought_per_{}'.format(interval): results[item]})
-                return send_file('static/items_per_period.csv',
-                    mimetype='text/csv',
-                    attachment_filename='items_per_period.csv',
-                    as_attachment=True)
-        return jsonify(results)
\ No newline at end of file
+def __getattr__(name):
+    """Create the default app the first time 'app' is imported from this package"""
+    global _default_app
+    if name != 'app':
+        raise AttributeError("module 'app' has no attribute '{}'".format(name))
+    if _default_app is None:
+        _default_app = create_app()
+        # lets db.session and db.engine work outside an app context, as they did before the factory
+        db.app = _default_app
+    return _default_app
\ No newline at end of file
@@ -0,0 +1,219 @@
+"""
+Admission control for the expensive routes. Each limited route class gets a
+concurrency limit with a short wait queue and a token-bucket rate limit, so a
+spike on the big listings and exports can't take every worker and database
+connection away from cheap lookups.
+
+Limits are shared by every worker process on the host: each route class keeps
+its state (slots held, requests waiting, tokens left) in a small JSON file that
+is read and rewritten under an exclusive flock. Slots are recorded per process
+id, so the ones held by a worker that died are given back on the next read.
+
+Past the limits a request fails fast instead of queueing behind the others:
+429 when it is over the rate limit, 503 when the route is full and its wait queue
+is too, both with a Retry-After header
+"""
+import errno
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, jsonify, make_response, current_app
+from app.instrumentation import metrics
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+# concurrency: requests running at once, queue: requests allowed to wait for a slot,
+# wait: seconds a queued request waits before giving up, rate/burst: token bucket
+# refilled at 'rate' requests per second holding up to 'burst' tokens
+DEFAULT_LIMITS = {
+    'categories': {'concurrency': 4, 'queue': 8, 'wait': 2.0, 'rate': 20, 'burst': 40},
+    'orders': {'concurrency': 4, 'queue': 8, 'wait': 2.0, 'rate': 20, 'burst': 40},
+    'exports': {'concurrency': 2, 'queue': 4, 'wait': 1.0, 'rate': 2, 'burst': 10},
+}
+POLL_SECONDS = 0.02
+
+
+def alive(pid):
+    """Whether a process with this id is running on the host, for state that worker processes leave behind"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class SharedState(object):
+    """A JSON object in a file, read-modify-written under an exclusive flock"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), 'r+') as handle:
+                    raw = handle.read()
+                    state = json.loads(raw) if raw else {}
+                    yield state
+                    handle.seek(0)
+                    handle.truncate()
+                    handle.write(json.dumps(state))
+            finally:
+                os.close(fd)
+
+
+class Limiter(object):
+
+    def __init__(self, name, directory, concurrency=None, queue=0, wait=1.0, rate=None, burst=None, retry_after=1):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.wait = wait
+        self.rate = rate
+        self.burst = burst or rate
+        self.retry_after = retry_after
+        self.state = SharedState(os.path.join(directory, '{}.json'.format(name)))
+
+    @staticmethod
+    def _live(counts):
+        return {pid: count for pid, count in counts.items() if count > 0 and alive(int(pid))}
+
+    def _try(self, state, queued):
+        """
+        One admission attempt on the locked state. Returns (None, None) when a slot
+        was taken, ('rate', seconds) when over the rate limit, ('wait', None) when the
+        caller may keep waiting and ('concurrency', None) when it has to give up
+        """
+        now = time.time()
+        pid = str(os.getpid())
+        holders = state['holders'] = self._live(state.get('holders', {}))
+        waiting = state['waiting'] = self._live(state.get('waiting', {}))
+        if self.rate and not queued:
+            tokens = min(self.burst, state.get('tokens', self.burst) + (now - state.get('updated', now)) * self.rate)
+            state['tokens'], state['updated'] = tokens, now
+            if tokens < 1:
+                return 'rate', (1 - tokens) / self.rate
+        if self.concurrency and sum(holders.values()) >= self.concurrency:
+            if queued:
+                return 'wait', None
+            if sum(waiting.values()) >= self.queue:
+                return 'concurrency', None
+            waiting[pid] = waiting.get(pid, 0) + 1
+            return 'wait', None
+        if self.rate and not queued:
+            state['tokens'] -= 1
+        if queued:
+            waiting[pid] -= 1
+        holders[pid] = holders.get(pid, 0) + 1
+        return None, None
+
+    def acquire(self):
+        """Take a slot, waiting in the queue if there is room. Returns (reason, retry after seconds) or None"""
+        deadline = time.time() + self.wait
+        queued = False
+        while True:
+            with self.state.locked() as state:
+                reason, retry = self._try(state, queued)
+                if reason == 'wait' and time.time() >= deadline:
+                    state['waiting'][str(os.getpid())] -= 1
+                    return 'concurrency', self.retry_after
+            if reason is None:
+                return None
+            if reason == 'rate':
+                return reason, retry
+            if reason == 'concurrency':
+                return reason, self.retry_after
+            queued = True
+            time.sleep(POLL_SECONDS)
+
+    def release(self):
+        with self.state.locked() as state:
+            holders = state.setdefault('holders', {})
+            pid = str(os.getpid())
+            if holders.get(pid, 0) > 0:
+                holders[pid] -= 1
+
+    def snapshot(self):
+        with self.state.locked() as state:
+            return (sum(self._live(state.get('holders', {})).values()),
+                    sum(self._live(state.get('waiting', {})).values()))
+
+
+class Admission(object):
+    """Builds each app's limiters (kept in app.extensions['admission']) and releases slots after requests"""
+
+    def init_app(self, app):
+        app.config.setdefault('ADMISSION_CONTROL', True)
+        app.config.setdefault('ADMISSION_LIMITS', {})
+        app.config.setdefault('ADMISSION_DIR', os.path.join(tempfile.gettempdir(), 'customer_api_admission'))
+        self.configure(app)
+
+        @app.teardown_request
+        def release_slots(exc):
+            for limiter in g.pop('admitted', []):
+                limiter.release()
+
+    def configure(self, app):
+        """(Re)build the app's limiters from ADMISSION_LIMITS layered over DEFAULT_LIMITS"""
+        directory = app.config['ADMISSION_DIR']
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        limits = {name: dict(settings) for name, settings in DEFAULT_LIMITS.items()}
+        for name, settings in (app.config['ADMISSION_LIMITS'] or {}).items():
+            limits.setdefault(name, {}).update(settings)
+        app.extensions['admission'] = {name: Limiter(name, directory, **settings) for name, settings in limits.items()}
+
+    def metric_families(self):
+        """In-flight and queued requests per route class for app.instrumentation.Metrics.add_source"""
+        limiters = current_app.extensions.get('admission', {}) if current_app else {}
+        snapshots = [(name, limiter.snapshot()) for name, limiter in sorted(limiters.items())]
+        return [
+            ('api_admission_in_flight', 'gauge', 'Requests holding a slot of a limited route class',
+             [((('limit', name),), running) for name, (running, _) in snapshots]),
+            ('api_admission_waiting', 'gauge', 'Requests queued for a slot of a limited route class',
+             [((('limit', name),), waiting) for name, (_, waiting) in snapshots]),
+        ]
+
+
+admission = Admission()
+
+
+def limited(classify):
+    """
+    Put a view behind the limits of the route class classify(**view_args) names,
+    or let it straight through when that returns None
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            limiter = current_app.extensions['admission'].get(classify(**kwargs)) \
+                if current_app.config.get('ADMISSION_CONTROL') else None
+            if limiter is None:
+                return view(*args, **kwargs)
+            shed = limiter.acquire()
+            if shed is not None:
+                reason, retry = shed
+                metrics.increment('api_requests_shed_total', (('limit', limiter.name), ('reason', reason)))
+                if reason == 'rate':
+                    response = make_response(jsonify(error='Too many requests, slow down.'), 429)
+                else:
+                    response = make_response(jsonify(error='Server busy, try again shortly.'), 503)
+                response.headers['Retry-After'] = str(max(int(math.ceil(retry)), 1))
+                return response
+            g.setdefault('admitted', []).append(limiter)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
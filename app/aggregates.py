@@ -0,0 +1,176 @@
+"""
+Aggregation queries that let the database do the grouping and summing,
+instead of walking the ORM relationships one lazy-load at a time
+"""
+import datetime
+from flask import g, has_request_context
+from sqlalchemy import func
+from app import db
+from app.models import Customer, Category, Product, Order, OrderItem, DailyProductSales, products_categories
+
+SERIES_INTERVALS = ('day', 'week', 'month', 'year')
+STREAM_CHUNK = 5000
+
+
+def as_day(value):
+    """
+    The date of a date or datetime, for date range filters. Dates compare as text
+    on SQLite, so '2018-01-01 00:00:00' would exclude the first day
+    """
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+
+def date_bucket(column, interval, dialect):
+    """
+    SQL expression for the first day (as YYYY-MM-DD) of the day/week/month/year
+    containing 'column'. Weeks are ISO weeks, so they start on Monday
+    """
+    if dialect == 'sqlite':
+        if interval == 'week':
+            # move forward to the week's Sunday (or stay), then back to its Monday
+            return func.date(column, 'weekday 0', '-6 days')
+        return func.strftime({'day': '%Y-%m-%d', 'month': '%Y-%m-01', 'year': '%Y-01-01'}[interval], column)
+    return func.to_char(func.date_trunc(interval, column), 'YYYY-MM-DD')
+
+
+def customer_category_quantities():
+    """
+    Return (customer id, customer name, category id, category name, quantity) rows
+    for every category each customer has bought from, using a single GROUP BY query.
+    Rows come back grouped by customer, with each customer's categories in the order
+    they were first bought (by order, then by order item)
+    """
+    return db.session.query(
+            Customer.id,
+            Customer.name,
+            Category.id,
+            Category.name,
+            func.sum(OrderItem.quantity)) \
+        .select_from(OrderItem) \
+        .join(Order, Order.id == OrderItem.order_id) \
+        .join(Customer, Customer.id == Order.customer_id) \
+        .join(products_categories, products_categories.c.product_id == OrderItem.product_id) \
+        .join(Category, Category.id == products_categories.c.category_id) \
+        .group_by(Customer.id, Customer.name, Category.id, Category.name) \
+        .order_by(Customer.id, func.min(Order.id), func.min(OrderItem.id), Category.id) \
+        .all()
+
+
+def product_quantities(start_date, end_date):
+    """
+    Return (product name, quantity) rows of everything sold between the two dates,
+    read from the daily_product_sales rollup so the cost depends on days x products
+    rather than on how many orders were placed
+    """
+    return db.session.query(Product.name, func.sum(DailyProductSales.quantity)) \
+        .join(DailyProductSales, DailyProductSales.product_id == Product.id) \
+        .filter(DailyProductSales.date.between(as_day(start_date), as_day(end_date))) \
+        .group_by(Product.name) \
+        .all()
+
+
+def top_products(start_date, end_date, limit):
+    """(product id, name, quantity) of the 'limit' best sellers between the two dates, exactly, from the rollup"""
+    quantity = func.sum(DailyProductSales.quantity)
+    return db.session.query(Product.id, Product.name, quantity) \
+        .join(DailyProductSales, DailyProductSales.product_id == Product.id) \
+        .filter(DailyProductSales.date.between(as_day(start_date), as_day(end_date))) \
+        .group_by(Product.id, Product.name) \
+        .order_by(quantity.desc(), Product.id) \
+        .limit(limit) \
+        .all()
+
+
+def product_series(start_date, end_date, interval):
+    """
+    Return (bucket, product name, quantity) rows of everything sold between the two
+    dates, one per product per day/week/month/year it sold in, ordered by bucket
+    and product. Buckets are truncated and grouped in SQL over the rollup
+    """
+    bucket = date_bucket(DailyProductSales.date, interval, db.engine.dialect.name).label('bucket')
+    return db.session.query(bucket, Product.name, func.sum(DailyProductSales.quantity)) \
+        .join(Product, Product.id == DailyProductSales.product_id) \
+        .filter(DailyProductSales.date.between(as_day(start_date), as_day(end_date))) \
+        .group_by(bucket, Product.name) \
+        .order_by(bucket, Product.name) \
+        .all()
+
+
+def bucket_start(date, interval):
+    """Python twin of date_bucket for a single date"""
+    if interval == 'week':
+        date = date - datetime.timedelta(days=date.weekday())
+    elif interval == 'month':
+        date = date.replace(day=1)
+    elif interval == 'year':
+        date = date.replace(month=1, day=1)
+    return date.strftime('%Y-%m-%d')
+
+
+def stream_rows(query, chunk=STREAM_CHUNK):
+    """
+    Iterate a column query over a server-side cursor, 'chunk' rows at a time, and
+    add the number of rows read to g.rows_processed for the X-Rows-Processed header
+    """
+    count = 0
+    try:
+        for row in query.yield_per(chunk):
+            count += 1
+            yield row
+    finally:
+        if has_request_context():
+            g.rows_processed = g.get('rows_processed', 0) + count
+
+
+class StreamingAggregates(object):
+    """
+    The aggregations above computed from the raw orders and order items instead of
+    the rollup, folding a flat projection into running totals as it streams past.
+    Memory is bounded by the number of groups, not by how many rows the range holds
+    """
+
+    def _items(self, start_date, end_date, *columns):
+        return db.session.query(*columns) \
+            .select_from(OrderItem) \
+            .join(Order, Order.id == OrderItem.order_id) \
+            .join(Product, Product.id == OrderItem.product_id) \
+            .filter(Order.date.between(as_day(start_date), as_day(end_date)))
+
+    def product_quantities(self, start_date, end_date):
+        totals = {}
+        rows = self._items(start_date, end_date, Product.name, OrderItem.quantity)
+        for name, quantity in stream_rows(rows):
+            totals[name] = totals.get(name, 0) + quantity
+        return list(totals.items())
+
+    def product_series(self, start_date, end_date, interval):
+        totals = {}
+        rows = self._items(start_date, end_date, Order.date, Product.name, OrderItem.quantity)
+        for date, name, quantity in stream_rows(rows):
+            key = (bucket_start(date, interval), name)
+            totals[key] = totals.get(key, 0) + quantity
+        return [(bucket, name, quantity) for (bucket, name), quantity in sorted(totals.items())]
+
+    def customer_category_quantities(self):
+        rows = db.session.query(Customer.id, Customer.name, Category.id, Category.name, Order.id, OrderItem.id,
+                                OrderItem.quantity) \
+            .select_from(OrderItem) \
+            .join(Order, Order.id == OrderItem.order_id) \
+            .join(Customer, Customer.id == Order.customer_id) \
+            .join(products_categories, products_categories.c.product_id == OrderItem.product_id) \
+            .join(Category, Category.id == products_categories.c.category_id)
+        groups = {}
+        for customer_id, name, category_id, category, order_id, item_id, quantity in stream_rows(rows):
+            group = groups.get((customer_id, category_id))
+            if group is None:
+                groups[(customer_id, category_id)] = [name, category, quantity, order_id, item_id]
+            else:
+                group[2] += quantity
+                group[3] = min(group[3], order_id)
+                group[4] = min(group[4], item_id)
+        ordered = sorted(groups.items(), key=lambda group: (group[0][0], group[1][3], group[1][4], group[0][1]))
+        return [(customer_id, name, category_id, category, quantity)
+                for (customer_id, category_id), (name, category, quantity, _, _) in ordered]
+
+
+streaming = StreamingAggregates()
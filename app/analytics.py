@@ -0,0 +1,310 @@
+"""
+Optional in-memory columnar engine for the analytical endpoints. Every order item
+is held as NumPy arrays (item id, order id, customer id, product id, quantity and
+order date) alongside a CSR product -> categories mapping, and the aggregations in
+app.aggregates are answered with boolean masks and bincount instead of SQL.
+
+Set ANALYTICS_ENGINE=columnar to use it. The arrays are loaded on first use and
+then topped up with the order items whose id is above the highest one seen, so
+appends (the API, bulk ingest, the synthetic generator) cost one small query,
+plus the names and category links of customers and products seen for the first
+time. Updating or deleting existing items or moving an order to another date
+through the ORM forces a full reload on the next call, and changing existing
+customers, products or categories reloads the names and links. Those commits also bump a
+generation in a small state file in ANALYTICS_DIR, one per database, so every
+worker process on the host reloads, not just the one that made the change.
+Changes made behind the app's back are only picked up after calling reset().
+Each app keeps its own store (see app/extensions.py). NumPy is only needed when
+the engine is on
+"""
+import hashlib
+import importlib.util
+import os
+import tempfile
+import threading
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+from app import db
+from app import aggregates
+from app.admission import SharedState
+from app.extensions import PerApp
+from app.aggregates import SERIES_INTERVALS, as_day
+from app.models import Customer, Category, Product, Order, OrderItem, products_categories
+
+# imported on first use, numpy alone costs about as much as importing the rest of the app
+np = None
+
+LOAD_CHUNK = 50000
+# ids per IN (...) when loading the names of customers and products first seen in an append
+NAME_CHUNK = 500
+
+
+def numpy_available():
+    return np is not None or importlib.util.find_spec('numpy') is not None
+
+
+def _array(values, dtype):
+    return np.array(values, dtype=dtype) if values else np.zeros(0, dtype=dtype)
+
+
+class ColumnStore(object):
+    """Order items as column arrays, refreshed incrementally by order_items.id"""
+
+    COLUMNS = ('item_id', 'order_id', 'customer_id', 'product_id', 'quantity', 'date')
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self.stale = True
+        self.dimensions_stale = True
+        self.last_item_id = 0
+        self.columns = None
+        self.category_ptr = None
+        self.category_ids = None
+        self.customer_names = {}
+        self.category_names = {}
+        self.product_names = {}
+        self.links = None
+        # generations of the shared state file this process has caught up with
+        self.generations = {}
+
+    def reset(self):
+        """Drop everything, the next call reloads from scratch"""
+        with self._lock:
+            self.stale = True
+
+    def _empty(self):
+        return {name: np.zeros(0, dtype='datetime64[D]' if name == 'date' else np.int64) for name in self.COLUMNS}
+
+    def _load(self, connection, after):
+        """Column arrays for the order items with an id above 'after', in id order"""
+        items, orders = OrderItem.__table__, Order.__table__
+        query = select([items.c.id, items.c.order_id, orders.c.customer_id, items.c.product_id, items.c.quantity,
+                        orders.c.date]) \
+            .select_from(items.join(orders, orders.c.id == items.c.order_id)) \
+            .where(items.c.id > after) \
+            .order_by(items.c.id)
+        result = connection.execution_options(stream_results=True).execute(query)
+        chunks = []
+        while True:
+            rows = result.fetchmany(LOAD_CHUNK)
+            if not rows:
+                break
+            columns = list(zip(*rows))
+            chunks.append({name: _array(list(values), 'datetime64[D]' if name == 'date' else np.int64)
+                           for name, values in zip(self.COLUMNS, columns)})
+        if not chunks:
+            return self._empty()
+        return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in self.COLUMNS}
+
+    def _index_links(self, product_ids, category_ids):
+        """The CSR product -> categories mapping of the (product id, category id) link arrays"""
+        order = np.lexsort((category_ids, product_ids))
+        product_ids, category_ids = product_ids[order], category_ids[order]
+        self.links = (product_ids, category_ids)
+        size = max(list(self.product_names) + product_ids.tolist() + [0]) + 1
+        self.category_ids = category_ids
+        self.category_ptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(product_ids, minlength=size), out=self.category_ptr[1:])
+
+    def _load_dimensions(self, connection):
+        """Every name and the CSR product -> categories mapping, after customers, products or categories changed"""
+        names = lambda table: dict(connection.execute(select([table.c.id, table.c.name])).fetchall())
+        self.customer_names = names(Customer.__table__)
+        self.category_names = names(Category.__table__)
+        self.product_names = names(Product.__table__)
+        links = connection.execute(
+            select([products_categories.c.product_id, products_categories.c.category_id])).fetchall()
+        self._index_links(_array([row[0] for row in links], np.int64), _array([row[1] for row in links], np.int64))
+
+    def _add_dimensions(self, connection, columns):
+        """Names and category links of the customers and products appended rows mention for the first time"""
+        def names(table, ids):
+            found = {}
+            for start in range(0, len(ids), NAME_CHUNK):
+                found.update(connection.execute(select([table.c.id, table.c.name])
+                                                .where(table.c.id.in_(ids[start:start + NAME_CHUNK]))).fetchall())
+            return found
+
+        customers = sorted(set(np.unique(columns['customer_id']).tolist()) - set(self.customer_names))
+        self.customer_names.update(names(Customer.__table__, customers))
+        products = sorted(set(np.unique(columns['product_id']).tolist()) - set(self.product_names))
+        if not products:
+            return
+        self.product_names.update(names(Product.__table__, products))
+        links = []
+        for start in range(0, len(products), NAME_CHUNK):
+            links.extend(connection.execute(
+                select([products_categories.c.product_id, products_categories.c.category_id])
+                .where(products_categories.c.product_id.in_(products[start:start + NAME_CHUNK]))).fetchall())
+        categories = sorted(set(row[1] for row in links) - set(self.category_names))
+        self.category_names.update(names(Category.__table__, categories))
+        self._index_links(np.concatenate([self.links[0], _array([row[0] for row in links], np.int64)]),
+                          np.concatenate([self.links[1], _array([row[1] for row in links], np.int64)]))
+
+    def _catch_up(self):
+        """Flag what another worker process changed since this one last looked, per the shared state file"""
+        with _shared_state(self.app) as state:
+            generations = dict(state)
+        if self.generations.get('items') != generations.get('items'):
+            self.stale = True
+        if self.generations.get('dimensions') != generations.get('dimensions'):
+            self.dimensions_stale = True
+        return generations
+
+    def refresh(self):
+        """Bring the arrays up to date with the database and return a consistent snapshot of them"""
+        global np
+        if np is None:
+            try:
+                import numpy as np
+            except ImportError:
+                raise RuntimeError('The columnar analytics engine needs numpy, pip install numpy')
+        with self._lock:
+            generations = self._catch_up()
+            connection = db.session.connection()
+            last_item_id = connection.execute(select([func.coalesce(func.max(OrderItem.__table__.c.id), 0)])).scalar()
+            if self.stale or last_item_id < self.last_item_id:
+                self.columns, self.last_item_id, self.stale = self._load(connection, 0), 0, False
+                self.dimensions_stale = True
+            elif last_item_id > self.last_item_id:
+                new = self._load(connection, self.last_item_id)
+                self.columns = {name: np.concatenate([self.columns[name], new[name]]) for name in self.COLUMNS}
+                if not self.dimensions_stale:
+                    self._add_dimensions(connection, new)
+            if self.dimensions_stale:
+                self._load_dimensions(connection)
+            self.dimensions_stale = False
+            self.generations = generations
+            if len(self.columns['item_id']):
+                self.last_item_id = int(self.columns['item_id'][-1])
+            return self.columns
+
+    def _categories_of(self, product_ids):
+        """For each position in product_ids, repeat it once per category: (positions, category ids)"""
+        known = product_ids < len(self.category_ptr) - 1
+        product_ids = np.where(known, product_ids, 0)
+        starts = self.category_ptr[product_ids]
+        counts = np.where(known, self.category_ptr[product_ids + 1] - starts, 0)
+        positions = np.repeat(np.arange(len(product_ids)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return positions, self.category_ids[np.repeat(starts, counts) + offsets]
+
+    def customer_category_quantities(self):
+        """Same rows, in the same order, as app.aggregates.customer_category_quantities"""
+        columns = self.refresh()
+        positions, category_ids = self._categories_of(columns['product_id'])
+        customers = columns['customer_id'][positions]
+        width = int(category_ids.max()) + 1 if len(category_ids) else 1
+        keys, first, inverse = np.unique(customers * width + category_ids, return_index=True, return_inverse=True)
+        quantities = np.bincount(inverse, weights=columns['quantity'][positions], minlength=len(keys))
+        first_order = np.full(len(keys), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(first_order, inverse, columns['order_id'][positions])
+        # positions follow item id, so the first occurrence of a key is its lowest item id
+        first_item = columns['item_id'][positions][first]
+        customer_ids, group_categories = keys // width, keys % width
+        order = np.lexsort((group_categories, first_item, first_order, customer_ids))
+        return [(int(customer_ids[i]), self.customer_names.get(int(customer_ids[i])), int(group_categories[i]),
+                 self.category_names.get(int(group_categories[i])), int(quantities[i])) for i in order]
+
+    def _in_range(self, columns, start_date, end_date):
+        dates = columns['date']
+        return (dates >= np.datetime64(as_day(start_date), 'D')) & (dates <= np.datetime64(as_day(end_date), 'D'))
+
+    def product_quantities(self, start_date, end_date):
+        """Same rows as app.aggregates.product_quantities"""
+        columns = self.refresh()
+        mask = self._in_range(columns, start_date, end_date)
+        product_ids = columns['product_id'][mask]
+        quantities = np.bincount(product_ids, weights=columns['quantity'][mask])
+        sold = np.flatnonzero(np.bincount(product_ids))
+        totals = {}
+        for product_id in sold:
+            name = self.product_names.get(int(product_id))
+            totals[name] = totals.get(name, 0) + int(quantities[product_id])
+        return list(totals.items())
+
+    def product_series(self, start_date, end_date, interval):
+        """Same rows as app.aggregates.product_series"""
+        if interval not in SERIES_INTERVALS:
+            raise ValueError(interval)
+        columns = self.refresh()
+        mask = self._in_range(columns, start_date, end_date)
+        dates, product_ids = columns['date'][mask], columns['product_id'][mask]
+        if interval == 'week':
+            # 1970-01-01 was a Thursday, shift so Monday is day 0 of the week
+            days = dates.astype(np.int64)
+            buckets = (days - (days + 3) % 7).astype('datetime64[D]')
+        elif interval == 'day':
+            buckets = dates
+        else:
+            buckets = dates.astype('datetime64[{}]'.format('M' if interval == 'month' else 'Y')).astype('datetime64[D]')
+        width = int(product_ids.max()) + 1 if len(product_ids) else 1
+        keys, inverse = np.unique(buckets.astype(np.int64) * width + product_ids, return_inverse=True)
+        quantities = np.bincount(inverse, weights=columns['quantity'][mask], minlength=len(keys))
+        totals = {}
+        for key, quantity in zip(keys, quantities):
+            bucket = str(np.datetime64(int(key // width), 'D'))
+            name = self.product_names.get(int(key % width))
+            totals[(bucket, name)] = totals.get((bucket, name), 0) + int(quantity)
+        return [(bucket, name, quantity) for (bucket, name), quantity in sorted(totals.items())]
+
+
+# each app's ColumnStore, see app/extensions.py
+store = PerApp('analytics', ColumnStore)
+
+
+def aggregates_for(app):
+    """
+    The module or engine the analytical endpoints should aggregate with, per
+    ANALYTICS_ENGINE: sql (the rollup, default), stream (raw rows over a
+    server-side cursor) or columnar (this module)
+    """
+    engine = app.config.get('ANALYTICS_ENGINE')
+    if engine == 'columnar':
+        return store.for_app(app)
+    return aggregates.streaming if engine == 'stream' else aggregates
+
+
+def _shared_state(app):
+    directory = app.config.get('ANALYTICS_DIR') or os.path.join(tempfile.gettempdir(), 'customer_api_analytics')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # apps on different databases must not see each other's generations
+    database = hashlib.sha1(str(app.config['SQLALCHEMY_DATABASE_URI']).encode('utf-8')).hexdigest()[:16]
+    return SharedState(os.path.join(directory, 'generations-{}.json'.format(database))).locked()
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_on_rewrite(session, flush_context):
+    """New items are picked up by id, anything that rewrites existing rows needs a full reload"""
+    stale = session.info.setdefault('analytics_stale', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Customer, Category, Product)):
+            # new ones are loaded when an appended order item first mentions them
+            if obj not in session.new:
+                stale.add('dimensions')
+        elif isinstance(obj, (Order, OrderItem)) and obj not in session.new \
+                and (obj in session.deleted or session.is_modified(obj, include_collections=False)):
+            stale.add('items')
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    """Flag this process's store, and let the other worker processes know through the shared state file"""
+    stale = session.info.pop('analytics_stale', set())
+    app = getattr(session, 'app', None)
+    if not stale or app is None or 'analytics' not in app.extensions:
+        return
+    columns = store.for_app(app)
+    columns.stale = columns.stale or 'items' in stale
+    columns.dimensions_stale = columns.dimensions_stale or 'dimensions' in stale
+    if app.config.get('ANALYTICS_ENGINE') == 'columnar':
+        with _shared_state(app) as state:
+            for name in stale:
+                state[name] = state.get(name, 0) + 1
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_after_rollback(session):
+    session.info.pop('analytics_stale', None)
@@ -0,0 +1,173 @@
+"""
+In-process response cache for the read endpoints, one per app. Entries live in a
+bounded LRU with a TTL, are served with strong ETags (so If-None-Match gets a 304), and are
+dropped as soon as a session commits a change to one of the tables they were
+built from
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, make_response, current_app, Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app import formats
+from app.extensions import PerApp
+
+# headers a cached response keeps, everything else is recomputed on the way out
+KEPT_HEADERS = ('Content-Type', 'Link', 'Content-Disposition', 'Vary')
+
+
+class ResponseCache(object):
+
+    def __init__(self, maxsize=256, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the live entry for key (and mark it recently used), or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['expires'] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry, generation):
+        """
+        Store an entry unless a commit invalidated the cache since 'generation'
+        was read, which would mean the entry may already be stale
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            entry['expires'] = time.time() + self.ttl
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, tables):
+        """Drop every entry built from any of the given table names"""
+        tables = set(tables)
+        if not tables:
+            return
+        with self._lock:
+            self.generation += 1
+            stale = [key for key, entry in self._entries.items() if entry['tables'] & tables]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def metric_families(self):
+        """Counters and size in the shape app.instrumentation.Metrics.add_source expects"""
+        stats = self.stats()
+        return [
+            ('api_response_cache_hits_total', 'counter', 'Response cache hits', [((), stats['hits'])]),
+            ('api_response_cache_misses_total', 'counter', 'Response cache misses', [((), stats['misses'])]),
+            ('api_response_cache_evictions_total', 'counter', 'Entries evicted by the LRU bound',
+             [((), stats['evictions'])]),
+            ('api_response_cache_invalidations_total', 'counter', 'Entries dropped by commits',
+             [((), stats['invalidations'])]),
+            ('api_response_cache_entries', 'gauge', 'Entries currently cached', [((), stats['size'])]),
+        ]
+
+
+# each app's ResponseCache, see app/extensions.py
+cache = PerApp('response_cache', lambda app: ResponseCache(app.config.get('RESPONSE_CACHE_SIZE', 256),
+                                                           app.config.get('RESPONSE_CACHE_TTL', 30)))
+
+
+def etag_for(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+def cached(*tables):
+    """
+    Cache a GET view's 200 responses, keyed on the full path and negotiated format, until the TTL runs out
+    or a commit touches one of 'tables'. Streamed responses are passed through
+    """
+    tables = frozenset(tables)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or not current_app.config.get('RESPONSE_CACHE', True):
+                return view(*args, **kwargs)
+            # the same URL can be served as JSON or MessagePack
+            key = (request.full_path, formats.negotiate())
+            store = cache.for_app(current_app)
+            entry = store.get(key)
+            if entry is not None:
+                response = Response(entry['body'], status=entry['status'], headers=entry['headers'])
+                response.headers['X-Cache'] = 'HIT'
+            else:
+                generation = store.generation
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                entry = {
+                    'body': response.get_data(),
+                    'status': response.status_code,
+                    'headers': [(name, value) for name, value in response.headers if name in KEPT_HEADERS],
+                    'tables': tables,
+                }
+                entry['etag'] = etag_for(entry['body'])
+                store.set(key, entry, generation)
+                response.headers['X-Cache'] = 'MISS'
+            response.set_etag(entry['etag'])
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_tables(session, flush_context):
+    tables = session.info.setdefault('cache_tables', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(obj, '__table__', None)
+        if table is not None:
+            tables.add(table.name)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    tables = session.info.pop('cache_tables', ())
+    app = getattr(session, 'app', None)
+    if tables and app is not None and 'response_cache' in app.extensions:
+        cache.for_app(app).invalidate(tables)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_after_rollback(session):
+    session.info.pop('cache_tables', None)
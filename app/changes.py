@@ -0,0 +1,237 @@
+"""
+Change feed behind /api/orders/stream. Every new order, order item and order
+status change is written to the order_changes log in the same transaction as
+the change itself (by the session events below, and by bulk ingest), so the log
+id is a cursor that clients resume from with Last-Event-ID.
+
+Each worker process has one Feed per app: a background thread that waits for
+new log rows and fans them out to every connected client. On Postgres it wakes
+on LISTEN/NOTIFY (writers NOTIFY in the same transaction), elsewhere it polls
+the log every CHANGE_FEED_POLL seconds. Either way it reads the log once for
+all its subscribers. The thread runs only while someone is subscribed.
+
+Each subscriber gets a buffer of CHANGE_FEED_BUFFER events. A client that falls
+that far behind is disconnected rather than buffered without bound. Its SSE
+client reconnects with the id it last saw and catches up from the log
+"""
+import json
+import logging
+import queue
+import select as _select
+import threading
+import time
+from flask import current_app
+from sqlalchemy import event, func, select, text
+from sqlalchemy.orm import Session, attributes
+from app import db
+from app.models import Order, OrderItem, OrderChange
+
+changes = OrderChange.__table__
+
+CHANNEL = 'order_changes'
+# pg_advisory_xact_lock key, see record()
+LOCK_KEY = 72210251
+READ_CHUNK = 500
+# a LISTENing thread still polls this often, in case a notification is missed
+LISTEN_POLL = 5.0
+
+log = logging.getLogger(__name__)
+
+
+def order_event(order, items=()):
+    return {'id': order['id'], 'customer_id': order['customer_id'], 'status': order['status'],
+            'date': order['date'].strftime('%Y-%m-%d'),
+            'items': [item_event(item) for item in items]}
+
+
+def item_event(item):
+    return {'id': item['id'], 'order_id': item['order_id'], 'product_id': item['product_id'],
+            'quantity': item['quantity']}
+
+
+def record(connection, events):
+    """
+    Append (kind, order id, data) events to the change log. On Postgres the
+    writers take turns from here to commit, so log ids become visible in id order
+    and a reader never skips a row that commits late, and NOTIFY the feed
+    """
+    if not events:
+        return
+    postgres = connection.dialect.name == 'postgresql'
+    if postgres:
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), key=LOCK_KEY)
+    connection.execute(changes.insert(), [{'kind': kind, 'order_id': order_id, 'data': json.dumps(data)}
+                                          for kind, order_id, data in events])
+    if postgres:
+        connection.execute(text('SELECT pg_notify(:channel, :payload)'), channel=CHANNEL, payload='')
+
+
+def bulk_events(order_rows, item_rows):
+    """Events for orders and items written with Core inserts, given as the dicts passed to insert()"""
+    items = {}
+    for row in item_rows:
+        items.setdefault(row['order_id'], []).append(row)
+    return [('order', row['id'], order_event(row, items.get(row['id'], ()))) for row in order_rows]
+
+
+def _columns(obj, names):
+    return {name: getattr(obj, name) for name in names}
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_after_flush(session, flush_context):
+    new_orders, new_items, status_changes = [], {}, []
+    for obj in session.new:
+        if isinstance(obj, Order):
+            new_orders.append(obj)
+        elif isinstance(obj, OrderItem):
+            new_items.setdefault(obj.order_id, []).append(
+                _columns(obj, ('id', 'order_id', 'product_id', 'quantity')))
+    for obj in session.dirty:
+        if isinstance(obj, Order):
+            history = attributes.get_history(obj, 'status')
+            if history.added and history.deleted and history.added[0] != history.deleted[0]:
+                status_changes.append(('status', obj.id, {'order_id': obj.id, 'from': history.deleted[0],
+                                                          'to': history.added[0]}))
+    # orders carry the items written with them, items added to existing orders go out on their own
+    events = [('order', order.id, order_event(_columns(order, ('id', 'customer_id', 'status', 'date')),
+                                              new_items.pop(order.id, ())))
+              for order in sorted(new_orders, key=lambda order: order.id)]
+    for order_id, items in sorted(new_items.items()):
+        events.extend(('order_item', order_id, item_event(item)) for item in items)
+    record(session.connection(), events + sorted(status_changes, key=lambda change: change[1]))
+
+
+def last_id(connection):
+    return connection.execute(select([func.coalesce(func.max(changes.c.id), 0)])).scalar()
+
+
+def read(connection, after, limit=READ_CHUNK):
+    """Up to 'limit' logged changes after id 'after', as (id, kind, data) in id order"""
+    return connection.execute(select([changes.c.id, changes.c.kind, changes.c.data])
+                              .where(changes.c.id > after).order_by(changes.c.id).limit(limit)).fetchall()
+
+
+def prune(connection, before):
+    """Delete the changes logged before a datetime, returns how many went. Clients further behind miss them"""
+    return connection.execute(changes.delete().where(changes.c.created < before)).rowcount
+
+
+class Subscriber(object):
+
+    def __init__(self, size):
+        self.events = queue.Queue(size)
+        self.overflowed = False
+
+
+class Feed(object):
+    """One app's shared change-log reader, fanning each change out to every subscriber"""
+
+    def __init__(self, app):
+        self.app = app
+        self.subscribers = set()
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_id = 0
+
+    def subscribe(self):
+        """A Subscriber that gets every change committed from now on"""
+        subscriber = Subscriber(self.app.config['CHANGE_FEED_BUFFER'])
+        with self._lock:
+            self.subscribers.add(subscriber)
+            if self._thread is None:
+                with db.get_engine(self.app).connect() as connection:
+                    self._last_id = last_id(connection)
+                self._thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+    def _publish(self, rows):
+        with self._lock:
+            for subscriber in list(self.subscribers):
+                for row in rows:
+                    try:
+                        subscriber.events.put_nowait(row)
+                    except queue.Full:
+                        # too slow to keep up, it reconnects and catches up from the log instead
+                        subscriber.overflowed = True
+                        self.subscribers.discard(subscriber)
+                        self.dropped += 1
+                        break
+            self._last_id = rows[-1][0]
+
+    def _listen(self, engine):
+        """A dedicated LISTENing DBAPI connection on Postgres, None elsewhere"""
+        if engine.dialect.name != 'postgresql':
+            return None
+        connection = engine.raw_connection()
+        # keep it out of the pool, it stays LISTENing until it is closed
+        connection.detach()
+        connection.connection.autocommit = True
+        cursor = connection.connection.cursor()
+        cursor.execute('LISTEN {}'.format(CHANNEL))
+        cursor.close()
+        return connection
+
+    def _wait(self, listener):
+        if listener is None:
+            time.sleep(self.app.config['CHANGE_FEED_POLL'])
+            return
+        raw = listener.connection
+        if _select.select([raw], [], [], LISTEN_POLL)[0]:
+            raw.poll()
+            del raw.notifies[:]
+
+    def _run(self):
+        engine = db.get_engine(self.app)
+        listener = None
+        try:
+            listener = self._listen(engine)
+            while True:
+                with self._lock:
+                    if not self.subscribers:
+                        self._thread = None
+                        return
+                    after = self._last_id
+                try:
+                    with engine.connect() as connection:
+                        rows = read(connection, after)
+                        while rows:
+                            self._publish(rows)
+                            rows = read(connection, rows[-1][0]) if len(rows) == READ_CHUNK else []
+                except Exception:
+                    log.exception('Reading the order change log failed')
+                self._wait(listener)
+        finally:
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+            if listener is not None:
+                listener.close()
+
+
+def init_app(app):
+    app.config.setdefault('CHANGE_FEED_POLL', 0.5)
+    app.config.setdefault('CHANGE_FEED_BUFFER', 1000)
+    app.config.setdefault('CHANGE_FEED_HEARTBEAT', 15.0)
+    app.extensions['changes'] = Feed(app)
+
+
+def feed():
+    return current_app.extensions['changes']
+
+
+def metric_families():
+    """Connected subscribers and slow ones dropped, for app.instrumentation.Metrics.add_source"""
+    state = current_app.extensions.get('changes') if current_app else None
+    return [
+        ('api_change_feed_subscribers', 'gauge', 'Clients connected to /api/orders/stream',
+         [((), len(state.subscribers) if state else 0)]),
+        ('api_change_feed_dropped_total', 'counter', 'Change feed clients disconnected for falling behind',
+         [((), state.dropped if state else 0)]),
+    ]
@@ -0,0 +1,229 @@
+"""
+CSV exports for the orders date-range endpoint. Rows are produced by generators
+and written straight into a streamed response, so nothing is staged on disk and
+the first bytes go out before the last row has been read from the database.
+
+Exports too big to wait for can run as background jobs instead: ExportJobs
+writes them (CSV or NDJSON) to EXPORT_DIR on a bounded thread pool, keeps
+identical requests on one job while it runs and deletes finished files after
+EXPORT_TTL seconds
+"""
+import csv
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, stream_with_context, current_app
+from app import db
+from app import formats
+from app.admission import SharedState, alive
+from app.aggregates import as_day
+from app.extensions import PerApp
+from app.models import Customer, Product, Order, OrderItem
+
+ORDER_ITEM_HEADER = ['order_id', 'customer_id', 'customer', 'date', 'status', 'product', 'quantity']
+CHUNK_SIZE = 1000
+OUTPUTS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+
+class _Echo(object):
+    """File-like object whose write() hands back the line instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(header, rows):
+    """Yield the CSV encoded header and rows one line at a time"""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def csv_response(filename, header, rows):
+    """Stream rows to the client as a CSV attachment"""
+    return Response(
+        stream_with_context(csv_lines(header, rows)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
+
+
+def interval_rows(results):
+    """Rows for the per-interval averages, one per product"""
+    for item, frequency in results.items():
+        yield [item, frequency]
+
+
+def order_item_rows(start_date, end_date):
+    """
+    Rows for the raw listing, one per order item in the date range, read from a
+    flat column-only join in chunks of CHUNK_SIZE rather than loaded all at once
+    """
+    query = db.session.query(
+            Order.id, Order.customer_id, Customer.name, Order.date, Order.status, Product.name, OrderItem.quantity) \
+        .join(Customer, Customer.id == Order.customer_id) \
+        .join(OrderItem, OrderItem.order_id == Order.id) \
+        .join(Product, Product.id == OrderItem.product_id) \
+        .filter(Order.date.between(as_day(start_date), as_day(end_date))) \
+        .order_by(Order.id, OrderItem.id) \
+        .yield_per(CHUNK_SIZE)
+    for order_id, customer_id, customer, date, status, product, quantity in query:
+        yield [order_id, customer_id, customer, date.strftime('%Y-%m-%d'), status, product, quantity]
+
+
+def write_file(path, output, header, rows, progress):
+    """Write rows to path as CSV or NDJSON, calling progress(rows written) every CHUNK_SIZE rows"""
+    written = 0
+    with open(path, 'wb') as out:
+        if output == 'csv':
+            writer = csv.writer(_Echo())
+            out.write(writer.writerow(header).encode('utf-8'))
+        for row in rows:
+            if output == 'csv':
+                out.write(writer.writerow(row).encode('utf-8'))
+            else:
+                out.write(formats.dumps(dict(zip(header, row)), sort_keys=False) + b'\n')
+            written += 1
+            if written % CHUNK_SIZE == 0:
+                progress(written)
+    progress(written)
+
+
+class ExportJobs(object):
+    """
+    Background exports on a bounded pool of worker threads per process. Job state
+    lives in a registry file in EXPORT_DIR, next to the exported files, so any
+    worker process on the host can report on and serve a job another one ran
+    """
+
+    def __init__(self, app):
+        self._futures = {}
+        self._pool = None
+        app.config.setdefault('EXPORT_WORKERS', 2)
+        app.config.setdefault('EXPORT_QUEUE_SIZE', 20)
+        app.config.setdefault('EXPORT_TTL', 3600)
+        app.config.setdefault('EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'customer_api_exports'))
+        self.app = app
+        self.directory = app.config['EXPORT_DIR']
+        self._registry = SharedState(os.path.join(self.directory, 'jobs.json'))
+
+    def _state(self):
+        """The registry, {'jobs': {id: job}, 'keys': {key: id of its queued or running job}}, locked for update"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        return self._registry.locked()
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.app.config['EXPORT_WORKERS'])
+        return self._pool
+
+    def submit(self, key, filename, output, produce):
+        """
+        Queue produce() -> (header, rows) to be written as 'output' and return the job,
+        or the existing job for the same key while it is still queued or running.
+        Raises OverflowError when EXPORT_QUEUE_SIZE jobs are already waiting
+        """
+        self.expire()
+        key = hashlib.sha1(repr((key, output)).encode('utf-8')).hexdigest()
+        with self._state() as state:
+            jobs, keys = state.setdefault('jobs', {}), state.setdefault('keys', {})
+            existing = jobs.get(keys.get(key))
+            if existing is not None:
+                return existing
+            waiting = sum(1 for job in jobs.values() if job['status'] in ('queued', 'running'))
+            if waiting >= self.app.config['EXPORT_QUEUE_SIZE']:
+                raise OverflowError('Too many exports in progress, try again later.')
+            job_id = uuid.uuid4().hex
+            job = {'id': job_id, 'status': 'queued', 'rows': 0, 'output': output,
+                   'filename': '{}.{}'.format(filename, output), 'created': time.time(), 'finished': None,
+                   'error': None, 'path': os.path.join(self.directory, job_id + '.' + output), 'key': key,
+                   'pid': os.getpid()}
+            jobs[job_id] = job
+            keys[key] = job_id
+        self._futures[job_id] = self._executor().submit(self._run, current_app._get_current_object(), job, produce)
+        return job
+
+    def _update(self, job_id, **changes):
+        with self._state() as state:
+            job = state['jobs'].get(job_id)
+            if job is None:
+                return
+            job.update(changes)
+            if job['status'] in ('done', 'failed') and state['keys'].get(job['key']) == job_id:
+                # finished exports are served until they expire, but a new request exports afresh
+                del state['keys'][job['key']]
+
+    def _run(self, app, job, produce):
+        with app.app_context():
+            try:
+                self._update(job['id'], status='running')
+                header, rows = produce()
+                write_file(job['path'], job['output'], header, rows,
+                           lambda written: self._update(job['id'], rows=written))
+                self._update(job['id'], status='done', finished=time.time())
+            except Exception as e:
+                app.logger.exception('Export %s failed', job['id'])
+                self._update(job['id'], status='failed', error=str(e), finished=time.time())
+            finally:
+                db.session.remove()
+                self._futures.pop(job['id'], None)
+
+    def get(self, job_id):
+        """The job's state, or None if it doesn't exist or has expired"""
+        self.expire()
+        with self._state() as state:
+            return state.get('jobs', {}).get(job_id)
+
+    def wait(self, job_id, timeout=None):
+        """Block until a job this process runs finishes, for tests and the CLI"""
+        future = self._futures.get(job_id)
+        if future is not None:
+            future.result(timeout)
+
+    def expire(self, now=None):
+        """
+        Forget finished jobs older than EXPORT_TTL and delete their files, and fail
+        the jobs of worker processes that died before finishing them
+        """
+        now = now or time.time()
+        cutoff = now - self.app.config['EXPORT_TTL']
+        with self._state() as state:
+            jobs, keys = state.setdefault('jobs', {}), state.setdefault('keys', {})
+            for job in jobs.values():
+                if job['finished'] is None and not alive(job['pid']):
+                    job.update(status='failed', error='The worker running this export stopped.', finished=now)
+            old = [job for job in jobs.values() if job['finished'] is not None and job['finished'] <= cutoff]
+            for job in old:
+                del jobs[job['id']]
+            for key, job_id in list(keys.items()):
+                if job_id not in jobs or jobs[job_id]['finished'] is not None:
+                    del keys[key]
+        for job in old:
+            if os.path.exists(job['path']):
+                os.remove(job['path'])
+
+    def shutdown(self):
+        """Stop the pool, and forget the jobs this process ran and remove their files"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        if not os.path.isdir(self.directory):
+            return
+        with self._state() as state:
+            jobs, keys = state.setdefault('jobs', {}), state.setdefault('keys', {})
+            mine = [job for job in jobs.values() if job['pid'] == os.getpid()]
+            for job in mine:
+                del jobs[job['id']]
+                if keys.get(job['key']) == job['id']:
+                    del keys[job['key']]
+        for job in mine:
+            if os.path.exists(job['path']):
+                os.remove(job['path'])
+
+
+# each app's ExportJobs, see app/extensions.py
+jobs = PerApp('exports', ExportJobs)
@@ -0,0 +1,33 @@
+"""
+Per-app state for the module-level helpers (app.cache.cache, app.routing.router,
+app.exports.jobs and app.analytics.store). Every app built by create_app() keeps
+its own instance in app.extensions, so two apps in one process never share
+cached responses, replica engines, export jobs or columnar analytics arrays. The module-level object forwards to the
+instance of the current app, or of the default app outside an app context, the
+same way db.session does
+"""
+
+
+class PerApp(object):
+
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+
+    def init_app(self, app):
+        """Build the app's instance with factory(app)"""
+        app.extensions[self._name] = self._factory(app)
+        return app.extensions[self._name]
+
+    def for_app(self, app=None):
+        from app import db
+        return (app or db.get_app()).extensions[self._name]
+
+    def metric_families(self):
+        """The current app's samples, for app.instrumentation.Metrics.add_source"""
+        return self.for_app().metric_families()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.for_app(), name)
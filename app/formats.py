@@ -0,0 +1,124 @@
+"""
+Content negotiation for the read endpoints. Responses are JSON unless the client
+sends Accept: application/msgpack, and ?format=columnar turns a list of rows into
+one array per column ({"id": [1, 2], "name": ["a", "b"]}), which is much smaller
+than repeating every key on every row. JSON goes through orjson and MessagePack
+through msgpack when they are installed, the stdlib json module is the fallback.
+
+JSON comes out byte for byte as jsonify wrote it: sorted keys, ASCII only, HTTP
+dates and a trailing newline, pretty printed in debug mode. orjson is used
+when its output would be the same, which is everything but non-ASCII text,
+floats Python writes in exponent form and dicts with non-string keys
+"""
+import json
+import re
+from flask import request, abort, current_app, has_app_context, Response
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+# older clients still send the pre-registration name
+MSGPACK_TYPES = (MSGPACK, 'application/x-msgpack')
+FORMATS = ('rows', 'columnar')
+# orjson output Python's json module would write differently: exponents (1e16, 2.5e-7) and 0.00001
+DIFFERENT_FLOATS = re.compile(rb'[0-9]e|0\.0000')
+
+
+def negotiate():
+    """The mimetype the response will be encoded as, or None if nothing the client accepts is available"""
+    if not request.accept_mimetypes:
+        return JSON
+    offered = [JSON] + (list(MSGPACK_TYPES) if msgpack is not None else [])
+    match = request.accept_mimetypes.best_match(offered)
+    return MSGPACK if match in MSGPACK_TYPES else match
+
+
+def columnar(results, columns):
+    """
+    Transpose results into {column: [values]}. Handles a list of dicts, a list of
+    row lists, a list of scalars (one column) and a {key: value or row list} mapping,
+    whose keys become the first column
+    """
+    if isinstance(results, dict):
+        keys = list(results)
+        values = list(results.values())
+        if len(columns) == 2:
+            return {columns[0]: keys, columns[1]: values}
+        results = [[key] + list(value) for key, value in zip(keys, values)]
+    if not results:
+        return {column: [] for column in columns or ()}
+    if isinstance(results[0], dict):
+        columns = columns or list(results[0])
+        return {column: [row[column] for row in results] for column in columns}
+    if len(columns) == 1:
+        return {columns[0]: list(results)}
+    return {column: [row[index] for row in results] for index, column in enumerate(columns)}
+
+
+def shape(results, columns=None):
+    """Apply ?format= to results, raises ValueError with a user facing message for unknown formats"""
+    requested = request.args.get('format', 'rows')
+    if requested not in FORMATS:
+        raise ValueError('Invalid format, choose from: {}.'.format(', '.join(FORMATS)))
+    return columnar(results, columns) if requested == 'columnar' else results
+
+
+def _pretty():
+    """Whether jsonify would indent, as it does in debug mode"""
+    if not has_app_context():
+        return False
+    compact = getattr(current_app.json, 'compact', None)
+    return compact is False or (compact is None and current_app.debug)
+
+
+def dumps(payload, sort_keys=True):
+    """payload as compact JSON, the same bytes as json.dumps with jsonify's settings"""
+    if orjson is not None:
+        try:
+            data = orjson.dumps(payload, default=DefaultJSONProvider.default,
+                                option=(orjson.OPT_SORT_KEYS if sort_keys else 0) | orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            # non-string keys, which json.dumps sorts before turning them into strings
+            data = None
+        if data is not None and data.isascii() and not DIFFERENT_FLOATS.search(data):
+            return data
+    return json.dumps(payload, default=DefaultJSONProvider.default, sort_keys=sort_keys,
+                      separators=(',', ':')).encode('ascii')
+
+
+def encode(payload, mimetype):
+    if mimetype == MSGPACK:
+        if isinstance(payload, dict):
+            payload = {str(key): value for key, value in payload.items()}
+        return msgpack.packb(payload, use_bin_type=True)
+    if _pretty():
+        return current_app.json.dumps(payload, indent=2).encode('utf-8') + b'\n'
+    return dumps(payload) + b'\n'
+
+
+def respond(payload, status=200):
+    """Encode an already shaped payload in the negotiated format"""
+    mimetype = negotiate()
+    if mimetype is None:
+        abort(406)
+    response = Response(encode(payload, mimetype), status=status, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+def render(results, columns=None):
+    """Shape and encode results, or a 400 for an unknown ?format="""
+    try:
+        payload = shape(results, columns)
+    except ValueError as e:
+        return respond({'error': str(e)}, 400)
+    return respond(payload)
@@ -0,0 +1,201 @@
+"""
+Bulk order ingestion. Orders arrive as NDJSON, one order per line with its items
+nested inside, e.g.
+
+    {"customer_id": 1, "status": "Waiting", "date": "2018-03-12",
+     "items": [{"product_id": 1, "quantity": 5}]}
+
+Lines are validated as they are read and written in batches with Core inserts,
+using COPY on Postgres and a single executemany per table everywhere else,
+each batch in its own transaction. A batch the database refuses (say a concurrent
+writer took its ids) is reported line by line and the upload carries on
+"""
+import csv
+import datetime
+import io
+import json
+import time
+from sqlalchemy import exc, func, select, text
+from app import db
+from app import changes, rollups, summaries
+from app.cache import cache
+from app.models import Customer, Product, Order, OrderItem
+
+BATCH_SIZE = 5000
+MAX_ERRORS = 100
+
+orders = Order.__table__
+order_items = OrderItem.__table__
+
+
+def validate(line):
+    """Turn one NDJSON line into an order dict, raises ValueError explaining what is wrong"""
+    try:
+        data = json.loads(line)
+    except ValueError:
+        raise ValueError('Line is not valid JSON.')
+    if not isinstance(data, dict):
+        raise ValueError('Each line must be a JSON object.')
+    customer_id, status = data.get('customer_id'), data.get('status')
+    if not isinstance(customer_id, int) or isinstance(customer_id, bool):
+        raise ValueError('customer_id must be an integer.')
+    if not isinstance(status, str) or not status:
+        raise ValueError('status must be a non-empty string.')
+    try:
+        date = datetime.datetime.strptime(data.get('date') or '', '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise ValueError('date must be in YYYY-MM-DD format.')
+    items = data.get('items', [])
+    if not isinstance(items, list):
+        raise ValueError('items must be a list.')
+    for item in items:
+        if not isinstance(item, dict):
+            raise ValueError('Each item must be an object.')
+        for key in ('product_id', 'quantity'):
+            if not isinstance(item.get(key), int) or isinstance(item.get(key), bool):
+                raise ValueError('Item {} must be an integer.'.format(key))
+        if item['quantity'] < 1:
+            raise ValueError('Item quantity must be at least 1.')
+    return {'customer_id': customer_id, 'status': status, 'date': date,
+            'items': [{'product_id': item['product_id'], 'quantity': item['quantity']} for item in items]}
+
+
+def _existing(connection, column, ids):
+    if not ids:
+        return set()
+    return set(row[0] for row in connection.execute(select([column]).where(column.in_(sorted(ids)))))
+
+
+def copy_rows(connection, table, columns, rows):
+    """Load rows into table with Postgres COPY ... FROM STDIN"""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN WITH CSV'.format(table, ', '.join(columns)), buffer)
+    finally:
+        cursor.close()
+
+
+def _allocate_ids(connection, table, count):
+    """
+    Reserve ids for a batch of rows so they can be referenced (and reported in the
+    change feed) before insert. Postgres hands them out from the table's sequence,
+    elsewhere they follow the current max id (a concurrent writer racing for the
+    same ids fails the batch on the primary key, see ingest())
+    """
+    if not count:
+        return []
+    if connection.dialect.name == 'postgresql':
+        return [row[0] for row in connection.execute(
+            text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+            table=table.name, count=count)]
+    start = connection.execute(select([func.coalesce(func.max(table.c.id), 0)])).scalar() + 1
+    return list(range(start, start + count))
+
+
+def _error(summary, line, message):
+    summary['error_count'] += 1
+    if len(summary['errors']) < MAX_ERRORS:
+        summary['errors'].append({'line': line, 'error': message})
+
+
+def write_batch(batch, summary):
+    """
+    Insert one batch of (line number, order) pairs in a single transaction, after
+    dropping orders that reference customers or products that don't exist.
+    Returns the batch's row counts and timing. Rejected lines are only reported
+    once the batch commits
+    """
+    started = time.time()
+    rejected = []
+    with db.engine.begin() as connection:
+        customers = _existing(connection, Customer.__table__.c.id, set(order['customer_id'] for _, order in batch))
+        products = _existing(connection, Product.__table__.c.id,
+            set(item['product_id'] for _, order in batch for item in order['items']))
+        valid = []
+        for line, order in batch:
+            missing_products = [item['product_id'] for item in order['items'] if item['product_id'] not in products]
+            if order['customer_id'] not in customers:
+                rejected.append((line, 'Unknown customer_id {}.'.format(order['customer_id'])))
+            elif missing_products:
+                rejected.append((line, 'Unknown product_id {}.'.format(missing_products[0])))
+            else:
+                valid.append(order)
+        order_rows, item_rows = [], []
+        item_ids = iter(_allocate_ids(connection, order_items, sum(len(order['items']) for order in valid)))
+        for order_id, order in zip(_allocate_ids(connection, orders, len(valid)), valid):
+            order_rows.append({'id': order_id, 'status': order['status'], 'date': order['date'],
+                               'customer_id': order['customer_id']})
+            item_rows.extend({'id': next(item_ids), 'quantity': item['quantity'], 'product_id': item['product_id'],
+                              'order_id': order_id} for item in order['items'])
+        if connection.dialect.name == 'postgresql':
+            method = 'copy'
+            copy_rows(connection, 'orders', ['id', 'status', 'date', 'customer_id'],
+                [(row['id'], row['status'], row['date'].isoformat(), row['customer_id']) for row in order_rows])
+            copy_rows(connection, 'order_items', ['id', 'quantity', 'product_id', 'order_id'],
+                [(row['id'], row['quantity'], row['product_id'], row['order_id']) for row in item_rows])
+        else:
+            method = 'executemany'
+            if order_rows:
+                connection.execute(orders.insert(), order_rows)
+            if item_rows:
+                connection.execute(order_items.insert(), item_rows)
+        after_bulk_insert(connection, order_rows, item_rows)
+    for line, message in rejected:
+        _error(summary, line, message)
+    cache.invalidate(['orders', 'order_items'])
+    return {'orders': len(order_rows), 'order_items': len(item_rows), 'method': method,
+            'seconds': round(time.time() - started, 4)}
+
+
+def after_bulk_insert(connection, order_rows, item_rows):
+    """
+    Core inserts skip the ORM session events, so do the same bookkeeping they
+    would have done for the rows just written
+    """
+    dates = {row['id']: row['date'] for row in order_rows}
+    rollups.refresh(connection, set((dates[row['order_id']], row['product_id']) for row in item_rows))
+    summaries.apply(connection, summaries.bulk_deltas(order_rows, item_rows))
+    changes.record(connection, changes.bulk_events(order_rows, item_rows))
+
+
+def ingest(lines, batch_size=BATCH_SIZE):
+    """
+    Validate and insert orders from an iterable of NDJSON lines. Invalid lines are
+    reported (up to MAX_ERRORS of them) and skipped, the rest are written in batches
+    """
+    summary = {'orders': 0, 'order_items': 0, 'batches': [], 'errors': [], 'error_count': 0}
+    batch = []
+
+    def flush():
+        try:
+            result = write_batch(batch, summary)
+        except exc.DBAPIError as e:
+            # the batch rolled back, the batches before it stay written and the rest still go in
+            message = 'Batch not written, send the line again: {}'.format(str(e.orig).strip() or type(e.orig).__name__)
+            for line, _ in batch:
+                _error(summary, line, message)
+            result = {'orders': 0, 'order_items': 0, 'lines': [batch[0][0], batch[-1][0]], 'error': str(e.orig)}
+        summary['batches'].append(result)
+        summary['orders'] += result['orders']
+        summary['order_items'] += result['order_items']
+        del batch[:]
+
+    for number, line in enumerate(lines, 1):
+        try:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.strip():
+                continue
+            batch.append((number, validate(line)))
+        except UnicodeDecodeError:
+            _error(summary, number, 'Line is not valid UTF-8.')
+        except ValueError as e:
+            _error(summary, number, str(e))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return summary
@@ -0,0 +1,174 @@
+"""
+Per-request SQL instrumentation. Engine events time every statement and tally it
+against the current request, the request hooks turn that into a Server-Timing
+header (plus X-Rows-Processed when rows were streamed through
+app.aggregates.stream_rows), flag likely N+1 patterns (the same statement
+repeated many times in one request) and feed per-route histograms that
+/api/_metrics serves in the Prometheus text format
+"""
+import re
+import threading
+import time
+from collections import Counter
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500, 1000)
+
+
+def fingerprint(statement):
+    """Collapse a statement to its shape, so the same query with different parameters matches"""
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    statement = re.sub(r'\b\d+\b', '?', statement)
+    statement = re.sub(r"'[^']*'", '?', statement)
+    return re.sub(r'\((\s*\?\s*,)+\s*\?\s*\)', '(?)', statement)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+class Metrics(object):
+    """Thread-safe per-route histograms and counters, rendered in Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = Counter()
+        self._sources = []
+
+    def observe(self, name, buckets, labels, value):
+        with self._lock:
+            key = (name, labels)
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+
+    def increment(self, name, labels, amount=1):
+        with self._lock:
+            self._counters[(name, labels)] += amount
+
+    def add_source(self, source):
+        """Register a callable returning extra (name, type, help, [(labels, value)]) metric families"""
+        self._sources.append(source)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self):
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        for name in sorted(set(key[0] for key, _ in histograms)):
+            lines.append('# HELP {} {}'.format(name, HELP.get(name, name)))
+            lines.append('# TYPE {} histogram'.format(name))
+            for (metric, labels), histogram in histograms:
+                if metric != name:
+                    continue
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', _number(bound)),)), count))
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', '+Inf'),)), histogram.count))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(histogram.sum)))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), histogram.count))
+        families = [(name, 'counter', HELP.get(name, name), [(labels, value) for (metric, labels), value in counters
+                                                                if metric == name])
+                    for name in sorted(set(key[0] for key, _ in counters))]
+        for source in self._sources:
+            families.extend(source())
+        for name, kind, help_text, samples in families:
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, _labels(tuple(labels)), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+HELP = {
+    'api_request_duration_seconds': 'Time spent handling the request',
+    'api_request_sql_queries': 'SQL statements executed per request',
+    'api_request_sql_seconds': 'Time spent in SQL per request',
+    'api_n_plus_one_total': 'Requests that repeated one SQL statement past the N+1 threshold',
+    'api_requests_shed_total': 'Requests turned away by admission control',
+}
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+metrics = Metrics()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    if has_request_context() and hasattr(g, 'sql_queries'):
+        g.sql_queries += 1
+        g.sql_seconds += elapsed
+        g.sql_fingerprints[fingerprint(statement)] += 1
+
+
+def init_app(app):
+    app.config.setdefault('SQL_N_PLUS_ONE_THRESHOLD', 10)
+
+    @app.before_request
+    def start_instrumentation():
+        g.request_started = time.perf_counter()
+        g.sql_queries = 0
+        g.sql_seconds = 0.0
+        g.sql_fingerprints = Counter()
+
+    @app.after_request
+    def record_instrumentation(response):
+        if not hasattr(g, 'request_started'):
+            return response
+        elapsed = time.perf_counter() - g.request_started
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        labels = (('method', request.method), ('route', route))
+        metrics.observe('api_request_duration_seconds', DURATION_BUCKETS, labels, elapsed)
+        metrics.observe('api_request_sql_queries', QUERY_BUCKETS, labels, g.sql_queries)
+        metrics.observe('api_request_sql_seconds', DURATION_BUCKETS, labels, g.sql_seconds)
+        timing = 'db;dur={:.2f};desc="{} queries", app;dur={:.2f}'.format(
+            g.sql_seconds * 1000, g.sql_queries, elapsed * 1000)
+        if g.sql_fingerprints:
+            statement, repeats = g.sql_fingerprints.most_common(1)[0]
+            if repeats >= app.config['SQL_N_PLUS_ONE_THRESHOLD']:
+                metrics.increment('api_n_plus_one_total', labels)
+                timing += ', n-plus-one;desc="{} x repeated statement"'.format(repeats)
+                app.logger.warning('Possible N+1 on %s %s: %d x %s', request.method, route, repeats, statement)
+        response.headers['Server-Timing'] = timing
+        if 'rows_processed' in g:
+            response.headers['X-Rows-Processed'] = str(g.rows_processed)
+        return response
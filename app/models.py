@@ -5,12 +5,16 @@ import datetime
 class Order(db.Model):
 
     __tablename__ = 'orders'
+    __table_args__ = (
+        db.Index('ix_orders_date', 'date'),
+        db.Index('ix_orders_customer_id', 'customer_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     status = db.Column(db.Text, nullable=False)
     date = db.Column(db.Date, nullable=False)
     customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
-    order_items = db.relationship('OrderItem', backref='order', lazy=True)
+    order_items = db.relationship('OrderItem', backref='order', lazy=True, order_by='OrderItem.id')
 
     def __init__(self, customer_id, status, date=datetime.datetime.now().strftime('%Y-%m-%d')):
         self.customer_id = customer_id
@@ -23,6 +27,10 @@ class Order(db.Model):
 
 class OrderItem(db.Model):
     __tablename__ = 'order_items'
+    __table_args__ = (
+        db.Index('ix_order_items_order_id', 'order_id', 'product_id', 'quantity'),
+        db.Index('ix_order_items_product_id', 'product_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     quantity = db.Column(db.Integer, nullable=False)
@@ -54,7 +62,9 @@ class Category(db.Model):
 
 products_categories = db.Table('products_categories',
     db.Column('product_id', db.Integer, db.ForeignKey('products.id')),
-    db.Column('category_id',db.Integer, db.ForeignKey('categories.id'))
+    db.Column('category_id',db.Integer, db.ForeignKey('categories.id')),
+    db.Index('ix_products_categories_product_id', 'product_id', 'category_id'),
+    db.Index('ix_products_categories_category_id', 'category_id', 'product_id')
 )
 
 
@@ -95,3 +105,93 @@ class Customer(db.Model):
     def __repr__(self):
         return "{}".format(self.name)
 
+
+class DailyProductSales(db.Model):
+    """Rollup of quantity sold per product per day, maintained by app/rollups.py"""
+
+    __tablename__ = 'daily_product_sales'
+
+    date = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, date, product_id, quantity):
+        self.date = date
+        self.product_id = product_id
+        self.quantity = quantity
+
+    def __repr__(self):
+        return "{}, Product ID: {}, Quantity: {}".format(self.date, self.product_id, self.quantity)
+
+
+
+class DailyProductSketch(db.Model):
+    """Count-Min and top-K sketch of one day of daily_product_sales, maintained by app/sketches.py"""
+
+    __tablename__ = 'daily_product_sketches'
+
+    date = db.Column(db.Date, primary_key=True)
+    total = db.Column(db.Integer, nullable=False)
+    # largest quantity of a product that isn't in 'top'
+    threshold = db.Column(db.Integer, nullable=False)
+    # JSON list of [product id, quantity] pairs, largest first
+    top = db.Column(db.Text, nullable=False)
+    counts = db.Column(db.LargeBinary, nullable=False)
+
+    def __init__(self, date, total, threshold, top, counts):
+        self.date = date
+        self.total = total
+        self.threshold = threshold
+        self.top = top
+        self.counts = counts
+
+    def __repr__(self):
+        return "{}, Total: {}, Top: {}".format(self.date, self.total, self.top)
+
+class CustomerSummary(db.Model):
+    """Order totals per customer, maintained by app/summaries.py"""
+
+    __tablename__ = 'customer_summaries'
+
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False)
+    total_quantity = db.Column(db.Integer, nullable=False)
+    last_order_date = db.Column(db.Date)
+    # JSON object of order count per status
+    status_counts = db.Column(db.Text, nullable=False)
+
+    def __init__(self, customer_id, order_count=0, total_quantity=0, last_order_date=None, status_counts='{}'):
+        self.customer_id = customer_id
+        self.order_count = order_count
+        self.total_quantity = total_quantity
+        self.last_order_date = last_order_date
+        self.status_counts = status_counts
+
+    def __repr__(self):
+        return "Customer ID: {}, Orders: {}, Quantity: {}".format(self.customer_id, self.order_count,
+                                                                 self.total_quantity)
+
+
+class OrderChange(db.Model):
+    """Change log of new orders, order items and status changes, written by app/changes.py"""
+
+    __tablename__ = 'order_changes'
+    __table_args__ = (
+        # changes.prune() deletes by age
+        db.Index('ix_order_changes_created', 'created'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.Text, nullable=False)
+    order_id = db.Column(db.Integer, nullable=False)
+    # JSON of the event sent to /api/orders/stream subscribers
+    data = db.Column(db.Text, nullable=False)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __init__(self, kind, order_id, data):
+        self.kind = kind
+        self.order_id = order_id
+        self.data = data
+
+    def __repr__(self):
+        return "{} {}, Order ID: {}".format(self.kind, self.id, self.order_id)
@@ -0,0 +1,110 @@
+"""
+Keyset (cursor) pagination for the list endpoints. Pages are walked with
+?limit=N&after=<id>, where 'after' is the last id of the previous page, so every
+page is an indexed range scan on the primary key no matter how deep you go.
+An optional ?fields=a,b,c trims each row down to the listed keys
+"""
+from flask import request, url_for
+from app import db
+from app import formats
+from app.models import Customer, Category, Product, Order, OrderItem, products_categories
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+CUSTOMER_FIELDS = ('id', 'name')
+PRODUCT_FIELDS = ('id', 'name', 'categories')
+ORDER_FIELDS = ('id', 'customer_id', 'customer', 'status', 'date', 'items')
+
+
+def wants_page():
+    """True if the request asked for a paginated/projected listing"""
+    return any(arg in request.args for arg in ('limit', 'after', 'fields'))
+
+
+def page_args(allowed_fields):
+    """
+    Read limit, after and fields from the query string, raises ValueError with
+    a user facing message if any of them are malformed
+    """
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+        after = request.args.get('after')
+        after = int(after) if after is not None else None
+    except ValueError:
+        raise ValueError('Invalid page parameters, limit and after must be integers.')
+    if limit < 1:
+        raise ValueError('Invalid page parameters, limit must be at least 1.')
+    fields = request.args.get('fields')
+    if fields is not None:
+        fields = [field for field in fields.split(',') if field]
+        unknown = [field for field in fields if field not in allowed_fields]
+        if unknown or not fields:
+            raise ValueError('Invalid fields, choose from: {}.'.format(', '.join(allowed_fields)))
+    return min(limit, MAX_LIMIT), after, fields
+
+
+def keyset(query, id_column, after, limit):
+    """Return one page of query rows after the given id, and whether more rows follow"""
+    if after is not None:
+        query = query.filter(id_column > after)
+    rows = query.order_by(id_column).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+
+def page_response(results, has_more, limit, fields):
+    """
+    Wrap a page of row dicts in a {results, next} envelope with a Link header,
+    raises ValueError for an unknown ?format=
+    """
+    next_url = None
+    if has_more:
+        args = request.args.to_dict()
+        args.update(limit=limit, after=results[-1]['id'])
+        args.update(request.view_args or {})
+        next_url = url_for(request.endpoint, **args)
+    if fields:
+        results = [{field: row[field] for field in fields} for row in results]
+    response = formats.respond({'results': formats.shape(results, fields), 'next': next_url})
+    if next_url:
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    return response
+
+
+def customers_page(limit, after, fields):
+    rows, has_more = keyset(db.session.query(Customer.id, Customer.name), Customer.id, after, limit)
+    results = [{'id': customer_id, 'name': name} for customer_id, name in rows]
+    return page_response(results, has_more, limit, fields)
+
+
+def products_page(limit, after, fields):
+    rows, has_more = keyset(db.session.query(Product.id, Product.name), Product.id, after, limit)
+    results = [{'id': product_id, 'name': name, 'categories': []} for product_id, name in rows]
+    if results and (fields is None or 'categories' in fields):
+        by_id = {row['id']: row for row in results}
+        categories = db.session.query(products_categories.c.product_id, Category.name) \
+            .join(Category, Category.id == products_categories.c.category_id) \
+            .filter(products_categories.c.product_id.in_(list(by_id)))
+        for product_id, name in categories:
+            by_id[product_id]['categories'].append(name)
+    return page_response(results, has_more, limit, fields)
+
+
+def orders_page(limit, after, fields):
+    query = db.session.query(Order.id, Order.customer_id, Customer.name, Order.status, Order.date) \
+        .join(Customer, Customer.id == Order.customer_id)
+    rows, has_more = keyset(query, Order.id, after, limit)
+    results = [
+        {'id': order_id, 'customer_id': customer_id, 'customer': name, 'status': status,
+         'date': date.strftime('%Y-%m-%d'), 'items': []}
+        for order_id, customer_id, name, status, date in rows
+    ]
+    if results and (fields is None or 'items' in fields):
+        by_id = {row['id']: row for row in results}
+        items = db.session.query(OrderItem.order_id, OrderItem.product_id, Product.name, OrderItem.quantity) \
+            .join(Product, Product.id == OrderItem.product_id) \
+            .filter(OrderItem.order_id.in_(list(by_id))) \
+            .order_by(OrderItem.id)
+        for order_id, product_id, name, quantity in items:
+            by_id[order_id]['items'].append({'product.id': product_id, 'name': name, 'quantity': quantity})
+    return page_response(results, has_more, limit, fields)
@@ -0,0 +1,149 @@
+"""
+Keeps the daily_product_sales rollup in step with orders and order_items.
+Every flush that writes an OrderItem, or moves an Order to another date, recomputes
+the affected (date, product) rows inside the same transaction, so the rollup is
+always consistent with what gets committed. On Postgres, writers of the same day
+take turns (see _lock()). What changed is passed on to the daily sketches of
+app/sketches.py
+"""
+import datetime
+from itertools import chain
+from sqlalchemy import bindparam, event, func, select, text
+from sqlalchemy.orm import Session, attributes
+from app import sketches
+from app.models import Order, OrderItem, DailyProductSales
+
+rollup = DailyProductSales.__table__
+orders = Order.__table__
+order_items = OrderItem.__table__
+
+# pg_advisory_xact_lock(LOCK_KEY, day) serialises the writers of one day, see _lock()
+LOCK_KEY = 72210252
+
+
+def _as_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+def _history(obj, key):
+    """Current and previous values of an attribute that changed in this flush"""
+    history = attributes.get_history(obj, key)
+    values = set(chain(history.added, history.unchanged, history.deleted, [getattr(obj, key)]))
+    return [value for value in values if value is not None]
+
+
+def _totals(where):
+    return select([orders.c.date, order_items.c.product_id, func.sum(order_items.c.quantity)]) \
+        .select_from(order_items.join(orders, orders.c.id == order_items.c.order_id)) \
+        .where(where) \
+        .group_by(orders.c.date, order_items.c.product_id)
+
+
+def _lock(connection, dates):
+    """
+    On Postgres, let one transaction at a time rewrite a day, so two writers of the
+    same (date, product) key can't both find it missing and both insert it. Taken
+    in date order so writers of several days can't deadlock on each other
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    for date in sorted(dates):
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key, :day)'), key=LOCK_KEY, day=date.toordinal())
+
+
+def refresh(connection, keys):
+    """Recompute the rollup rows for an iterable of (date, product_id) keys"""
+    by_date = {}
+    for date, product_id in keys:
+        by_date.setdefault(_as_date(date), set()).add(product_id)
+    _lock(connection, by_date)
+    changed = {}
+    for date, product_ids in sorted(by_date.items()):
+        product_ids = sorted(product_ids)
+        stored = dict(connection.execute(select([rollup.c.product_id, rollup.c.quantity]).where(
+            (rollup.c.date == date) & rollup.c.product_id.in_(product_ids))).fetchall())
+        totals = dict((product_id, int(quantity)) for _, product_id, quantity in connection.execute(
+            _totals((orders.c.date == date) & order_items.c.product_id.in_(product_ids))))
+        # only write the keys that changed, updating rows in place where they already exist
+        updates = [{'key_date': date, 'key_product': product_id, 'quantity': quantity}
+                   for product_id, quantity in totals.items()
+                   if product_id in stored and stored[product_id] != quantity]
+        inserts = [{'date': date, 'product_id': product_id, 'quantity': quantity}
+                   for product_id, quantity in totals.items() if product_id not in stored]
+        gone = [product_id for product_id in stored if product_id not in totals]
+        changed[date] = dict((product_id, (stored.get(product_id, 0), totals.get(product_id, 0)))
+                             for product_id in product_ids if stored.get(product_id, 0) != totals.get(product_id, 0))
+        if updates:
+            connection.execute(rollup.update().where((rollup.c.date == bindparam('key_date'))
+                                                     & (rollup.c.product_id == bindparam('key_product'))), updates)
+        if inserts:
+            connection.execute(rollup.insert(), inserts)
+        if gone:
+            connection.execute(rollup.delete().where((rollup.c.date == date) & rollup.c.product_id.in_(gone)))
+    sketches.update(connection, changed)
+
+
+def rebuild(connection):
+    """Throw away the rollup and recompute it from every order item"""
+    connection.execute(rollup.delete())
+    connection.execute(rollup.insert().from_select(
+        ['date', 'product_id', 'quantity'], _totals(order_items.c.id.isnot(None))))
+    sketches.rebuild(connection)
+
+
+def keys_for_orders(connection, order_ids, dates=None):
+    """
+    Rollup keys touched by the items of the given orders, on each order's
+    current date plus any extra dates (e.g. the date an order was moved from)
+    """
+    if not order_ids:
+        return set()
+    rows = connection.execute(
+        select([orders.c.date, order_items.c.product_id])
+        .select_from(order_items.join(orders, orders.c.id == order_items.c.order_id))
+        .where(orders.c.id.in_(sorted(order_ids)))).fetchall()
+    keys = set()
+    for date, product_id in rows:
+        keys.add((_as_date(date), product_id))
+        for extra in dates or ():
+            keys.add((_as_date(extra), product_id))
+    return keys
+
+
+@event.listens_for(Session, 'before_flush')
+def _remember_order_dates(session, flush_context, instances):
+    """
+    Orders whose date is about to change need the old date too, which is usually
+    expired from the object by now, so read it before the flush overwrites it
+    """
+    moved = [obj.id for obj in session.dirty
+             if isinstance(obj, Order) and obj.id is not None and attributes.get_history(obj, 'date').added]
+    if moved:
+        rows = session.connection().execute(
+            select([orders.c.id, orders.c.date]).where(orders.c.id.in_(moved))).fetchall()
+        session.info['rollup_moved_orders'] = {order_id: [date] for order_id, date in rows}
+
+
+@event.listens_for(Session, 'after_flush')
+def _refresh_after_flush(session, flush_context):
+    item_keys = []
+    moved_orders = session.info.pop('rollup_moved_orders', {})
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, OrderItem):
+            for order_id in _history(obj, 'order_id'):
+                for product_id in _history(obj, 'product_id'):
+                    item_keys.append((order_id, product_id))
+    if not item_keys and not moved_orders:
+        return
+    connection = session.connection()
+    keys = set()
+    order_ids = sorted(set(order_id for order_id, _ in item_keys))
+    if order_ids:
+        dates = dict(connection.execute(
+            select([orders.c.id, orders.c.date]).where(orders.c.id.in_(order_ids))).fetchall())
+        keys.update((dates[order_id], product_id) for order_id, product_id in item_keys if order_id in dates)
+    for order_id, old_dates in moved_orders.items():
+        keys.update(keys_for_orders(connection, [order_id], old_dates))
+    refresh(connection, keys)
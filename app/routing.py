@@ -0,0 +1,217 @@
+"""
+Read-replica routing. When SQLALCHEMY_REPLICA_URIS lists one or more replicas,
+GET/HEAD requests are spread across them round-robin, and everything else
+(writes, flushes, CLI code, background jobs) stays on the primary. Each request
+sticks to the replica it was given, so all its queries see the same snapshot
+and share one connection.
+
+Replicas are health probed every REPLICA_HEALTH_INTERVAL seconds by a background
+thread, never on the request path, and only take reads once a probe has passed.
+A replica that fails a probe, or drops a connection mid-query, is skipped for
+REPLICA_RETRY_SECONDS and its share of reads falls back to the other replicas,
+or to the primary when none are left. After a client writes, a short-lived cookie
+keeps its reads on the primary (read-your-writes), as does sending an
+X-Read-Your-Writes header
+"""
+import itertools
+import os
+import threading
+import time
+from flask import request, g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from app.extensions import PerApp
+
+READ_METHODS = ('GET', 'HEAD')
+PRIMARY_COOKIE = 'read_primary_until'
+# environment variable -> (create_engine keyword, type)
+POOL_SETTINGS = {
+    'SQLALCHEMY_POOL_SIZE': ('pool_size', int),
+    'SQLALCHEMY_MAX_OVERFLOW': ('max_overflow', int),
+    'SQLALCHEMY_POOL_TIMEOUT': ('pool_timeout', int),
+    'SQLALCHEMY_POOL_RECYCLE': ('pool_recycle', int),
+    'SQLALCHEMY_POOL_PRE_PING': ('pool_pre_ping', lambda value: value.lower() not in ('0', 'false', 'off', 'no')),
+}
+
+
+def pool_options(environ):
+    """Engine keyword arguments for whichever pool settings are set in the environment"""
+    return {option: cast(environ[name]) for name, (option, cast) in POOL_SETTINGS.items() if environ.get(name)}
+
+
+def replica_uris(environ):
+    return [uri.strip() for uri in (environ.get('DATABASE_REPLICA_URLS') or '').split(',') if uri.strip()]
+
+
+class ReplicaRouter(object):
+    """One app's replica engines and their health"""
+
+    def __init__(self, app):
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._engines = None
+        self._uris = None
+        self._down_until = {}
+        self._up = set()
+        self._prober = None
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('REPLICA_HEALTH_INTERVAL', 5)
+        app.config.setdefault('REPLICA_RETRY_SECONDS', 30)
+        app.config.setdefault('READ_YOUR_WRITES_SECONDS', 5)
+        self.app = app
+        self.retry_seconds = app.config['REPLICA_RETRY_SECONDS']
+
+        @app.after_request
+        def remember_write(response):
+            if request.method not in READ_METHODS + ('OPTIONS',) and response.status_code < 400 \
+                    and app.config['SQLALCHEMY_REPLICA_URIS']:
+                response.set_cookie(PRIMARY_COOKIE, str(time.time() + app.config['READ_YOUR_WRITES_SECONDS']),
+                                    max_age=app.config['READ_YOUR_WRITES_SECONDS'], httponly=True)
+            return response
+
+    def engines(self):
+        """Engines for the configured replicas, rebuilt if the configured list changes"""
+        uris = list(self.app.config.get('SQLALCHEMY_REPLICA_URIS') or [])
+        with self._lock:
+            if uris != self._uris:
+                self._dispose_locked()
+                options = dict(self.app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+                self._engines = [create_engine(uri, **options) for uri in uris]
+                for engine in self._engines:
+                    event.listen(engine, 'handle_error', self._on_error)
+                self._uris = uris
+            return list(self._engines)
+
+    def dispose(self):
+        """Close every replica connection, e.g. in a freshly forked worker"""
+        with self._lock:
+            for engine in self._engines or []:
+                engine.dispose()
+
+    def _dispose_locked(self):
+        for engine in self._engines or []:
+            engine.dispose()
+        self._engines = []
+        self._down_until.clear()
+        self._up.clear()
+
+    def _on_error(self, context):
+        if context.is_disconnect and context.engine is not None:
+            self.mark_down(context.engine)
+
+    def mark_down(self, engine, seconds=None):
+        with self._lock:
+            self._down_until[engine] = time.time() + (seconds or self.retry_seconds)
+            self._up.discard(engine)
+
+    def available(self, engine):
+        """Whether a replica passed its last probe and isn't being skipped"""
+        return engine in self._up and self._down_until.get(engine, 0) <= time.time()
+
+    def probe(self):
+        """Health check every replica now, with a SELECT 1"""
+        for engine in self.engines():
+            try:
+                connection = engine.connect()
+                try:
+                    connection.execute('SELECT 1')
+                finally:
+                    connection.close()
+            except Exception:
+                if engine in self._up or engine not in self._down_until:
+                    self.app.logger.warning('Replica %s failed its health check, reading from elsewhere', engine.url)
+                self.mark_down(engine)
+                continue
+            with self._lock:
+                self._up.add(engine)
+
+    def _probe_forever(self, stopped):
+        while not stopped.is_set():
+            try:
+                self.probe()
+            except Exception:
+                self.app.logger.exception('Probing the replicas failed')
+            if stopped.wait(self.app.config['REPLICA_HEALTH_INTERVAL']):
+                return
+            with self._lock:
+                if not self._engines:
+                    self._prober = None
+                    return
+
+    def _start_prober(self):
+        """Probe in the background, one thread per process (a forked worker starts its own)"""
+        with self._lock:
+            if self._prober is not None and self._prober[0] == os.getpid():
+                return
+            stopped = threading.Event()
+            thread = threading.Thread(target=self._probe_forever, args=(stopped,), name='replica-health',
+                                      daemon=True)
+            self._prober = (os.getpid(), thread, stopped)
+        thread.start()
+
+    def stop(self):
+        """Stop this process's background prober and wait for it, the next pick() starts a new one"""
+        with self._lock:
+            prober = self._prober if self._prober is not None and self._prober[0] == os.getpid() else None
+            if prober is not None:
+                self._prober = None
+        if prober is not None:
+            prober[2].set()
+            prober[1].join()
+
+    def pick(self):
+        """Next available replica in round-robin order, or None to use the primary"""
+        engines = self.engines()
+        if not engines:
+            return None
+        picked = None
+        for _ in range(len(engines)):
+            engine = engines[next(self._counter) % len(engines)]
+            if self.available(engine):
+                picked = engine
+                break
+        self._start_prober()
+        return picked
+
+    def metric_families(self):
+        """Replica health in the shape app.instrumentation.Metrics.add_source expects"""
+        with self._lock:
+            samples = [((('replica', repr(engine.url)),), int(self.available(engine)))
+                       for engine in self._engines or []]
+        return [('api_replica_healthy', 'gauge', 'Whether a read replica is taking reads', samples)]
+
+
+# each app's ReplicaRouter, see app/extensions.py
+router = PerApp('replicas', ReplicaRouter)
+
+
+def reads_from_replica():
+    """True while handling a read request that doesn't need to see its own writes"""
+    if not has_request_context() or request.method not in READ_METHODS or g.get('use_primary'):
+        return False
+    if request.headers.get('X-Read-Your-Writes'):
+        return False
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) < time.time()
+    except ValueError:
+        return True
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not self.new and not self.dirty and not self.deleted \
+                and self.app.config.get('SQLALCHEMY_REPLICA_URIS') and reads_from_replica():
+            # one replica per request, so its queries read one snapshot
+            replicas = router.for_app(self.app)
+            if 'replica' not in g:
+                g.replica = replicas.pick()
+            if g.replica is not None and replicas.available(g.replica):
+                return g.replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,348 @@
+"""
+Ranked name search over products and customers, for /api/products/search and
+/api/customers/search. Queries of three or more characters match anywhere in
+the name (case-insensitively), shorter ones match the start of it. Each
+database gets the index it is good at, picked by SEARCH_BACKEND=auto:
+
+- trigram (Postgres): a GiST pg_trgm index on lower(name). Matches are found
+  with LIKE and ranked by trigram distance, which the index returns in order,
+  so a page costs the same however many names match
+- fts5 (SQLite): an external content FTS5 table with the trigram tokenizer,
+  kept in step with the base table by triggers
+- memory: an in-process n-gram index (trigram postings plus a sorted name
+  list for prefixes), loaded on first use and kept in sync through the session
+  events, for databases with neither
+
+Trigrams can't match fewer than three characters, so short queries walk a
+btree on lower(name) from the prefix instead, in name order, on every backend.
+
+The fts5 and memory backends rank exact matches first, then prefix matches, then
+the rest, shorter names first within each. Ties go to the lowest id. To keep a
+page's cost flat however common the query is, they rank at most MAX_CANDIDATES
+prefix matches (in name order) and MAX_CANDIDATES other matches (in whatever
+order the index yields them), so past that many matches the ranking is of a
+sample, though exact and prefix matches are always among it
+"""
+import threading
+from bisect import bisect_left, insort
+from heapq import nsmallest
+from itertools import chain
+from flask import request, url_for
+from sqlalchemy import DDL, event, func, select, text
+from sqlalchemy.orm import Session
+from app import db
+from app import formats
+from app.models import Customer, Product
+
+BACKENDS = ('trigram', 'fts5', 'memory')
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+# deeper pages cost the offset in skipped rows, nobody reads past the first few
+MAX_OFFSET = 1000
+GRAM = 3
+LOAD_CHUNK = 50000
+# matches ranked per query and match kind, at least as many as the deepest page reaches
+MAX_CANDIDATES = 2000
+
+MODELS = {'products': Product, 'customers': Customer}
+
+
+def _postgres_ddl(table):
+    return [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE INDEX IF NOT EXISTS ix_{0}_name_trgm ON {0} USING gist (lower(name) gist_trgm_ops)'.format(table),
+        # byte order, so short prefixes are a range scan that comes out sorted
+        'CREATE INDEX IF NOT EXISTS ix_{0}_name_prefix ON {0} (lower(name) COLLATE "C", id)'.format(table),
+    ]
+
+
+def _sqlite_ddl(table):
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {0}_search USING fts5(name, content='{0}', content_rowid='id', "
+        "tokenize='trigram')",
+        'CREATE INDEX IF NOT EXISTS ix_{0}_name_lower ON {0} (lower(name))',
+        'CREATE TRIGGER IF NOT EXISTS {0}_search_insert AFTER INSERT ON {0} BEGIN '
+        'INSERT INTO {0}_search (rowid, name) VALUES (new.id, new.name); END',
+        'CREATE TRIGGER IF NOT EXISTS {0}_search_delete AFTER DELETE ON {0} BEGIN '
+        "INSERT INTO {0}_search ({0}_search, rowid, name) VALUES ('delete', old.id, old.name); END",
+        'CREATE TRIGGER IF NOT EXISTS {0}_search_update AFTER UPDATE OF id, name ON {0} BEGIN '
+        "INSERT INTO {0}_search ({0}_search, rowid, name) VALUES ('delete', old.id, old.name); "
+        'INSERT INTO {0}_search (rowid, name) VALUES (new.id, new.name); END',
+        # picks up rows that were there before the table was
+        "INSERT INTO {0}_search ({0}_search) VALUES ('rebuild')",
+    ]
+    return [statement.format(table) for statement in statements]
+
+
+def fts5_available(connection):
+    """True if this SQLite build has FTS5 and the trigram tokenizer (3.34+)"""
+    if connection.dialect.name != 'sqlite':
+        return False
+    options = set(row[0] for row in connection.execute('PRAGMA compile_options'))
+    return 'ENABLE_FTS5' in options and connection.dialect.dbapi.sqlite_version_info >= (3, 34, 0)
+
+
+def _sqlite_with_fts5(ddl, target, bind, **kw):
+    return fts5_available(bind)
+
+
+for _name, _model in MODELS.items():
+    for _statement in _postgres_ddl(_name):
+        event.listen(_model.__table__, 'after_create', DDL(_statement).execute_if(dialect='postgresql'))
+    for _statement in _sqlite_ddl(_name):
+        event.listen(_model.__table__, 'after_create', DDL(_statement).execute_if(
+            callable_=_sqlite_with_fts5))
+    # the FTS table isn't in the metadata, so drop_all() would leave it behind with stale rowids
+    event.listen(_model.__table__, 'before_drop',
+                 DDL('DROP TABLE IF EXISTS {}_search'.format(_name)).execute_if(dialect='sqlite'))
+
+
+# database url -> fts5_available(), checked once per database
+_fts5 = {}
+
+
+def backend(app):
+    """The search backend SEARCH_BACKEND names, or the best one for the database when it is 'auto'"""
+    chosen = app.config.get('SEARCH_BACKEND') or 'auto'
+    if chosen != 'auto':
+        return chosen
+    engine = db.get_engine(app)
+    if engine.dialect.name == 'postgresql':
+        return 'trigram'
+    if engine.dialect.name == 'sqlite':
+        found = _fts5.get(str(engine.url))
+        if found is None:
+            with engine.connect() as connection:
+                found = _fts5[str(engine.url)] = fts5_available(connection)
+        if found:
+            return 'fts5'
+    return 'memory'
+
+
+def grams(name):
+    return set(name[i:i + GRAM] for i in range(len(name) - GRAM + 1))
+
+
+def _rank(name, query, row_id):
+    """Sort key shared by the fts5 and memory backends: exact, prefix, substring; then shorter; then id"""
+    return (0 if name == query else 1 if name.startswith(query) else 2, len(name), row_id)
+
+
+class NameIndex(object):
+    """Trigram postings and a sorted (lower name, id) list over one table's names"""
+
+    def __init__(self, table):
+        self.table = table
+        self._lock = threading.Lock()
+        self.stale = True
+        self.names = {}
+        self.ordered = []
+        self.postings = {}
+
+    def reset(self):
+        """Forget everything, the next search reloads the names"""
+        with self._lock:
+            self.stale = True
+
+    def _add(self, row_id, name):
+        lower = name.lower()
+        self.names[row_id] = name
+        insort(self.ordered, (lower, row_id))
+        for gram in grams(lower):
+            self.postings.setdefault(gram, set()).add(row_id)
+
+    def _discard(self, row_id):
+        name = self.names.pop(row_id, None)
+        if name is None:
+            return
+        lower = name.lower()
+        del self.ordered[bisect_left(self.ordered, (lower, row_id))]
+        for gram in grams(lower):
+            ids = self.postings[gram]
+            ids.discard(row_id)
+            if not ids:
+                del self.postings[gram]
+
+    def load(self):
+        """(Re)build from the database if stale"""
+        with self._lock:
+            if not self.stale:
+                return
+            table = MODELS[self.table].__table__
+            self.names, self.postings = {}, {}
+            result = db.session.connection().execution_options(stream_results=True).execute(
+                select([table.c.id, table.c.name]))
+            while True:
+                rows = result.fetchmany(LOAD_CHUNK)
+                if not rows:
+                    break
+                for row_id, name in rows:
+                    self.names[row_id] = name
+                    for gram in grams(name.lower()):
+                        self.postings.setdefault(gram, set()).add(row_id)
+            self.ordered = sorted((name.lower(), row_id) for row_id, name in self.names.items())
+            self.stale = False
+
+    def apply(self, changes):
+        """Apply committed (id, name) changes, a name of None meaning the row was deleted"""
+        with self._lock:
+            if self.stale:
+                return
+            for row_id, name in changes:
+                self._discard(row_id)
+                if name is not None:
+                    self._add(row_id, name)
+
+    def search(self, query, limit, offset):
+        self.load()
+        query = query.lower()
+        with self._lock:
+            if len(query) < GRAM:
+                start = bisect_left(self.ordered, (query,)) + offset
+                rows = []
+                for lower, row_id in self.ordered[start:start + limit]:
+                    if not lower.startswith(query):
+                        break
+                    rows.append((row_id, self.names[row_id]))
+                return rows
+            # exact and prefix matches come from the sorted names, so the cap below never crowds them out
+            start = bisect_left(self.ordered, (query,))
+            candidates = {}
+            for lower, row_id in self.ordered[start:start + MAX_CANDIDATES]:
+                if not lower.startswith(query):
+                    break
+                candidates[row_id] = lower
+            postings = sorted((self.postings.get(gram, set()) for gram in grams(query)), key=len)
+            found = 0
+            for row_id in postings[0]:
+                if found >= MAX_CANDIDATES:
+                    break
+                lower = self.names[row_id].lower()
+                if row_id not in candidates and all(row_id in ids for ids in postings[1:]) and query in lower:
+                    candidates[row_id] = lower
+                    found += 1
+            best = nsmallest(offset + limit, (_rank(lower, query, row_id) for row_id, lower in candidates.items()))
+            return [(row_id, self.names[row_id]) for _, _, row_id in best[offset:]]
+
+
+indexes = {table: NameIndex(table) for table in MODELS}
+
+
+def reset():
+    """Mark the in-memory indexes stale, for writes that went around the ORM"""
+    for index in indexes.values():
+        index.reset()
+
+
+def _escape_like(query):
+    return query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _search_prefix(table, query, limit, offset, collation=''):
+    """Names starting with query, walking the lower(name) index in order"""
+    end = query[:-1] + chr(ord(query[-1]) + 1)
+    return db.session.execute(text(
+        'SELECT id, name FROM {0} WHERE lower(name){1} >= :start AND lower(name){1} < :end '
+        'ORDER BY lower(name){1}, id LIMIT :limit OFFSET :offset'.format(table, collation)),
+        {'start': query, 'end': end, 'limit': limit, 'offset': offset}).fetchall()
+
+
+def _search_trigram(table, query, limit, offset):
+    if len(query) < GRAM:
+        # too short for trigrams to narrow anything down
+        return _search_prefix(table, query, limit, offset, ' COLLATE "C"')
+    source = MODELS[table].__table__
+    lower = func.lower(source.c.name)
+    return db.session.execute(
+        select([source.c.id, source.c.name])
+        .where(lower.like('%' + _escape_like(query) + '%'))
+        .order_by(lower.op('<->')(query), source.c.id)
+        .limit(limit).offset(offset)).fetchall()
+
+
+def _search_fts5(table, query, limit, offset):
+    if len(query) < GRAM:
+        # the trigram tokenizer can't match under three characters
+        return _search_prefix(table, query, limit, offset)
+    end = query[:-1] + chr(ord(query[-1]) + 1)
+    return db.session.execute(text(
+        'SELECT id, name FROM ('
+        'SELECT * FROM (SELECT id, name FROM {0} WHERE lower(name) >= :start AND lower(name) < :end '
+        'ORDER BY lower(name), id LIMIT :candidates) '
+        'UNION SELECT * FROM (SELECT {0}.id, {0}.name FROM {0}_search JOIN {0} ON {0}.id = {0}_search.rowid '
+        'WHERE {0}_search MATCH :phrase LIMIT :candidates)) '
+        'ORDER BY CASE WHEN lower(name) = :query THEN 0 WHEN instr(lower(name), :query) = 1 THEN 1 '
+        'ELSE 2 END, length(name), id LIMIT :limit OFFSET :offset'.format(table)),
+        {'phrase': '"{}"'.format(query.replace('"', '""')), 'query': query, 'start': query, 'end': end,
+         'candidates': MAX_CANDIDATES, 'limit': limit, 'offset': offset}).fetchall()
+
+
+def search(app, table, query, limit=DEFAULT_LIMIT, offset=0):
+    """[(id, name), ...] of the 'table' rows whose name matches query, best first"""
+    query = query.lower()
+    chosen = backend(app)
+    if chosen == 'trigram':
+        return _search_trigram(table, query, limit, offset)
+    if chosen == 'fts5':
+        return _search_fts5(table, query, limit, offset)
+    if chosen == 'memory':
+        return indexes[table].search(query, limit, offset)
+    raise ValueError('Unknown SEARCH_BACKEND {}, choose from: auto, {}.'.format(chosen, ', '.join(BACKENDS)))
+
+
+def search_args():
+    """
+    Read q, limit and offset from the query string, raises ValueError with a
+    user facing message if any of them are missing or malformed
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        raise ValueError('Missing search query, pass ?q=.')
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        raise ValueError('Invalid search parameters, limit and offset must be integers.')
+    if limit < 1 or offset < 0:
+        raise ValueError('Invalid search parameters, limit must be at least 1 and offset at least 0.')
+    if offset > MAX_OFFSET:
+        raise ValueError('Invalid search parameters, offset can be at most {}.'.format(MAX_OFFSET))
+    return query, min(limit, MAX_LIMIT), offset
+
+
+def search_response(app, table, query, limit, offset):
+    """One page of results in the {results, next} envelope of the paged listings"""
+    rows = search(app, table, query, limit + 1, offset)
+    results = [{'id': row_id, 'name': name} for row_id, name in rows[:limit]]
+    next_url = None
+    if len(rows) > limit and offset + limit <= MAX_OFFSET:
+        args = request.args.to_dict()
+        args.update(limit=limit, offset=offset + limit)
+        next_url = url_for(request.endpoint, **args)
+    response = formats.respond({'results': formats.shape(results, None), 'next': next_url})
+    if next_url:
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    return response
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_names(session, flush_context):
+    changes = session.info.setdefault('search_changes', [])
+    for obj in chain(session.new, session.dirty, session.deleted):
+        table = getattr(obj, '__tablename__', None)
+        if table in MODELS:
+            changes.append((table, obj.id, None if obj in session.deleted else obj.name))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_after_commit(session):
+    by_table = {}
+    for table, row_id, name in session.info.pop('search_changes', ()):
+        by_table.setdefault(table, []).append((row_id, name))
+    for table, changes in by_table.items():
+        indexes[table].apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_after_rollback(session):
+    session.info.pop('search_changes', None)
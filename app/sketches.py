@@ -0,0 +1,219 @@
+"""
+Per-day product sketches for approximate top-N queries over long date ranges
+(?top=N&approx=true). Each day of the daily_product_sales rollup is summarised
+in one daily_product_sketches row:
+
+- a Count-Min sketch (DEPTH rows of WIDTH counters) of quantity per product,
+  which never underestimates and overestimates by at most e / WIDTH of the
+  range's total quantity, except with probability e ** -DEPTH
+- the day's TOP_K best sellers with their quantities, and the threshold: the
+  most any product outside them sold that day
+
+Sketches merge by adding them up, so a range costs the same per day however
+many orders or products there are. A product's merged top-K quantity is a lower
+bound on what it sold. Adding the thresholds of the days it missed the top-K
+gives an upper bound, and the Count-Min estimate gives another.
+
+app/rollups.py hands every change it makes to a day to update(), which adds it
+to that day's counters and top-K in place, under the rollup's per-day lock. It
+does not recompute the day. A product that leaves the top-K raises the threshold
+to what it sold, and thresholds never go down, so the bounds stay valid but
+loosen as a day keeps changing. rebuild() (python manage.py rebuild_rollups)
+makes them tight again
+"""
+import array
+import json
+import math
+import sys
+from sqlalchemy import bindparam, select
+from app import db
+from app.aggregates import as_day
+from app.models import Product, DailyProductSales, DailyProductSketch
+
+TOP_K = 64
+WIDTH = 256
+DEPTH = 4
+# (a, b) of each row's hash, ((a * product id + b) mod PRIME) mod WIDTH
+PRIME = 2 ** 61 - 1
+HASHES = [(0x5bd1e995, 0x1b873593), (0x27d4eb2f, 0x165667b1), (0x61c88647, 0x3c6ef372), (0x7feb352d, 0x846ca68b)]
+INSERT_CHUNK = 1000
+
+rollup = DailyProductSales.__table__
+sketches = DailyProductSketch.__table__
+
+
+def _cells(product_id):
+    return [row * WIDTH + (a * product_id + b) % PRIME % WIDTH for row, (a, b) in enumerate(HASHES[:DEPTH])]
+
+
+def _pack(counts):
+    packed = array.array('I', counts)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack(data):
+    counts = array.array('I')
+    counts.frombytes(data)
+    if sys.byteorder == 'big':
+        counts.byteswap()
+    return counts
+
+
+def sketch(day, quantities):
+    """The daily_product_sketches row of one day, given its {product id: quantity}"""
+    counts = [0] * (WIDTH * DEPTH)
+    for product_id, quantity in quantities.items():
+        for cell in _cells(product_id):
+            counts[cell] += quantity
+    ranked = sorted(quantities.items(), key=lambda item: (-item[1], item[0]))
+    return {
+        'date': day,
+        'total': sum(quantities.values()),
+        'threshold': ranked[TOP_K][1] if len(ranked) > TOP_K else 0,
+        'top': json.dumps([[product_id, quantity] for product_id, quantity in ranked[:TOP_K]]),
+        'counts': _pack(counts),
+    }
+
+
+def _write(connection, days, target=sketches):
+    """Insert the sketch rows of {date: {product id: quantity}}"""
+    rows = [sketch(day, quantities) for day, quantities in sorted(days.items()) if quantities]
+    for start in range(0, len(rows), INSERT_CHUNK):
+        connection.execute(target.insert(), rows[start:start + INSERT_CHUNK])
+
+
+def refresh(connection, dates):
+    """Recompute the sketches of the given days from the rollup"""
+    dates = sorted(set(dates))
+    if not dates:
+        return
+    days = {day: {} for day in dates}
+    for day, product_id, quantity in connection.execute(
+            select([rollup.c.date, rollup.c.product_id, rollup.c.quantity]).where(rollup.c.date.in_(dates))):
+        days[day][product_id] = quantity
+    connection.execute(sketches.delete().where(sketches.c.date.in_(dates)))
+    _write(connection, days)
+
+
+def update(connection, days):
+    """
+    Apply rollup changes, {date: {product id: (old quantity, new quantity)}}, to
+    the sketches of those days. Days without a sketch get one computed from the rollup
+    """
+    days = dict((day, changed) for day, changed in days.items() if changed)
+    if not days:
+        return
+    query = select([sketches]).where(sketches.c.date.in_(sorted(days)))
+    if connection.dialect.name == 'postgresql':
+        query = query.with_for_update()
+    stored = {row['date']: row for row in connection.execute(query)}
+    updates, emptied = [], []
+    for day, changed in sorted(days.items()):
+        row = stored.get(day)
+        if row is None:
+            continue
+        counts = _unpack(row['counts'])
+        top = dict(json.loads(row['top']))
+        total = row['total']
+        for product_id, (old, new) in changed.items():
+            for cell in _cells(product_id):
+                counts[cell] += new - old
+            total += new - old
+            if new:
+                top[product_id] = new
+            else:
+                top.pop(product_id, None)
+        if not total:
+            emptied.append(day)
+            continue
+        ranked = sorted(top.items(), key=lambda item: (-item[1], item[0]))
+        # the first product cut from the top-K sold the most of those outside it
+        threshold = max(row['threshold'], ranked[TOP_K][1]) if len(ranked) > TOP_K else row['threshold']
+        updates.append({'key': day, 'total': total, 'threshold': threshold,
+                        'top': json.dumps([[product_id, quantity] for product_id, quantity in ranked[:TOP_K]]),
+                        'counts': _pack(counts)})
+    if updates:
+        connection.execute(sketches.update().where(sketches.c.date == bindparam('key')), updates)
+    if emptied:
+        connection.execute(sketches.delete().where(sketches.c.date.in_(emptied)))
+    refresh(connection, set(days) - set(stored))
+
+
+def fill(connection, source=rollup, target=sketches):
+    """
+    Sketch every day of the rollup into an empty sketch table. The migration that
+    creates the table passes its own table objects, so it doesn't depend on the models
+    """
+    days = {}
+    result = connection.execute(
+        select([source.c.date, source.c.product_id, source.c.quantity]).order_by(source.c.date))
+    for day, product_id, quantity in result:
+        if days and day not in days:
+            # the rows come in date order, so every earlier day is complete
+            _write(connection, days, target)
+            days = {}
+        days.setdefault(day, {})[product_id] = quantity
+    _write(connection, days, target)
+
+
+def rebuild(connection):
+    """Throw away every sketch and recompute them all from the rollup"""
+    connection.execute(sketches.delete())
+    fill(connection)
+
+
+def error_bound(total):
+    """Most the Count-Min estimates can overestimate by over a range selling 'total', and how likely that holds"""
+    return int(math.ceil(math.e / WIDTH * total)), 1 - math.exp(-DEPTH)
+
+
+def merge(start_date, end_date):
+    """
+    Merge the daily sketches between two dates: ([(product id, (lower bound, upper
+    bound)), ...] of every product in some day's top-K, best first, total quantity,
+    summed thresholds, days merged)
+    """
+    counts = [0] * (WIDTH * DEPTH)
+    lower, seen_thresholds = {}, {}
+    total = thresholds = days = 0
+    for day_total, threshold, top, day_counts in db.session.query(
+            DailyProductSketch.total, DailyProductSketch.threshold, DailyProductSketch.top,
+            DailyProductSketch.counts) \
+            .filter(DailyProductSketch.date.between(as_day(start_date), as_day(end_date))):
+        days += 1
+        total += day_total
+        thresholds += threshold
+        for product_id, quantity in json.loads(top):
+            lower[product_id] = lower.get(product_id, 0) + quantity
+            seen_thresholds[product_id] = seen_thresholds.get(product_id, 0) + threshold
+        counts = [count + added for count, added in zip(counts, _unpack(day_counts))]
+    bounds = {}
+    for product_id, quantity in lower.items():
+        # it sold at most the threshold on the days it missed the top-K, and never more than Count-Min says
+        upper = min(quantity + thresholds - seen_thresholds[product_id],
+                    min(counts[cell] for cell in _cells(product_id)))
+        bounds[product_id] = (quantity, upper)
+    ranked = sorted(bounds.items(), key=lambda item: (-item[1][1], -item[1][0], item[0]))
+    return ranked, total, thresholds, days
+
+
+def top_products(start_date, end_date, limit):
+    """
+    The 'limit' best selling products between two dates, as rows of product id,
+    name, quantity (an estimate that is never below what it sold), lower and upper
+    bounds and whether it is certainly in the top, plus the range's error bounds
+    """
+    if limit > TOP_K:
+        raise ValueError('Invalid top, approximate results go up to {} products.'.format(TOP_K))
+    ranked, total, thresholds, days = merge(start_date, end_date)
+    names = dict(db.session.query(Product.id, Product.name).filter(Product.id.in_([row[0] for row in ranked[:limit]])))
+    # the most anything ranked below the cut (or never in a daily top-K) can have sold
+    below = max([upper for _, (_, upper) in ranked[limit:]] + [thresholds])
+    rows = [{'product_id': product_id, 'product': names.get(product_id), 'quantity': upper, 'lower': lower,
+             'upper': upper, 'guaranteed': lower >= below}
+            for product_id, (lower, upper) in ranked[:limit]]
+    bound, confidence = error_bound(total)
+    return rows, {'days': days, 'total_quantity': total,
+                  'error_bounds': {'count_min': bound, 'confidence': round(confidence, 4), 'unseen_max': thresholds}}
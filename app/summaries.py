@@ -0,0 +1,258 @@
+"""
+Keeps customer_summaries (order count, lifetime quantity, last order date and
+orders per status of every customer) in step with orders and order_items, so
+a customer's summary is one primary key lookup instead of a pass over their
+whole history.
+
+Every flush turns its new orders and items, status changes and item quantity
+changes into per-customer deltas and applies them to the summary rows inside
+the same transaction. Changes a delta can't express (deleting an order, moving
+it to another customer or date, or a customer with no summary row yet) recompute
+that customer's row from their orders instead. On Postgres, writers of the same
+customer's row take turns (see _lock()). rebuild() and reconcile() cover
+everything else, see manage.py
+"""
+import datetime
+import json
+from itertools import chain
+from sqlalchemy import bindparam, event, func, select, text
+from sqlalchemy.orm import Session, attributes
+from app.models import Customer, Order, OrderItem, CustomerSummary
+
+summaries = CustomerSummary.__table__
+customers = Customer.__table__
+orders = Order.__table__
+order_items = OrderItem.__table__
+
+INSERT_CHUNK = 5000
+# pg_advisory_xact_lock(LOCK_KEY, customer id) serialises the writers of one summary row, see _lock()
+LOCK_KEY = 72210253
+
+
+def _as_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+def _history(obj, key):
+    """(previous values, current values) of an attribute in this flush"""
+    history = attributes.get_history(obj, key)
+    return list(history.deleted), list(history.added or history.unchanged)
+
+
+def _delta(deltas, customer_id):
+    return deltas.setdefault(customer_id, {'orders': 0, 'quantity': 0, 'last_order_date': None, 'statuses': {}})
+
+
+def _count(statuses, status, change):
+    statuses[status] = statuses.get(status, 0) + change
+
+
+def _add_order(deltas, customer_id, status, date):
+    delta = _delta(deltas, customer_id)
+    delta['orders'] += 1
+    _count(delta['statuses'], status, 1)
+    date = _as_date(date)
+    if delta['last_order_date'] is None or date > delta['last_order_date']:
+        delta['last_order_date'] = date
+
+
+def _lock(connection, customer_ids):
+    """
+    On Postgres, let one transaction at a time rewrite a customer's row, so two
+    writers of a customer without one can't both insert it. Taken in id order so
+    writers of several customers can't deadlock on each other
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    for customer_id in sorted(customer_ids):
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key, :customer)'), key=LOCK_KEY, customer=customer_id)
+
+
+def _only(query, column, customer_ids):
+    return query if customer_ids is None else query.where(column.in_(sorted(customer_ids)))
+
+
+def _compute(connection, customer_ids=None):
+    """{customer id: summary row} recomputed from orders, for the given customers or all of them"""
+    rows = {}
+    for customer_id, in connection.execute(_only(select([customers.c.id]), customers.c.id, customer_ids)):
+        rows[customer_id] = {'customer_id': customer_id, 'order_count': 0, 'total_quantity': 0,
+                             'last_order_date': None, 'status_counts': {}}
+    statuses = select([orders.c.customer_id, orders.c.status, func.count(), func.max(orders.c.date)]) \
+        .group_by(orders.c.customer_id, orders.c.status)
+    for customer_id, status, count, last in connection.execute(_only(statuses, orders.c.customer_id, customer_ids)):
+        row = rows.get(customer_id)
+        if row is not None:
+            row['order_count'] += count
+            row['status_counts'][status] = count
+            last = _as_date(last)
+            if row['last_order_date'] is None or last > row['last_order_date']:
+                row['last_order_date'] = last
+    quantities = select([orders.c.customer_id, func.sum(order_items.c.quantity)]) \
+        .select_from(order_items.join(orders, orders.c.id == order_items.c.order_id)) \
+        .group_by(orders.c.customer_id)
+    for customer_id, quantity in connection.execute(_only(quantities, orders.c.customer_id, customer_ids)):
+        if customer_id in rows:
+            rows[customer_id]['total_quantity'] = int(quantity or 0)
+    return rows
+
+
+def _stored(row):
+    return dict(row, status_counts=json.dumps(row['status_counts'], sort_keys=True))
+
+
+def _insert(connection, rows):
+    rows = [_stored(row) for row in rows]
+    for start in range(0, len(rows), INSERT_CHUNK):
+        connection.execute(summaries.insert(), rows[start:start + INSERT_CHUNK])
+
+
+def refresh(connection, customer_ids):
+    """Recompute the summary rows of the given customers from their orders"""
+    customer_ids = set(customer_ids)
+    if not customer_ids:
+        return
+    _lock(connection, customer_ids)
+    connection.execute(summaries.delete().where(summaries.c.customer_id.in_(sorted(customer_ids))))
+    _insert(connection, _compute(connection, customer_ids).values())
+
+
+def rebuild(connection):
+    """Throw away every summary row and recompute them all"""
+    connection.execute(summaries.delete())
+    _insert(connection, _compute(connection).values())
+
+
+def reconcile(connection, fix=True):
+    """
+    Compare every summary row with one recomputed from the orders and return the
+    ids of the customers that differ, recomputing their rows if 'fix'
+    """
+    expected = _compute(connection)
+    stored = {row['customer_id']: dict(row, status_counts=json.loads(row['status_counts']))
+              for row in connection.execute(select([summaries]))}
+    wrong = sorted(customer_id for customer_id in set(expected) | set(stored)
+                   if expected.get(customer_id) != stored.get(customer_id))
+    if fix and wrong:
+        _lock(connection, wrong)
+        connection.execute(summaries.delete().where(summaries.c.customer_id.in_(wrong)))
+        _insert(connection, [expected[customer_id] for customer_id in wrong if customer_id in expected])
+    return wrong
+
+
+def apply(connection, deltas):
+    """
+    Add per-customer deltas ({customer id: {orders, quantity, last_order_date,
+    statuses}}) to their summary rows. Customers without a row get theirs recomputed
+    """
+    if not deltas:
+        return
+    _lock(connection, deltas)
+    query = select([summaries]).where(summaries.c.customer_id.in_(sorted(deltas)))
+    if connection.dialect.name == 'postgresql':
+        query = query.with_for_update()
+    current = {row['customer_id']: row for row in connection.execute(query)}
+    updates = []
+    for customer_id, delta in deltas.items():
+        row = current.get(customer_id)
+        if row is None:
+            continue
+        statuses = json.loads(row['status_counts'])
+        for status, change in delta['statuses'].items():
+            _count(statuses, status, change)
+        last = row['last_order_date']
+        if delta['last_order_date'] is not None and (last is None or delta['last_order_date'] > _as_date(last)):
+            last = delta['last_order_date']
+        updates.append({
+            'key': customer_id,
+            'order_count': row['order_count'] + delta['orders'],
+            'total_quantity': row['total_quantity'] + delta['quantity'],
+            'last_order_date': last,
+            'status_counts': json.dumps({status: count for status, count in statuses.items() if count},
+                                        sort_keys=True),
+        })
+    if updates:
+        connection.execute(summaries.update().where(summaries.c.customer_id == bindparam('key')), updates)
+    refresh(connection, set(deltas) - set(current))
+
+
+def bulk_deltas(order_rows, item_rows):
+    """Deltas for rows written with Core inserts, given as the dicts passed to insert()"""
+    deltas = {}
+    owners = {}
+    for row in order_rows:
+        _add_order(deltas, row['customer_id'], row['status'], row['date'])
+        owners[row['id']] = row['customer_id']
+    for row in item_rows:
+        _delta(deltas, owners[row['order_id']])['quantity'] += row['quantity']
+    return deltas
+
+
+@event.listens_for(Session, 'before_flush')
+def _drop_deleted_customers(session, flush_context, instances):
+    """A customer's summary row has to go before the customer does, or the foreign key stops the delete"""
+    gone = [obj.id for obj in session.deleted if isinstance(obj, Customer) and obj.id is not None]
+    if gone:
+        session.connection().execute(summaries.delete().where(summaries.c.customer_id.in_(gone)))
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_after_flush(session, flush_context):
+    deltas, recompute, item_changes = {}, set(), []
+    for obj in session.new:
+        if isinstance(obj, Customer):
+            recompute.add(obj.id)
+        elif isinstance(obj, Order):
+            _add_order(deltas, obj.customer_id, obj.status, obj.date)
+        elif isinstance(obj, OrderItem):
+            item_changes.append((obj.order_id, obj.quantity))
+    for obj in session.dirty:
+        if isinstance(obj, Order):
+            old_customers, new_customers = _history(obj, 'customer_id')
+            old_dates, _ = _history(obj, 'date')
+            if old_customers or old_dates:
+                recompute.update(chain(old_customers, new_customers))
+                continue
+            old_statuses, new_statuses = _history(obj, 'status')
+            if old_statuses:
+                delta = _delta(deltas, obj.customer_id)
+                for status in old_statuses:
+                    _count(delta['statuses'], status, -1)
+                for status in new_statuses:
+                    _count(delta['statuses'], status, 1)
+        elif isinstance(obj, OrderItem):
+            old_orders, new_orders = _history(obj, 'order_id')
+            old_quantities, new_quantities = _history(obj, 'quantity')
+            if old_orders or old_quantities:
+                for order_id in old_orders or new_orders:
+                    item_changes.extend((order_id, -quantity) for quantity in old_quantities or new_quantities)
+                for order_id in new_orders:
+                    item_changes.extend((order_id, quantity) for quantity in new_quantities)
+    for obj in session.deleted:
+        if isinstance(obj, Order):
+            recompute.update(chain(*_history(obj, 'customer_id')))
+        elif isinstance(obj, OrderItem):
+            old_orders, current_orders = _history(obj, 'order_id')
+            old_quantities, current_quantities = _history(obj, 'quantity')
+            for order_id in old_orders or current_orders:
+                item_changes.extend((order_id, -quantity) for quantity in old_quantities or current_quantities)
+        elif isinstance(obj, Customer):
+            recompute.discard(obj.id)
+            deltas.pop(obj.id, None)
+    if not deltas and not recompute and not item_changes:
+        return
+    connection = session.connection()
+    order_ids = sorted(set(order_id for order_id, _ in item_changes))
+    if order_ids:
+        # orders deleted in this flush aren't found, their customers are recomputed anyway
+        owners = dict(connection.execute(
+            select([orders.c.id, orders.c.customer_id]).where(orders.c.id.in_(order_ids))).fetchall())
+        for order_id, quantity in item_changes:
+            if order_id in owners:
+                _delta(deltas, owners[order_id])['quantity'] += quantity
+    for customer_id in recompute:
+        deltas.pop(customer_id, None)
+    apply(connection, deltas)
+    refresh(connection, recompute)
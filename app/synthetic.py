@@ -0,0 +1,176 @@
+"""
+Synthetic data generator for trying the API at production-like scale. Everything
+is drawn from a random.Random seeded by the caller, so the same arguments always
+produce the same rows. Shapes are loosely modelled on real order data:
+
+- product popularity (and customer activity) follows a Zipf distribution,
+  so a few products/customers account for most of the volume
+- order dates are seasonal, busier in December and at weekends
+- products belong to one to three categories
+
+Rows are written in batches with Core inserts (COPY on Postgres), never through
+the ORM, so tens of millions of rows load in minutes rather than hours
+"""
+import datetime
+import math
+import random
+from itertools import accumulate
+from sqlalchemy import func, select, text
+from app import db
+from app import rollups, search, summaries
+from app.cache import cache
+from app.ingest import copy_rows
+from app.models import Customer, Category, Product, Order, OrderItem, products_categories
+
+FIRST_NAMES = ['James', 'Jean', 'Jonathan', 'Kathryn', 'Benjamin', 'Nyota', 'Hikaru', 'Leonard', 'Beverly',
+               'Geordi', 'Deanna', 'Worf', 'Montgomery', 'Pavel', 'Christine', 'Tasha', 'Miles', 'Keiko']
+LAST_NAMES = ['Kirk', 'Picard', 'Archer', 'Janeway', 'Sisko', 'Uhura', 'Sulu', 'McCoy', 'Crusher',
+              'La Forge', 'Troi', 'Rozhenko', 'Scott', 'Chekov', 'Chapel', 'Yar', "O'Brien", 'Ishikawa']
+ADJECTIVES = ['small', 'large', 'organic', 'family size', 'travel', 'scented', 'unscented', 'bulk', 'deluxe']
+NOUNS = ['bleach', 'toilet paper', 'mop', 'bucket', 'hand soap', 'sponge', 'paper towels', 'detergent',
+         'trash bags', 'dish soap', 'glass cleaner', 'broom', 'light bulbs', 'batteries', 'coffee', 'rice']
+DEPARTMENTS = ['Cleaning', 'Chemicals', 'Household Supplies', 'Paper Goods', 'Kitchen', 'Laundry',
+               'Pantry', 'Beverages', 'Electronics', 'Personal Care', 'Outdoor', 'Pets']
+STATUSES = ['Waiting', 'In Transit', 'Delivered']
+
+BATCH_SIZE = 10000
+
+
+def zipf_weights(count, exponent):
+    """Cumulative Zipf weights for ranks 1..count, ready for Random.choices(cum_weights=...)"""
+    return list(accumulate(1.0 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def seasonal_weights(start, end):
+    """Cumulative weight of each day between start and end, with a December peak and busier weekends"""
+    days = (end - start).days + 1
+    weights = []
+    for offset in range(days):
+        day = start + datetime.timedelta(days=offset)
+        weight = 1.0 + 0.25 * math.sin(2 * math.pi * (day.timetuple().tm_yday - 80) / 365.25)
+        if day.month == 12:
+            weight *= 1.6
+        if day.weekday() >= 5:
+            weight *= 1.3
+        weights.append(weight)
+    return list(accumulate(weights))
+
+
+def _next_id(connection, table):
+    return connection.execute(select([func.coalesce(func.max(table.c.id), 0)])).scalar() + 1
+
+
+def _insert(connection, table, rows):
+    if not rows:
+        return
+    if connection.dialect.name == 'postgresql':
+        columns = list(rows[0].keys())
+        copy_rows(connection, table.name, columns,
+            [[row[column].isoformat() if isinstance(row[column], datetime.date) else row[column]
+              for column in columns] for row in rows])
+    else:
+        connection.execute(table.insert(), rows)
+
+
+def _sync_sequences(connection, tables):
+    """Rows were given explicit ids, so move the Postgres sequences past them"""
+    for table in tables:
+        connection.execute(text(
+            "SELECT setval(pg_get_serial_sequence('{0}', 'id'), (SELECT COALESCE(MAX(id), 0) + 1 FROM {0}), false)"
+            .format(table.name)))
+
+
+def generate(customers=1000, products=200, categories=12, orders=10000, seed=0,
+             start=datetime.date(2015, 1, 1), end=datetime.date(2018, 12, 31), batch_size=BATCH_SIZE):
+    """
+    Add the requested number of customers, products, categories and orders (with
+    one to several items each) to the database. New ids continue after the current
+    maximum of each table. Returns the number of rows written per table
+    """
+    rng = random.Random(seed)
+    counts = {'customers': customers, 'products': products, 'categories': categories, 'orders': orders,
+              'order_items': 0, 'products_categories': 0}
+    customer_table, category_table = Customer.__table__, Category.__table__
+    product_table, order_table, item_table = Product.__table__, Order.__table__, OrderItem.__table__
+    connection = db.engine.connect()
+    sqlite = connection.dialect.name == 'sqlite'
+    if sqlite:
+        # skip the fsyncs for the duration of the load, they dominate insert time
+        connection.execute('PRAGMA synchronous = OFF')
+    try:
+        with connection.begin():
+            first_customer = _next_id(connection, customer_table)
+            first_category = _next_id(connection, category_table)
+            first_product = _next_id(connection, product_table)
+            first_order = _next_id(connection, order_table)
+            first_item = _next_id(connection, item_table)
+
+            for offset in range(0, customers, batch_size):
+                _insert(connection, customer_table, [
+                    {'id': first_customer + n,
+                     'name': '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))}
+                    for n in range(offset, min(offset + batch_size, customers))])
+            _insert(connection, category_table, [
+                {'id': first_category + n,
+                 'name': DEPARTMENTS[n % len(DEPARTMENTS)] + ('' if n < len(DEPARTMENTS) else ' {}'.format(n))}
+                for n in range(categories)])
+
+            category_weights = zipf_weights(categories, 0.8) if categories else []
+            category_ids = list(range(first_category, first_category + categories))
+            for offset in range(0, products, batch_size):
+                product_rows, link_rows = [], []
+                for n in range(offset, min(offset + batch_size, products)):
+                    product_id = first_product + n
+                    product_rows.append({'id': product_id, 'name': '{} {} #{}'.format(
+                        rng.choice(ADJECTIVES), rng.choice(NOUNS), product_id)})
+                    if category_ids:
+                        wanted = min(rng.choices([1, 2, 3], weights=[6, 3, 1])[0], categories)
+                        chosen = set()
+                        while len(chosen) < wanted:
+                            chosen.add(rng.choices(category_ids, cum_weights=category_weights)[0])
+                        link_rows.extend({'product_id': product_id, 'category_id': category_id}
+                                         for category_id in sorted(chosen))
+                _insert(connection, product_table, product_rows)
+                _insert(connection, products_categories, link_rows)
+                counts['products_categories'] += len(link_rows)
+
+            product_ids = list(range(first_product, first_product + products))
+            product_weights = zipf_weights(products, 1.1)
+            customer_ids = list(range(first_customer, first_customer + customers))
+            customer_weights = zipf_weights(customers, 0.6)
+            day_weights = seasonal_weights(start, end)
+            days = list(range(len(day_weights)))
+            recent = end - datetime.timedelta(days=14)
+            item_id = first_item
+            for offset in range(0, orders if product_ids and customer_ids else 0, batch_size):
+                size = min(batch_size, orders - offset)
+                order_rows, item_rows = [], []
+                dates = rng.choices(days, cum_weights=day_weights, k=size)
+                buyers = rng.choices(customer_ids, cum_weights=customer_weights, k=size)
+                for n in range(size):
+                    order_id = first_order + offset + n
+                    date = start + datetime.timedelta(days=dates[n])
+                    status = rng.choice(STATUSES) if date >= recent else 'Delivered'
+                    order_rows.append({'id': order_id, 'status': status, 'date': date, 'customer_id': buyers[n]})
+                    line_count = 1 + min(int(rng.expovariate(0.5)), 19)
+                    for product_id in rng.choices(product_ids, cum_weights=product_weights, k=line_count):
+                        quantity = rng.choices([1, 2, 3, 4, 6, 12], weights=[50, 20, 10, 8, 7, 5])[0]
+                        item_rows.append({'id': item_id, 'quantity': quantity, 'product_id': product_id,
+                                          'order_id': order_id})
+                        item_id += 1
+                _insert(connection, order_table, order_rows)
+                _insert(connection, item_table, item_rows)
+                counts['order_items'] += len(item_rows)
+            if connection.dialect.name == 'postgresql':
+                _sync_sequences(connection, [customer_table, category_table, product_table, order_table, item_table])
+            if orders:
+                rollups.rebuild(connection)
+            if customers or orders:
+                summaries.rebuild(connection)
+    finally:
+        if sqlite:
+            connection.execute('PRAGMA synchronous = FULL')
+        connection.close()
+    cache.clear()
+    search.reset()
+    return counts
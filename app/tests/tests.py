@@ -1,7 +1,70 @@
-from app import app, db
-from app.models import Product, Category, Customer, Order, OrderItem
+from app import app, db, create_app
+from app.models import Product, Category, Customer, Order, OrderItem, DailyProductSales, CustomerSummary, OrderChange, \
+    DailyProductSketch
+from app import rollups, summaries, sketches, ingest, synthetic, instrumentation
+from app.routing import router
+from sqlalchemy import create_engine
+from app.cache import cache
+from app import formats, aggregates, analytics, serializers, exports, search
+from app.admission import admission
+import threading
 import unittest
-from flask import json
+import re
+import os
+import shutil
+import tempfile
+import time
+import datetime
+from flask import json, jsonify
+import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy.orm import subqueryload
+
+
+class QueryCounter(object):
+    """Count (and keep) the SQL statements sent to the database inside a with block"""
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self.callback)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, 'before_cursor_execute', self.callback)
+
+    def callback(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append((statement, parameters))
+
+
+class PostgresLocks(object):
+    """A connection that passes for Postgres and records the advisory locks taken on it instead of running them"""
+
+    dialect = type('dialect', (), {'name': 'postgresql'})()
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.locks = []
+
+    def execute(self, statement, *args, **kwargs):
+        if 'pg_advisory_xact_lock' in str(statement):
+            self.locks.append(tuple(kwargs.values()))
+            return None
+        return self.connection.execute(statement, *args, **kwargs)
+
+
+def full_table_scans(statement, parameters):
+    """Tables SQLite would read end to end to run the statement, per EXPLAIN QUERY PLAN"""
+    plan = db.engine.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+    scans = set()
+    for row in plan:
+        match = re.match(r'SCAN (\w+?)(_\d+)?( |$)', row[-1])
+        if match and not match.group(1).startswith('anon'):
+            scans.add(match.group(1))
+    return scans
 
 
 class TestApp(unittest.TestCase):
@@ -13,6 +76,13 @@ class TestApp(unittest.TestCase):
         app.config['SQLALCHEMY_DATABASE_URI']='sqlite:///testing.db'
         db.drop_all()
         db.create_all()
+        cache.clear()
+        analytics.store.reset()
+        search.reset()
+        app.config['ADMISSION_DIR'] = tempfile.mkdtemp()
+        app.config['ADMISSION_LIMITS'] = {}
+        admission.configure(app)
+        self.addCleanup(shutil.rmtree, app.config['ADMISSION_DIR'])
 
         category1 = Category('Cleaning')
         category2 = Category('Chemicals')
@@ -52,6 +122,7 @@ class TestApp(unittest.TestCase):
         db.session.commit()
         
     def tearDown(self):
+        exports.jobs.shutdown()
         db.session.remove()
         db.drop_all()
 
@@ -156,6 +227,25 @@ class TestApp(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTrue(response_json, expected_json)
 
+    def test_customer_categories_matches_orm_walk(self):
+        expected = []
+        walk = subqueryload(Customer.orders).subqueryload(Order.order_items).joinedload(OrderItem.product)
+        for customer in Customer.query.options(walk).all():
+            category_quantities = {}
+            for order in customer.orders:
+                for item in order.order_items:
+                    for category in item.product.categories:
+                        category_quantities[category] = category_quantities.get(category, 0) + item.quantity
+            for category in category_quantities:
+                expected.append({'id': customer.id, 'name': customer.name, 'category_id': category.id,
+                    'category': category.name, 'quantity': category_quantities[category]})
+        response = self.app.get('/api/products/categories')
+        response_json = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['id'] for row in response_json], [row['id'] for row in expected])
+        key = lambda row: (row['id'], row['category_id'])
+        self.assertEqual(sorted(response_json, key=key), sorted(expected, key=key))
+
     def test_customer_orders(self):
         response = self.app.get('/api/customers/1')
         response_json = json.loads(response.data)
@@ -167,6 +257,21 @@ class TestApp(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTrue(response_json, expected_json)
 
+    def test_customer_orders_query_count(self):
+        for _ in range(20):
+            order = Order(1, 'Waiting')
+            db.session.add(order)
+            db.session.flush()
+            db.session.add_all([OrderItem(1, 1, order.id), OrderItem(2, 2, order.id), OrderItem(3, 3, order.id)])
+        db.session.commit()
+        db.session.remove()
+        with QueryCounter() as counter:
+            response = self.app.get('/api/customers/1')
+        response_json = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response_json), 63)
+        self.assertLessEqual(counter.count, 2)
+
     def test_products(self):
         response = self.app.get('/api/products')
         response_json = json.loads(response.data)
@@ -186,7 +291,7 @@ class TestApp(unittest.TestCase):
         response = self.app.get('/api/orders/2000-1-1/2012-6-15/monthhhhh')
         response_json = json.loads(response.data)
         self.assertEqual(response.status_code, 400)
-        self.assertEqual(response_json['error'], 'Invalid interval format (use day, month, or year).')    
+        self.assertEqual(response_json['error'], 'Invalid interval format (use day, week, month, or year).')    
 
     def test_bad_date(self):
         response = self.app.get('/api/orders/2000-1-1/201-6-15')
@@ -273,5 +378,1046 @@ class TestApp(unittest.TestCase):
         self.assertEqual(len(response_json), 4)
 
 
+    def test_orders_paginated(self):
+        response = self.app.get('/api/orders?limit=3')
+        response_json = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([order['id'] for order in response_json['results']], [1, 2, 3])
+        self.assertEqual(response_json['results'][1]['items'], [
+            {'name': 'Bleach', 'product.id': 1, 'quantity': 5},
+            {'name': 'small bucket', 'product.id': 5, 'quantity': 2}])
+        self.assertIn('after=3', response_json['next'])
+        self.assertIn('rel="next"', response.headers['Link'])
+        response_json = json.loads(self.app.get(response_json['next']).data)
+        self.assertEqual([order['id'] for order in response_json['results']], [4])
+        self.assertIsNone(response_json['next'])
+
+    def test_orders_paginated_fields(self):
+        response = self.app.get('/api/orders?after=3&fields=customer,status')
+        response_json = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response_json['results'], [{'customer': 'Jonathan Archer', 'status': 'Delivered'}])
+
+    def test_customers_and_products_paginated(self):
+        response_json = json.loads(self.app.get('/api/customers?limit=2&after=1').data)
+        self.assertEqual(response_json['results'], [{'id': 2, 'name': 'Jean Luc Picard'}, {'id': 3, 'name': 'Jonathan Archer'}])
+        self.assertIsNone(response_json['next'])
+        response_json = json.loads(self.app.get('/api/products?limit=1&fields=id,categories').data)
+        self.assertEqual(len(response_json['results']), 1)
+        self.assertEqual(sorted(response_json['results'][0]['categories']), ['Chemicals', 'Cleaning'])
+
+    def test_bad_page_parameters(self):
+        for url in ['/api/orders?limit=zero', '/api/customers?limit=0', '/api/products?fields=price']:
+            response = self.app.get(url)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', json.loads(response.data))
+
+
+    def test_columnar_format(self):
+        rows = json.loads(self.app.get('/api/products/categories').data)
+        response = self.app.get('/api/products/categories?format=columnar')
+        columns = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(columns), ['category', 'category_id', 'id', 'name', 'quantity'])
+        self.assertEqual(columns['quantity'], [row['quantity'] for row in rows])
+        self.assertLess(len(response.data), len(self.app.get('/api/products/categories').data))
+        orders = json.loads(self.app.get('/api/orders?format=columnar').data)
+        self.assertEqual(sorted(orders), ['customer', 'customer_id', 'date', 'items'])
+        self.assertEqual(len(orders['customer_id']), 4)
+        products = json.loads(self.app.get('/api/products?format=columnar').data)
+        self.assertEqual(products['id'], [1, 2, 3, 4, 5])
+        page = json.loads(self.app.get('/api/customers?limit=2&format=columnar').data)
+        self.assertEqual(page['results'], {'id': [1, 2], 'name': ['James T. Kirk', 'Jean Luc Picard']})
+
+    def test_bad_format(self):
+        for url in ['/api/customers?format=xml', '/api/customers?limit=2&format=xml']:
+            response = self.app.get(url)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', json.loads(response.data))
+
+    @unittest.skipIf(formats.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_negotiated_and_cached_separately(self):
+        packed = self.app.get('/api/customers/1', headers={'Accept': 'application/msgpack'})
+        self.assertEqual(packed.mimetype, 'application/msgpack')
+        self.assertIn('Accept', packed.headers['Vary'])
+        plain = self.app.get('/api/customers/1')
+        self.assertEqual(plain.mimetype, 'application/json')
+        self.assertEqual(plain.headers['X-Cache'], 'MISS')
+        self.assertEqual(formats.msgpack.unpackb(packed.data), json.loads(plain.data))
+        self.assertLess(len(packed.data), len(plain.data))
+        self.assertEqual(self.app.get('/api/customers/1', headers={'Accept': 'application/msgpack'})
+                         .headers['X-Cache'], 'HIT')
+
+    def test_json_matches_jsonify(self):
+        payloads = [
+            {'b': [1, 2.5, None, True], 'a': {'z': 'Jean Luc Picard', 'y': []}},
+            {'name': 'Beverly Crusher \u00e9', 'date': datetime.date(2018, 1, 2)},
+            {2: 'two', 10: 'ten'},
+            [1e16, 0.00001, 2.5e-7, 0.1],
+        ]
+        self.addCleanup(setattr, app, 'debug', app.debug)
+        for debug in (False, True):
+            app.debug = debug
+            with app.test_request_context():
+                for payload in payloads:
+                    self.assertEqual(formats.encode(payload, formats.JSON), jsonify(payload).get_data(), payload)
+        app.debug = False
+        app.config['RESPONSE_CACHE'] = False
+        self.addCleanup(app.config.__setitem__, 'RESPONSE_CACHE', True)
+        with app.test_request_context():
+            expected = jsonify(json.loads(self.app.get('/api/products/categories').data)).get_data()
+        self.assertEqual(self.app.get('/api/products/categories').data, expected)
+
+    def test_unacceptable_format(self):
+        self.assertEqual(self.app.get('/api/customers', headers={'Accept': 'text/html'}).status_code, 406)
+
+    def test_interval_series(self):
+        orders = [Order(1, 'Delivered', date='2018-01-01'), Order(2, 'Delivered', date='2018-01-07'),
+                  Order(1, 'Delivered', date='2018-01-08'), Order(3, 'Delivered', date='2018-02-20')]
+        db.session.add_all(orders)
+        db.session.commit()
+        db.session.add_all([OrderItem(2, 1, orders[0].id), OrderItem(3, 1, orders[1].id),
+                            OrderItem(4, 1, orders[2].id), OrderItem(1, 2, orders[2].id),
+                            OrderItem(5, 1, orders[3].id)])
+        db.session.commit()
+        response = self.app.get('/api/orders/2018-01-01/2018-02-28/week?series=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), [
+            ['2018-01-01', 'Bleach', 5], ['2018-01-08', 'Bleach', 4], ['2018-01-08', 'hand soap', 1],
+            ['2018-02-19', 'Bleach', 5]])
+        response_json = json.loads(self.app.get('/api/orders/2018-01-01/2018-02-28/month?series=1').data)
+        self.assertEqual(response_json, [
+            ['2018-01-01', 'Bleach', 9], ['2018-01-01', 'hand soap', 1], ['2018-02-01', 'Bleach', 5]])
+        response_json = json.loads(self.app.get('/api/orders/2018-01-01/2018-02-28/year?series=1&format=columnar').data)
+        self.assertEqual(response_json, {'bucket': ['2018-01-01', '2018-01-01'], 'product': ['Bleach', 'hand soap'],
+                                         'quantity': [14, 1]})
+        response = self.app.get('/api/orders/2018-01-07/2018-01-07/day?series=1')
+        self.assertEqual(json.loads(response.data), [['2018-01-07', 'Bleach', 3]])
+        response = self.app.get('/api/orders/2018-01-01/2018-01-08/day/export?series=1')
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(response.get_data(as_text=True).splitlines()[0], 'bucket,product,quantity')
+
+    def test_short_range_averages(self):
+        for interval in ['day', 'week', 'month', 'year']:
+            response = self.app.get('/api/orders/2018-01-01/2018-01-01/{}'.format(interval))
+            self.assertEqual(response.status_code, 200)
+
+    def test_single_day_range(self):
+        today = Order.query.get(1).date.strftime('%Y-%m-%d')
+        lines = self.app.get('/api/orders/{0}/{0}/export'.format(today)).get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(len(json.loads(self.app.get('/api/orders/{0}/{0}/'.format(today)).data)), 4)
+
+    def test_export_interval_csv(self):
+        response = self.app.get('/api/orders/2000-1-1/2100-1-1/year/export')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertIn('attachment; filename=items_per_period.csv', response.headers['Content-Disposition'])
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'item,frequency_bought_per_year')
+        self.assertEqual(len(lines), 5)
+
+    def test_export_order_items_csv(self):
+        response = self.app.get('/api/orders/2000-1-1/2100-1-1/export')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'order_id,customer_id,customer,date,status,product,quantity')
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[1].startswith('1,1,James T. Kirk,'))
+        self.assertTrue(lines[1].endswith(',Waiting,Bleach,5'))
+
+
+    def rollup_rows(self):
+        return sorted((str(row.date), row.product_id, row.quantity) for row in DailyProductSales.query.all())
+
+    def run_export_job(self, url):
+        response = self.app.post(url)
+        self.assertEqual(response.status_code, 202)
+        job = json.loads(response.data)
+        self.assertEqual(response.headers['Location'], job['url'])
+        exports.jobs.wait(job['id'], timeout=10)
+        return job, self.app.get(job['url'])
+
+    def test_background_export_matches_streamed_export(self):
+        for url in ['/api/orders/2000-01-01/2100-01-01/export', '/api/orders/2000-01-01/2100-01-01/month/export']:
+            job, response = self.run_export_job(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_data(), self.app.get(url).get_data())
+            self.assertIn('attachment', response.headers['Content-Disposition'])
+        job, response = self.run_export_job('/api/orders/2000-01-01/2100-01-01/export?output=ndjson')
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[0]['product'], 'Bleach')
+        self.assertEqual(exports.jobs.get(job['id'])['rows'], 5)
+
+    def test_background_export_dedupes_and_expires(self):
+        started, release = threading.Event(), threading.Event()
+
+        def produce():
+            started.set()
+            release.wait(10)
+            return ['n'], [[1]]
+
+        with app.app_context():
+            running = exports.jobs.submit('key', 'name', 'csv', produce)
+            started.wait(10)
+            self.assertEqual(exports.jobs.submit('key', 'name', 'csv', produce)['id'], running['id'])
+            release.set()
+            exports.jobs.wait(running['id'], timeout=10)
+            # once it is done the same request exports afresh, so it picks up new orders
+            self.assertEqual(exports.jobs.get(running['id'])['status'], 'done')
+            self.assertNotEqual(exports.jobs.submit('key', 'name', 'csv', produce)['id'], running['id'])
+        first, _ = self.run_export_job('/api/orders/2000-01-01/2100-01-01/export')
+        # another worker process sees the job through the shared registry
+        other = exports.ExportJobs(app)
+        self.assertEqual(other.get(first['id'])['status'], 'done')
+        path = exports.jobs.get(first['id'])['path']
+        self.assertTrue(os.path.exists(path))
+        exports.jobs.expire(now=time.time() + app.config['EXPORT_TTL'] + 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.app.get(first['url']).status_code, 404)
+
+    def test_background_export_failure_is_reported(self):
+        def produce():
+            raise RuntimeError('disk full')
+
+        with app.app_context():
+            job = exports.jobs.submit('failing', 'name', 'csv', produce)
+            exports.jobs.wait(job['id'], timeout=10)
+        response = self.app.get('/api/exports/{}'.format(job['id']))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json['status'], response.json['error']), ('failed', 'disk full'))
+
+    def test_background_export_bad_requests(self):
+        for url in ['/api/orders/2000-01-01/2100-01-01/export?output=xml', '/api/orders/2000-01-01/1999-01-01/export',
+                    '/api/orders/2000-01-01/2100-01-01/fortnight/export']:
+            self.assertEqual(self.app.post(url).status_code, 400)
+
+    def test_rollup_maintained_on_writes(self):
+        order = Order(2, 'Waiting', date='2001-2-3')
+        db.session.add(order)
+        db.session.flush()
+        item = OrderItem(4, 1, order.id)
+        db.session.add_all([item, OrderItem(6, 1, order.id)])
+        db.session.commit()
+        self.assertIn(('2001-02-03', 1, 10), self.rollup_rows())
+        item.quantity = 1
+        db.session.commit()
+        self.assertIn(('2001-02-03', 1, 7), self.rollup_rows())
+        order.date = datetime.date(2001, 2, 4)
+        db.session.commit()
+        self.assertIn(('2001-02-04', 1, 7), self.rollup_rows())
+        self.assertNotIn('2001-02-03', [row[0] for row in self.rollup_rows()])
+        db.session.delete(item)
+        db.session.commit()
+        self.assertIn(('2001-02-04', 1, 6), self.rollup_rows())
+
+    def test_rollup_rebuild_matches_incremental(self):
+        incremental = self.rollup_rows()
+        self.assertEqual(sum(row[2] for row in incremental), 33)
+        db.session.execute(DailyProductSales.__table__.delete())
+        rollups.rebuild(db.session.connection())
+        db.session.commit()
+        self.assertEqual(self.rollup_rows(), incremental)
+
+
+    def test_query_plans_use_indexes(self):
+        # endpoints that list or aggregate a whole table are allowed to scan it
+        endpoints = [
+            ('/api/customers/1', set()),
+            ('/api/customers?limit=2&after=1', set()),
+            ('/api/products?limit=2&after=1', set()),
+            ('/api/orders?limit=2&after=1', set()),
+            ('/api/orders/2000-1-1/2100-1-1/', set()),
+            ('/api/orders/2000-1-1/2100-1-1/year', set()),
+            ('/api/orders/2000-1-1/2100-1-1/export', set()),
+            ('/api/customers', {'customers'}),
+            ('/api/products', {'products', 'products_categories'}),
+            ('/api/orders', {'orders', 'order_items'}),
+            ('/api/products/categories', {'order_items'}),
+        ]
+        for url, allowed in endpoints:
+            with QueryCounter() as counter:
+                response = self.app.get(url)
+                response.get_data()
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(counter.statements, url)
+            for statement, parameters in counter.statements:
+                scans = full_table_scans(statement, parameters) - allowed
+                self.assertFalse(scans, '{} scans {} in: {}'.format(url, ', '.join(scans), statement))
+
+
+    def test_response_cache_hit_and_etag(self):
+        first = self.app.get('/api/customers')
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        with QueryCounter() as counter:
+            second = self.app.get('/api/customers')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        not_modified = self.app.get('/api/customers', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.data, b'')
+        stats = json.loads(self.app.get('/api/_cache').data)
+        self.assertGreaterEqual(stats['hits'], 2)
+
+    def test_response_cache_invalidated_on_commit(self):
+        self.assertEqual(len(json.loads(self.app.get('/api/customers').data)), 3)
+        self.app.get('/api/products')
+        db.session.add(Customer('Kathryn Janeway'))
+        db.session.commit()
+        response = self.app.get('/api/customers')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(json.loads(response.data)), 4)
+        self.assertEqual(self.app.get('/api/products').headers['X-Cache'], 'HIT')
+
+    def test_response_cache_lru_bound(self):
+        store = cache.for_app(app)
+        store.clear()
+        maxsize = store.maxsize
+        store.maxsize = 2
+        try:
+            for url in ['/api/customers', '/api/products', '/api/orders']:
+                self.app.get(url)
+            self.assertEqual(cache.stats()['size'], 2)
+            self.assertEqual(self.app.get('/api/customers').headers['X-Cache'], 'MISS')
+        finally:
+            store.maxsize = maxsize
+
+
+    def test_bulk_orders(self):
+        lines = [
+            {'customer_id': 1, 'status': 'Waiting', 'date': '2001-2-3', 'items': [{'product_id': 1, 'quantity': 2}]},
+            {'customer_id': 2, 'status': 'Waiting', 'date': '2001-02-03',
+             'items': [{'product_id': 1, 'quantity': 3}, {'product_id': 2, 'quantity': 1}]},
+            {'customer_id': 99, 'status': 'Waiting', 'date': '2001-02-03', 'items': []},
+            {'customer_id': 3, 'status': 'Waiting', 'date': 'yesterday'},
+            {'customer_id': 3, 'status': 'Delivered', 'date': '2001-02-04'},
+        ]
+        body = '\n'.join(json.dumps(line) for line in lines) + '\nnot json\n'
+        self.app.get('/api/orders')
+        response = self.app.post('/api/orders/bulk', data=body, content_type='application/x-ndjson')
+        response_json = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response_json['orders'], 3)
+        self.assertEqual(response_json['order_items'], 3)
+        self.assertEqual(response_json['batches'][0]['method'], 'executemany')
+        self.assertEqual(sorted(error['line'] for error in response_json['errors']), [3, 4, 6])
+        self.assertEqual(Order.query.count(), 7)
+        self.assertEqual(OrderItem.query.filter(OrderItem.order_id > 4).count(), 3)
+        self.assertIn(('2001-02-03', 1, 5), self.rollup_rows())
+        self.assertEqual(len(json.loads(self.app.get('/api/orders').data)), 7)
+
+    def test_bulk_orders_batches(self):
+        line = json.dumps({'customer_id': 1, 'status': 'Waiting', 'date': '2001-02-03',
+            'items': [{'product_id': 1, 'quantity': 1}]})
+        summary = ingest.ingest([line] * 5, batch_size=2)
+        self.assertEqual([batch['orders'] for batch in summary['batches']], [2, 2, 1])
+        self.assertEqual(summary['error_count'], 0)
+        self.assertEqual(Order.query.count(), 9)
+        self.assertIn(('2001-02-03', 1, 5), self.rollup_rows())
+
+    def test_bulk_orders_batch_failure_is_reported(self):
+        allocate = ingest._allocate_ids
+        calls = []
+
+        def racing(connection, table, count):
+            # another writer took the second batch's order ids first
+            calls.append(table.name)
+            if calls.count('orders') == 2 and table.name == 'orders':
+                return list(range(1, count + 1))
+            return allocate(connection, table, count)
+        self.addCleanup(setattr, ingest, '_allocate_ids', allocate)
+        ingest._allocate_ids = racing
+        line = json.dumps({'customer_id': 1, 'status': 'Waiting', 'date': '2001-02-03',
+                           'items': [{'product_id': 1, 'quantity': 1}]})
+        summary = ingest.ingest([line] * 5, batch_size=2)
+        self.assertEqual([batch['orders'] for batch in summary['batches']], [2, 0, 1])
+        self.assertEqual(summary['batches'][1]['lines'], [3, 4])
+        self.assertEqual([error['line'] for error in summary['errors']], [3, 4])
+        self.assertTrue(summary['errors'][0]['error'].startswith('Batch not written'))
+        self.assertEqual((summary['orders'], summary['order_items']), (3, 3))
+        self.assertEqual(Order.query.count(), 7)
+        self.assertEqual(summaries.reconcile(db.session.connection(), fix=False), [])
+
+    def test_bulk_orders_invalid_utf8(self):
+        line = json.dumps({'customer_id': 1, 'status': 'Waiting', 'date': '2001-02-03', 'items': []}).encode()
+        body = line + b'\n{"customer_id": 1, "status": "\xff"}\n' + line + b'\n'
+        response = self.app.post('/api/orders/bulk', data=body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['orders'], 2)
+        self.assertEqual(response.json['errors'], [{'line': 2, 'error': 'Line is not valid UTF-8.'}])
+
+
+    def synthetic_snapshot(self):
+        return [
+            db.session.execute('SELECT * FROM customers ORDER BY id').fetchall(),
+            db.session.execute('SELECT * FROM products ORDER BY id').fetchall(),
+            db.session.execute('SELECT * FROM products_categories ORDER BY product_id, category_id').fetchall(),
+            db.session.execute('SELECT * FROM orders ORDER BY id').fetchall(),
+            db.session.execute('SELECT * FROM order_items ORDER BY id').fetchall(),
+        ]
+
+    def test_synthetic_data_is_deterministic(self):
+        snapshots = []
+        for _ in range(2):
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+            counts = synthetic.generate(customers=50, products=30, categories=6, orders=400, seed=7, batch_size=64)
+            snapshots.append(self.synthetic_snapshot())
+        self.assertTrue(snapshots[0] == snapshots[1])
+        customers, products, links, orders, items = snapshots[0]
+        self.assertEqual((len(customers), len(products), len(orders)), (50, 30, 400))
+        self.assertEqual(len(items), counts['order_items'])
+        for product_id, _ in products:
+            self.assertTrue(1 <= len([link for link in links if link[0] == product_id]) <= 3)
+        rollup_total = db.session.execute('SELECT SUM(quantity) FROM daily_product_sales').scalar()
+        self.assertEqual(rollup_total, sum(item[1] for item in items))
+
+    @unittest.skipIf(not analytics.numpy_available(), 'numpy is not installed')
+    def test_columnar_engine_matches_sql(self):
+        synthetic.generate(customers=40, products=25, categories=6, orders=300, seed=3)
+        start, end = datetime.date(2016, 1, 1), datetime.date(2017, 6, 30)
+        store = analytics.store.for_app(app)
+        self.assertEqual(store.customer_category_quantities(),
+                         [tuple(int(value) if i in (0, 2, 4) else value for i, value in enumerate(row))
+                          for row in aggregates.customer_category_quantities()])
+        self.assertEqual(sorted(store.product_quantities(start, end)),
+                         sorted((name, int(quantity)) for name, quantity in aggregates.product_quantities(start, end)))
+        for interval in aggregates.SERIES_INTERVALS:
+            self.assertEqual(store.product_series(start, end, interval),
+                             [(bucket, name, int(quantity))
+                              for bucket, name, quantity in aggregates.product_series(start, end, interval)])
+        app.config['ANALYTICS_ENGINE'] = 'columnar'
+        try:
+            columnar = self.app.get('/api/products/categories').data
+        finally:
+            app.config['ANALYTICS_ENGINE'] = 'sql'
+        cache.clear()
+        self.assertEqual(json.loads(columnar), json.loads(self.app.get('/api/products/categories').data))
+
+    @unittest.skipIf(not analytics.numpy_available(), 'numpy is not installed')
+    def test_columnar_engine_refreshes_incrementally(self):
+        store = analytics.store.for_app(app)
+        self.assertEqual(len(store.refresh()['item_id']), 5)
+        order = Order(2, 'Waiting', date='2018-05-05')
+        db.session.add(order)
+        db.session.commit()
+        db.session.add(OrderItem(7, 1, order.id))
+        db.session.commit()
+        self.assertFalse(store.stale)
+        self.assertEqual(len(store.refresh()['item_id']), 6)
+        self.assertEqual(store.product_quantities(datetime.date(2018, 5, 5), datetime.date(2018, 5, 5)),
+                         [('Bleach', 7)])
+        item = OrderItem.query.get(6)
+        item.quantity = 1
+        db.session.commit()
+        self.assertTrue(store.stale)
+        self.assertEqual(store.product_quantities(datetime.date(2018, 5, 5), datetime.date(2018, 5, 5)),
+                         [('Bleach', 1)])
+        # an append only loads the names of the customers and products it brings in
+        customer = Customer('Hikaru Sulu')
+        db.session.add(customer)
+        db.session.commit()
+        order = Order(customer.id, 'Waiting', date='2018-05-05')
+        db.session.add(order)
+        db.session.commit()
+        db.session.add(OrderItem(2, 2, order.id))
+        db.session.commit()
+        self.assertFalse(store.dimensions_stale)
+        with QueryCounter() as counter:
+            store.refresh()
+        self.assertEqual(store.customer_names[customer.id], 'Hikaru Sulu')
+        self.assertFalse([statement for statement, _ in counter.statements
+                          if 'FROM customers' in statement and 'WHERE' not in statement])
+
+    @unittest.skipIf(not analytics.numpy_available(), 'numpy is not installed')
+    def test_columnar_engine_sees_other_workers_rewrites(self):
+        app.config['ANALYTICS_ENGINE'] = 'columnar'
+        app.config['ANALYTICS_DIR'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, app.config['ANALYTICS_DIR'])
+        self.addCleanup(app.config.update, ANALYTICS_ENGINE='sql', ANALYTICS_DIR=None)
+        store = analytics.store.for_app(app)
+        store.refresh()
+        item = OrderItem.query.get(1)
+        item.quantity = 9
+        db.session.commit()
+        # as if the commit happened in another worker, which only reaches this one through the state file
+        store.stale = False
+        self.assertEqual(int(store.refresh()['quantity'][0]), 9)
+
+    @unittest.skipIf(not analytics.numpy_available(), 'numpy is not installed')
+    def test_columnar_store_is_per_app(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'other.db')
+        shutil.copy(db.engine.url.database, path)
+        other = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'TESTING': True,
+                            'ANALYTICS_ENGINE': 'columnar', 'ANALYTICS_DIR': directory}, environ={})
+        self.assertEqual(len(analytics.store.for_app(app).refresh()['item_id']), 5)
+        db.session.remove()
+        with other.app_context():
+            db.session.execute(OrderItem.__table__.delete())
+            db.session.commit()
+            self.assertEqual(len(analytics.aggregates_for(other).refresh()['item_id']), 0)
+            db.session.remove()
+        self.assertIsNot(analytics.store.for_app(other), analytics.store.for_app(app))
+        self.assertEqual(len(analytics.store.for_app(app).refresh()['item_id']), 5)
+
+    def test_streaming_engine_matches_sql(self):
+        synthetic.generate(customers=40, products=25, categories=6, orders=300, seed=3)
+        start, end = datetime.date(2016, 1, 1), datetime.date(2017, 6, 30)
+        streaming = aggregates.streaming
+        self.assertEqual(streaming.customer_category_quantities(),
+                         [tuple(int(value) if i in (0, 2, 4) else value for i, value in enumerate(row))
+                          for row in aggregates.customer_category_quantities()])
+        self.assertEqual(sorted(streaming.product_quantities(start, end)),
+                         sorted((name, int(quantity)) for name, quantity in aggregates.product_quantities(start, end)))
+        for interval in aggregates.SERIES_INTERVALS:
+            self.assertEqual(streaming.product_series(start, end, interval),
+                             [(bucket, name, int(quantity))
+                              for bucket, name, quantity in aggregates.product_series(start, end, interval)])
+        items = db.session.query(OrderItem).join(Order).filter(Order.date.between(start, end)).count()
+        app.config['ANALYTICS_ENGINE'] = 'stream'
+        try:
+            response = self.app.get('/api/orders/2016-01-01/2017-06-30/month')
+        finally:
+            app.config['ANALYTICS_ENGINE'] = 'sql'
+        self.assertEqual(response.headers['X-Rows-Processed'], str(items))
+        cache.clear()
+        self.assertEqual(json.loads(response.data), json.loads(self.app.get('/api/orders/2016-01-01/2017-06-30/month').data))
+        self.assertNotIn('X-Rows-Processed', self.app.get('/api/customers').headers)
+
+    def test_serializers_match_model_reprs(self):
+        order = Order(1, 'Waiting', date='2018-02-02')
+        db.session.add_all([order, Product('no categories')])
+        db.session.commit()
+        synthetic.generate(customers=20, products=15, categories=4, orders=60, seed=5)
+        db.session.expire_all()
+        self.assertEqual(serializers.customer_names(), [repr(customer) for customer in Customer.query.all()])
+        self.assertEqual(serializers.product_categories(),
+                         {product.id: [product.name, repr(product.categories)] for product in Product.query.all()})
+        orm_rows = lambda orders: [[order.customer_id, repr(order.customers), order.date.strftime('%Y-%m-%d'),
+                                    repr(order.order_items)] for order in orders]
+        self.assertEqual(serializers.order_rows(), orm_rows(Order.query.all()))
+        between = Order.date.between(datetime.date(2016, 1, 1), datetime.date(2016, 12, 31))
+        self.assertEqual(serializers.order_rows(between, by_date=True), orm_rows(Order.query.filter(between).all()))
+
+    def test_server_timing_header(self):
+        response = self.app.get('/api/customers/1')
+        self.assertRegex(response.headers['Server-Timing'], r'^db;dur=[\d.]+;desc="2 queries", app;dur=[\d.]+$')
+
+    def test_n_plus_one_detected(self):
+        for n in range(12):
+            db.session.add(Product('product {}'.format(n)))
+        db.session.commit()
+        instrumentation.metrics.reset()
+        # the listings no longer lazy-load, so walk the relationships by hand inside a request
+        with app.test_request_context('/api/products'):
+            app.preprocess_request()
+            for product in Product.query.all():
+                product.categories
+            response = app.process_response(app.make_response('[]'))
+        self.assertIn('n-plus-one;desc="17 x repeated statement"', response.headers['Server-Timing'])
+        self.assertIn('desc="2 queries"', self.app.get('/api/products').headers['Server-Timing'])
+        metrics = self.app.get('/api/_metrics').get_data(as_text=True)
+        self.assertIn('api_n_plus_one_total{method="GET",route="/api/products"} 1', metrics)
+        self.assertIn('api_request_sql_queries_bucket{method="GET",route="/api/products",le="+Inf"} 2', metrics)
+        self.assertIn('# TYPE api_request_duration_seconds histogram', metrics)
+        self.assertIn('api_response_cache_misses_total', metrics)
+
+    def limit(self, **settings):
+        app.config['ADMISSION_LIMITS'] = {'categories': dict({'rate': None, 'queue': 0, 'wait': 0}, **settings)}
+        app.config['RESPONSE_CACHE'] = False
+        self.addCleanup(app.config.__setitem__, 'RESPONSE_CACHE', True)
+        admission.configure(app)
+        return app.extensions['admission']['categories']
+
+    def test_concurrency_limit_sheds_with_503(self):
+        limiter = self.limit(concurrency=1)
+        self.assertIsNone(limiter.acquire())
+        response = self.app.get('/api/products/categories')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(self.app.get('/api/customers/1').status_code, 200)
+        metrics = self.app.get('/api/_metrics').get_data(as_text=True)
+        self.assertIn('api_requests_shed_total{limit="categories",reason="concurrency"} 1', metrics)
+        self.assertIn('api_admission_in_flight{limit="categories"} 1', metrics)
+        limiter.release()
+        self.assertEqual(self.app.get('/api/products/categories').status_code, 200)
+        self.assertEqual(limiter.snapshot(), (0, 0))
+
+    def test_queued_request_waits_for_a_slot(self):
+        limiter = self.limit(concurrency=1, queue=1, wait=5)
+        self.assertIsNone(limiter.acquire())
+        threading.Timer(0.2, limiter.release).start()
+        self.assertEqual(self.app.get('/api/products/categories').status_code, 200)
+        self.assertEqual(limiter.snapshot(), (0, 0))
+
+    def test_rate_limit_sheds_with_429(self):
+        self.limit(rate=0.5, burst=1)
+        self.assertEqual(self.app.get('/api/products/categories').status_code, 200)
+        response = self.app.get('/api/products/categories')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '2')
+
+    def test_slots_of_dead_workers_are_reclaimed(self):
+        limiter = self.limit(concurrency=1)
+        with limiter.state.locked() as state:
+            state['holders'] = {'999999999': 1}
+        self.assertEqual(self.app.get('/api/products/categories').status_code, 200)
+
+    def test_create_app_is_independent_and_warms_up(self):
+        other = create_app({'SQLALCHEMY_DATABASE_URI': app.config['SQLALCHEMY_DATABASE_URI'], 'TESTING': True,
+                            'WARM_UP': True}, environ={})
+        self.assertIsNot(other, app)
+        self.assertFalse(app.config['WARM_UP'])
+        response = other.test_client().get('/api/customers/1')
+        self.assertEqual(response.status_code, 200)
+        # the warm-up filled the other app's own cache, this one's is untouched
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertEqual(self.app.get('/api/customers/1').headers['X-Cache'], 'MISS')
+        self.assertIsNot(cache.for_app(other), cache.for_app(app))
+        self.assertIsNot(exports.jobs.for_app(other), exports.jobs.for_app(app))
+        self.assertEqual(json.loads(response.data), json.loads(self.app.get('/api/customers/1').data))
+
+    @unittest.skipIf(not hasattr(os, 'register_at_fork'), 'needs os.register_at_fork')
+    def test_engines_disposed_before_fork(self):
+        pool = db.engine.pool
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertIsNot(db.engine.pool, pool)
+
+    def search(self, path, **args):
+        response = self.app.get(path, query_string=args)
+        return response.status_code, json.loads(response.data)
+
+    def test_search_backends_rank_and_page(self):
+        self.addCleanup(app.config.__setitem__, 'SEARCH_BACKEND', 'auto')
+        for backend in ('fts5', 'memory'):
+            app.config['SEARCH_BACKEND'] = backend
+            cache.clear()
+            status, body = self.search('/api/products/search', q='SOAP')
+            self.assertEqual(status, 200)
+            self.assertEqual(body, {'results': [{'id': 2, 'name': 'hand soap'}], 'next': None})
+            self.assertEqual([row['name'] for row in self.search('/api/products/search', q='p')[1]['results']], [])
+            self.assertEqual([row['name'] for row in self.search('/api/products/search', q='to')[1]['results']],
+                             ['toilet paper'])
+            # exact, then prefix, then substring matches
+            db.session.add_all([Product('pap'), Product('paper'), Product('paper towels')])
+            db.session.commit()
+            names = [row['name'] for row in self.search('/api/products/search', q='pap')[1]['results']]
+            self.assertEqual(names, ['pap', 'paper', 'paper towels', 'toilet paper'])
+            status, body = self.search('/api/products/search', q='pap', limit=2)
+            self.assertEqual([row['name'] for row in body['results']], ['pap', 'paper'])
+            self.assertIn('offset=2', body['next'])
+            self.assertEqual([row['name'] for row in self.app.get(body['next']).json['results']],
+                             ['paper towels', 'toilet paper'])
+            self.assertEqual([row['name'] for row in self.search('/api/customers/search', q='j')[1]['results']],
+                             ['James T. Kirk', 'Jean Luc Picard', 'Jonathan Archer'])
+            self.assertEqual([row['id'] for row in self.search('/api/customers/search', q='luc pic')[1]['results']],
+                             [2])
+            Product.query.filter(Product.name.in_(['pap', 'paper', 'paper towels'])).delete(synchronize_session=False)
+            db.session.commit()
+            search.reset()
+
+    def test_search_follows_writes(self):
+        self.addCleanup(app.config.__setitem__, 'SEARCH_BACKEND', 'auto')
+        for backend in ('fts5', 'memory'):
+            app.config['SEARCH_BACKEND'] = backend
+            self.assertEqual(self.search('/api/customers/search', q='kirk')[1]['results'][0]['name'], 'James T. Kirk')
+            Customer.query.get(1).name = 'James Tiberius Kirk'
+            added = Customer('Kathryn Janeway')
+            db.session.add(added)
+            db.session.commit()
+            added_id = added.id
+            self.assertEqual([row['name'] for row in self.search('/api/customers/search', q='kirk')[1]['results']],
+                             ['James Tiberius Kirk'])
+            self.assertEqual(self.search('/api/customers/search', q='janew')[1]['results'][0]['id'], added_id)
+            db.session.delete(Customer.query.get(added_id))
+            Customer.query.get(1).name = 'James T. Kirk'
+            db.session.commit()
+            self.assertEqual(self.search('/api/customers/search', q='janew')[1]['results'], [])
+
+    def test_search_caps_candidates(self):
+        self.addCleanup(app.config.__setitem__, 'SEARCH_BACKEND', 'auto')
+        self.addCleanup(setattr, search, 'MAX_CANDIDATES', search.MAX_CANDIDATES)
+        search.MAX_CANDIDATES = 1
+        db.session.add_all([Product('big sopa'), Product('sopa'), Product('soap dish')])
+        db.session.commit()
+        for backend in ('fts5', 'memory'):
+            app.config['SEARCH_BACKEND'] = backend
+            cache.clear()
+            names = [row['name'] for row in self.search('/api/products/search', q='sopa')[1]['results']]
+            # one substring match ranked, but the exact match is never crowded out
+            self.assertEqual(names[0], 'sopa')
+            self.assertEqual(len(names), 2)
+            names = [row['name'] for row in self.search('/api/products/search', q='so')[1]['results']]
+            self.assertEqual(names, ['soap dish', 'sopa'])
+        Product.query.filter(Product.name.in_(['big sopa', 'sopa', 'soap dish'])).delete(synchronize_session=False)
+        db.session.commit()
+        search.reset()
+
+    def test_search_bad_requests(self):
+        for args in ({}, {'q': '  '}, {'q': 'soap', 'limit': 'x'}, {'q': 'soap', 'offset': -1},
+                     {'q': 'soap', 'offset': search.MAX_OFFSET + 1}):
+            status, body = self.search('/api/products/search', **args)
+            self.assertEqual(status, 400)
+            self.assertIn('error', body)
+
+    def test_search_uses_indexes(self):
+        with app.test_request_context():
+            for query in ('soap', 'ha'):
+                with QueryCounter() as counter:
+                    search.search(app, 'products', query)
+                statement, parameters = counter.statements[-1]
+                self.assertEqual(full_table_scans(statement, parameters) - {'products_search'}, set(), statement)
+
+    def summary(self, customer_id):
+        return json.loads(self.app.get('/api/customers/{}/summary'.format(customer_id)).data)
+
+    def test_customer_summary(self):
+        today = Order.query.get(1).date.strftime('%Y-%m-%d')
+        self.assertEqual(self.summary(1), {'customer_id': 1, 'order_count': 2, 'total_quantity': 12,
+                                           'last_order_date': today, 'statuses': {'Waiting': 2}})
+        customer = Customer('Kathryn Janeway')
+        db.session.add(customer)
+        db.session.commit()
+        self.assertEqual(self.summary(customer.id)['order_count'], 0)
+        self.assertEqual(self.app.get('/api/customers/99/summary').status_code, 404)
+        app.config['RESPONSE_CACHE'] = False
+        self.addCleanup(app.config.__setitem__, 'RESPONSE_CACHE', True)
+        with app.test_request_context(), QueryCounter() as counter:
+            self.app.get('/api/customers/1/summary')
+        self.assertEqual(counter.count, 1)
+
+    def test_customer_summary_follows_writes(self):
+        order = Order(1, 'Waiting', '2030-01-02')
+        db.session.add(order)
+        db.session.flush()
+        order_id = order.id
+        db.session.add_all([OrderItem(3, 1, order_id), OrderItem(4, 2, order_id)])
+        Order.query.get(2).status = 'Delivered'
+        OrderItem.query.get(1).quantity = 6
+        db.session.commit()
+        self.assertEqual(self.summary(1), {'customer_id': 1, 'order_count': 3, 'total_quantity': 20,
+                                           'last_order_date': '2030-01-02',
+                                           'statuses': {'Delivered': 1, 'Waiting': 2}})
+        db.session.delete(OrderItem.query.get(2))
+        moved = Order.query.get(4)
+        moved.customer_id = 1
+        db.session.commit()
+        self.assertEqual(self.summary(1)['total_quantity'], 16)
+        self.assertEqual(self.summary(1)['statuses'], {'Delivered': 2, 'Waiting': 2})
+        self.assertEqual(self.summary(3)['order_count'], 0)
+        for item in OrderItem.query.filter_by(order_id=order_id):
+            db.session.delete(item)
+        db.session.delete(Order.query.get(order_id))
+        db.session.commit()
+        self.assertEqual(self.summary(1)['last_order_date'], Order.query.get(1).date.strftime('%Y-%m-%d'))
+        lines = [json.dumps({'customer_id': 2, 'status': 'Waiting', 'date': '2031-05-06',
+                             'items': [{'product_id': 1, 'quantity': 7}]})]
+        ingest.ingest(lines)
+        self.assertEqual(self.summary(2), {'customer_id': 2, 'order_count': 2, 'total_quantity': 27,
+                                           'last_order_date': '2031-05-06',
+                                           'statuses': {'In Transit': 1, 'Waiting': 1}})
+        self.assertEqual(summaries.reconcile(db.session.connection()), [])
+
+    def test_customer_summary_reconcile(self):
+        db.session.query(CustomerSummary).filter_by(customer_id=2).update({'total_quantity': 0})
+        db.session.query(CustomerSummary).filter_by(customer_id=3).delete()
+        db.session.commit()
+        self.assertEqual(summaries.reconcile(db.session.connection(), fix=False), [2, 3])
+        self.assertEqual(summaries.reconcile(db.session.connection()), [2, 3])
+        db.session.commit()
+        self.assertEqual(summaries.reconcile(db.session.connection()), [])
+        self.assertEqual(self.summary(2)['total_quantity'], 20)
+        synthetic.generate(customers=20, products=5, categories=2, orders=50, seed=1)
+        self.assertEqual(summaries.reconcile(db.session.connection()), [])
+
+    def test_customer_summary_writers_take_turns(self):
+        # two first orders for a customer without a row: the second writer waits, then rewrites the row
+        db.session.query(CustomerSummary).filter_by(customer_id=3).delete()
+        db.session.commit()
+        expected = summaries._compute(db.session.connection(), [1, 3])
+        first = PostgresLocks(db.session.connection())
+        summaries.apply(first, {3: {'orders': 1, 'quantity': 0, 'last_order_date': None, 'statuses': {}},
+                                1: {'orders': 0, 'quantity': 0, 'last_order_date': None, 'statuses': {}}})
+        self.assertEqual(first.locks[:2], [(summaries.LOCK_KEY, 1), (summaries.LOCK_KEY, 3)])
+        second = PostgresLocks(db.session.connection())
+        summaries.refresh(second, [3])
+        self.assertEqual(second.locks, [(summaries.LOCK_KEY, 3)])
+        db.session.commit()
+        self.assertEqual(summaries.reconcile(db.session.connection(), fix=False), [])
+        self.assertEqual(self.summary(3)['order_count'], expected[3]['order_count'])
+
+    def top(self, start, end, **args):
+        response = self.app.get('/api/orders/{}/{}/'.format(start, end), query_string=args)
+        return response.status_code, json.loads(response.data)
+
+    def test_top_products_exact_and_approx(self):
+        today = Order.query.get(1).date.strftime('%Y-%m-%d')
+        status, exact = self.top(today, today, top=2)
+        self.assertEqual(status, 200)
+        self.assertEqual(exact, {'approx': False, 'top': [{'product_id': 3, 'product': 'toilet paper', 'quantity': 20},
+                                                          {'product_id': 1, 'product': 'Bleach', 'quantity': 10}]})
+        status, approx = self.top(today, today, top=2, approx='true')
+        self.assertEqual([(row['product_id'], row['quantity'], row['lower'], row['guaranteed']) for row in approx['top']],
+                         [(3, 20, 20, True), (1, 10, 10, True)])
+        self.assertEqual(approx['days'], 1)
+        self.assertEqual(approx['total_quantity'], 33)
+        self.assertEqual(approx['error_bounds']['unseen_max'], 0)
+        for args in ({'top': 'x'}, {'top': 0}, {'top': sketches.TOP_K + 1, 'approx': 'true'}):
+            self.assertEqual(self.top(today, today, **args)[0], 400)
+
+    def test_approx_top_products_bounds(self):
+        self.addCleanup(setattr, sketches, 'TOP_K', sketches.TOP_K)
+        sketches.TOP_K = 2
+        synthetic.generate(customers=50, products=40, categories=3, orders=3000, seed=4)
+        status, approx = self.top('2015-01-01', '2018-12-31', top=2, approx='true')
+        self.assertEqual(status, 200)
+        self.assertGreater(approx['error_bounds']['unseen_max'], 0)
+        exact = dict((row['product_id'], row['quantity'])
+                     for row in self.top('2015-01-01', '2018-12-31', top=1000)[1]['top'])
+        exact_top = sorted(exact, key=lambda product_id: (-exact[product_id], product_id))[:2]
+        for row in approx['top']:
+            self.assertLessEqual(row['lower'], exact[row['product_id']])
+            self.assertGreaterEqual(row['upper'], exact[row['product_id']])
+            if row['guaranteed']:
+                self.assertIn(row['product_id'], exact_top)
+        self.assertEqual(approx['top'][0]['product_id'], exact_top[0])
+
+    def test_sketches_backfilled_for_existing_history(self):
+        synthetic.generate(customers=30, products=20, categories=3, orders=500, seed=2)
+        # what migration e8a35c0f7d19 starts from: rollup history and no sketch table
+        connection = db.session.connection()
+        DailyProductSketch.__table__.drop(connection)
+        DailyProductSketch.__table__.create(connection)
+        rollup = sa.table('daily_product_sales', sa.column('date', sa.Date()), sa.column('product_id', sa.Integer()),
+                          sa.column('quantity', sa.Integer()))
+        sketches.fill(connection, rollup, DailyProductSketch.__table__)
+        db.session.commit()
+        cache.clear()
+        status, approx = self.top('2015-01-01', '2018-12-31', top=3, approx='true')
+        self.assertEqual(status, 200)
+        exact = self.top('2015-01-01', '2018-12-31', top=3)[1]['top']
+        self.assertEqual([(row['product_id'], row['lower'], row['guaranteed']) for row in approx['top']],
+                         [(row['product_id'], row['quantity'], True) for row in exact])
+        days = db.session.query(DailyProductSales.date).distinct() \
+            .filter(DailyProductSales.date.between(datetime.date(2015, 1, 1), datetime.date(2018, 12, 31)))
+        self.assertEqual(approx['days'], days.count())
+
+    def test_sketches_updated_in_place(self):
+        self.addCleanup(setattr, sketches, 'TOP_K', sketches.TOP_K)
+        sketches.TOP_K = 2
+        day = datetime.date(2001, 2, 3)
+        order = Order(2, 'Waiting', date='2001-2-3')
+        db.session.add(order)
+        db.session.flush()
+        order_id = order.id
+        first = OrderItem(4, 1, order_id)
+        db.session.add_all([first, OrderItem(3, 2, order_id), OrderItem(1, 3, order_id)])
+        db.session.commit()
+
+        def stored():
+            row = DailyProductSketch.query.get(day)
+            return row.total, row.threshold, json.loads(row.top), list(sketches._unpack(row.counts))
+
+        fresh = sketches.sketch(day, {1: 4, 2: 3, 3: 1})
+        self.assertEqual(stored(), (8, 1, [[1, 4], [2, 3]], list(sketches._unpack(fresh['counts']))))
+        db.session.add(OrderItem(5, 3, order_id))
+        db.session.commit()
+        # product 3 moves into the top-K and pushes product 2 out, the threshold covers it
+        self.assertEqual(stored()[:3], (13, 3, [[3, 6], [1, 4]]))
+        db.session.delete(first)
+        db.session.commit()
+        fresh = sketches.sketch(day, {2: 3, 3: 6})
+        self.assertEqual(stored(), (9, 3, [[3, 6]], list(sketches._unpack(fresh['counts']))))
+        status, approx = self.top('2001-02-03', '2001-02-03', top=1, approx='true')
+        self.assertEqual([(row['product_id'], row['lower'], row['guaranteed']) for row in approx['top']],
+                         [(3, 6, True)])
+        rollups.rebuild(db.session.connection())
+        db.session.commit()
+        self.assertEqual(stored()[:3], (9, 0, [[3, 6], [2, 3]]))
+        for item in OrderItem.query.filter_by(order_id=order_id):
+            db.session.delete(item)
+        db.session.commit()
+        self.assertIsNone(DailyProductSketch.query.get(day))
+
+    def test_customers_batch(self):
+        response = self.app.get('/api/customers/batch?ids=2,1,99,1')
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.data)
+        # keys sorted, the way jsonify writes them
+        self.assertEqual(list(body['customers']), ['1', '2'])
+        self.assertEqual(body['missing'], [99])
+        self.assertEqual(body['customers']['1']['name'], 'James T. Kirk')
+        self.assertEqual(body['customers']['1']['items'], json.loads(self.app.get('/api/customers/1').data))
+        self.assertEqual(body['customers']['2']['items'], json.loads(self.app.get('/api/customers/2').data))
+        posted = self.app.post('/api/customers/batch', data=json.dumps({'ids': [1, 2, 99]}),
+                               content_type='application/json')
+        self.assertEqual(json.loads(posted.data), dict(body, customers={'1': body['customers']['1'],
+                                                                        '2': body['customers']['2']}))
+        for args in ({'query_string': {'ids': 'a,b'}}, {'query_string': {}},
+                     {'method': 'POST', 'data': '{"ids": [1.5]}', 'content_type': 'application/json'},
+                     {'method': 'POST', 'data': 'nope'}):
+            self.assertEqual(self.app.open('/api/customers/batch', **args).status_code, 400)
+
+    def test_customers_batch_chunks_in_lists(self):
+        self.addCleanup(setattr, serializers, 'BATCH_CHUNK', serializers.BATCH_CHUNK)
+        serializers.BATCH_CHUNK = 2
+        app.config['RESPONSE_CACHE'] = False
+        self.addCleanup(app.config.__setitem__, 'RESPONSE_CACHE', True)
+        with app.test_request_context(), QueryCounter() as counter:
+            response = self.app.post('/api/customers/batch', data=json.dumps(list(range(1, 8))),
+                                     content_type='application/json')
+        self.assertEqual(json.loads(response.data)['missing'], [4, 5, 6, 7])
+        # two queries for each chunk of two ids
+        self.assertEqual(counter.count, 8)
+        self.assertTrue(all(statement.count('?') <= 2 for statement, _ in counter.statements))
+
+    def test_order_change_log(self):
+        self.assertEqual([change.kind for change in OrderChange.query.order_by(OrderChange.id)],
+                         ['order'] * 4 + ['order_item'] * 5)
+        order = Order.query.get(3)
+        order.status = 'Delivered'
+        db.session.commit()
+        ingest.ingest([json.dumps({'customer_id': 2, 'status': 'Waiting', 'date': '2031-05-06',
+                                   'items': [{'product_id': 1, 'quantity': 7}]})])
+        status, bulk = OrderChange.query.order_by(OrderChange.id.desc()).limit(2).all()[::-1]
+        self.assertEqual((status.kind, json.loads(status.data)), ('status', {'order_id': 3, 'from': 'In Transit',
+                                                                             'to': 'Delivered'}))
+        self.assertEqual(bulk.kind, 'order')
+        item_id = OrderItem.query.filter_by(order_id=bulk.order_id).one().id
+        self.assertEqual(json.loads(bulk.data)['items'], [{'id': item_id, 'order_id': bulk.order_id, 'product_id': 1,
+                                                           'quantity': 7}])
+
+    def stream(self, **headers):
+        app.config['CHANGE_FEED_POLL'] = 0.02
+        app.config['CHANGE_FEED_HEARTBEAT'] = 0.05
+        self.addCleanup(app.config.update, CHANGE_FEED_POLL=0.5, CHANGE_FEED_HEARTBEAT=15.0, CHANGE_FEED_BUFFER=1000)
+        response = self.app.get('/api/orders/stream', headers=headers, buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.addCleanup(response.close)
+        return response, iter(response.response)
+
+    def next_events(self, chunks, count):
+        """The next 'count' events of a stream as (id, event, data), skipping keep-alives"""
+        events = []
+        deadline = time.time() + 5
+        while len(events) < count and time.time() < deadline:
+            chunk = next(chunks).decode('utf-8')
+            if chunk.startswith('id:'):
+                fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+                events.append((int(fields['id']), fields['event'], json.loads(fields['data'])))
+        return events
+
+    def test_orders_stream_resumes_and_follows(self):
+        response, chunks = self.stream(**{'Last-Event-ID': '2'})
+        self.assertEqual(next(chunks), b'retry: 2000\n\n')
+        replayed = self.next_events(chunks, 7)
+        self.assertEqual([(change_id, kind) for change_id, kind, _ in replayed],
+                         [(3, 'order'), (4, 'order'), (5, 'order_item'), (6, 'order_item'), (7, 'order_item'),
+                          (8, 'order_item'), (9, 'order_item')])
+        Order.query.get(1).status = 'Delivered'
+        db.session.commit()
+        self.assertEqual(self.next_events(chunks, 1), [(10, 'status', {'order_id': 1, 'from': 'Waiting',
+                                                                       'to': 'Delivered'})])
+        ingest.ingest([json.dumps({'customer_id': 2, 'status': 'Waiting', 'date': '2031-05-06', 'items': []})])
+        (change_id, kind, data), = self.next_events(chunks, 1)
+        self.assertEqual((change_id, kind, data['customer_id']), (11, 'order', 2))
+        response.close()
+        self.assertEqual(app.extensions['changes'].subscribers, set())
+        # without a cursor the feed starts from now
+        response, chunks = self.stream()
+        next(chunks)
+        self.assertEqual(next(chunks), b': keep-alive\n\n')
+        self.assertEqual(self.app.get('/api/orders/stream?after=x').status_code, 400)
+
+    def test_orders_stream_drops_slow_clients(self):
+        app.config['CHANGE_FEED_BUFFER'] = 2
+        response, chunks = self.stream()
+        next(chunks)
+        # past the log catch-up, waiting on the feed
+        self.assertEqual(next(chunks), b': keep-alive\n\n')
+        db.session.add_all([Order(1, 'Waiting') for _ in range(5)])
+        db.session.commit()
+        time.sleep(0.2)
+        events = []
+        for chunk in chunks:
+            if chunk.startswith(b'id:'):
+                events.append(chunk)
+        self.assertEqual(len(events), 2)
+        self.assertIn('api_change_feed_dropped_total 1', self.app.get('/api/_metrics').get_data(as_text=True))
+
+    def test_fingerprint(self):
+        self.assertEqual(instrumentation.fingerprint('SELECT a FROM t  WHERE id IN (?, ?, ?) AND x = 5'),
+                         'SELECT a FROM t WHERE id IN (?) AND x = ?')
+
+
+    def make_replicas(self, count):
+        """Copy the test database into 'count' SQLite replicas whose first customer is renamed"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        primary = db.engine.url.database
+        uris = []
+        for n in range(count):
+            path = os.path.join(directory, 'replica{}.db'.format(n))
+            shutil.copy(primary, path)
+            engine = create_engine('sqlite:///' + path)
+            engine.execute("UPDATE customers SET name = 'replica {}' WHERE id = 1".format(n))
+            engine.dispose()
+            uris.append('sqlite:///' + path)
+        return uris
+
+    def use_replicas(self, uris):
+        # cleanups run last in first, so the prober is gone before the replicas are
+        self.addCleanup(router.for_app(app).stop)
+        app.config['SQLALCHEMY_REPLICA_URIS'] = uris
+        app.config['RESPONSE_CACHE'] = False
+        self.addCleanup(app.config.__setitem__, 'SQLALCHEMY_REPLICA_URIS', [])
+        self.addCleanup(app.config.__setitem__, 'RESPONSE_CACHE', True)
+        router.for_app(app).probe()
+
+    def test_reads_round_robin_across_replicas(self):
+        uris = self.make_replicas(2)
+        app.config['SQLALCHEMY_REPLICA_URIS'] = uris
+        # replicas only take reads once they have passed a probe
+        with app.test_request_context('/api/customers'):
+            self.assertIsNone(router.for_app(app).pick())
+        self.use_replicas(uris)
+        names = set(json.loads(self.app.get('/api/customers').data)[0] for _ in range(4))
+        self.assertEqual(names, {'replica 0', 'replica 1'})
+        with app.test_request_context('/api/customers'):
+            binds = set(str(db.session.get_bind().url) for _ in range(4))
+        self.assertEqual(len(binds), 1)
+        self.assertEqual(json.loads(self.app.get('/api/customers', headers={'X-Read-Your-Writes': '1'}).data)[0],
+                         'James T. Kirk')
+
+    def test_unhealthy_replica_falls_back(self):
+        self.use_replicas([self.make_replicas(1)[0], 'sqlite:////nonexistent/directory/replica.db'])
+        names = set(json.loads(self.app.get('/api/customers').data)[0] for _ in range(4))
+        self.assertEqual(names, {'replica 0'})
+        metrics = self.app.get('/api/_metrics').get_data(as_text=True)
+        self.assertIn('api_replica_healthy{replica="sqlite:////nonexistent/directory/replica.db"} 0', metrics)
+        self.use_replicas(['sqlite:////nonexistent/directory/replica.db'])
+        self.assertEqual(json.loads(self.app.get('/api/customers').data)[0], 'James T. Kirk')
+
+    def test_writes_stay_on_primary_and_pin_reads(self):
+        self.use_replicas(self.make_replicas(1))
+        line = json.dumps({'customer_id': 1, 'status': 'Waiting', 'date': '2001-02-03', 'items': []})
+        response = self.app.post('/api/orders/bulk', data=line)
+        self.assertEqual(json.loads(response.data)['orders'], 1)
+        self.assertIn('read_primary_until', response.headers['Set-Cookie'])
+        self.assertEqual(len(json.loads(self.app.get('/api/orders').data)), 5)
+        self.assertEqual(json.loads(self.app.get('/api/customers').data)[0], 'James T. Kirk')
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,462 @@
+"""
+The API's views, registered on the app by create_app() as the 'api' blueprint
+"""
+import datetime
+import json
+import queue
+from flask import Blueprint, render_template, jsonify, request, make_response, abort, Response, url_for, send_file, \
+    current_app
+from app import db
+from app.models import Customer, Product, Order, OrderItem, CustomerSummary
+from app import aggregates
+from app.aggregates import SERIES_INTERVALS, as_day
+from app.analytics import aggregates_for
+from app import pagination, exports, sketches, ingest, formats, serializers, search, changes
+from app.cache import cache, cached
+from app import instrumentation
+from app.admission import limited
+
+api = Blueprint('api', __name__)
+
+# column names of the unpaginated order listings' row lists, for ?format=columnar
+ORDER_COLUMNS = ['customer_id', 'customer', 'date', 'items']
+SERIES_COLUMNS = ['bucket', 'product', 'quantity']
+BATCH_MAX_IDS = 10000
+
+
+def orders_limit(start_date=None, end_date=None, interval=None, export=None):
+    """Admission control route class of an orders_by_date request, paged listings are cheap enough to skip"""
+    if 'export' in (interval, export):
+        return 'exports'
+    if start_date is None and pagination.wants_page():
+        return None
+    return 'orders'
+
+
+@api.app_errorhandler(404)
+def page_not_found(e):
+    return render_template('404.html'), 404
+
+
+def paginated(page, allowed_fields):
+    """Serve one keyset page of a listing, or a 400 if the page or format parameters are bad"""
+    try:
+        limit, after, fields = pagination.page_args(allowed_fields)
+        return page(limit, after, fields)
+    except ValueError as e:
+        return make_response(jsonify(error=str(e)), 400)
+
+
+def searched(table):
+    """Serve one page of name search results, or a 400 if the query or page parameters are bad"""
+    try:
+        query, limit, offset = search.search_args()
+        return search.search_response(current_app, table, query, limit, offset)
+    except ValueError as e:
+        return make_response(jsonify(error=str(e)), 400)
+
+
+@api.route("/", methods=['GET'])
+def root():
+    return "This is the root of the app, you probablly are looking for /api"
+
+
+@api.route("/api/", methods=['GET'])
+def index():
+    """Just tell the user the app is running and the routes avaliable"""
+    return render_template('index.html')
+
+
+@api.route("/api/_cache", methods=['GET'])
+def cache_stats():
+    """Hit/miss counters and size of the response cache"""
+    return jsonify(cache.stats())
+
+
+@api.route("/api/_metrics", methods=['GET'])
+def metrics():
+    """Per-route request/SQL histograms and cache counters in Prometheus text format"""
+    return Response(instrumentation.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@api.route("/api/customers", methods=['GET'])
+@cached('customers')
+def customers():
+    """
+    Provides  JSON of all customers with thteir associated IDs (so you can look up someone easy during testing the API
+    Pass limit/after/fields to page through them instead (see app/pagination.py)
+    """
+    if pagination.wants_page():
+        return paginated(pagination.customers_page, pagination.CUSTOMER_FIELDS)
+    return formats.render(serializers.customer_names(), ['customer'])
+
+
+@api.route("/api/customers/search", methods=['GET'])
+@cached('customers')
+def customers_search():
+    """
+    Customers whose name contains ?q= (or starts with it, under three characters), best match first.
+    Page with limit/offset (see app/search.py)
+    """
+    return searched('customers')
+
+
+@api.route("/api/customers/batch", methods=['GET', 'POST'])
+@cached('customers', 'orders', 'order_items', 'products')
+@limited(lambda: 'orders')
+def customers_batch():
+    """
+    Provide JSON of several customers' order items at once, keyed by customer id, for
+    ?ids=1,2,3 or a POSTed JSON list of ids ({"ids": [...]} works too). Ids that don't
+    exist are listed under 'missing' rather than failing the request
+    """
+    try:
+        customer_ids = batch_ids()
+    except ValueError as e:
+        return make_response(jsonify(error=str(e)), 400)
+    found = serializers.customer_order_items(customer_ids)
+    return formats.respond({
+        'customers': {str(customer_id): found[customer_id] for customer_id in customer_ids if customer_id in found},
+        'missing': [customer_id for customer_id in customer_ids if customer_id not in found],
+    })
+
+
+def batch_ids():
+    """The distinct customer ids of a batch request in the order given, raises ValueError if they are malformed"""
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        ids = body.get('ids') if isinstance(body, dict) else body
+        if not isinstance(ids, list):
+            raise ValueError('Invalid body, send a JSON list of customer ids or {"ids": [...]}.')
+    else:
+        ids = [value for value in request.args.get('ids', '').split(',') if value.strip()]
+    try:
+        if any(isinstance(value, (bool, float)) for value in ids):
+            raise ValueError
+        ids = [int(value) for value in ids]
+    except (TypeError, ValueError):
+        raise ValueError('Invalid ids, they must be integers.')
+    if not ids:
+        raise ValueError('Missing ids, pass ?ids=1,2,3 or POST a JSON list.')
+    if len(ids) > BATCH_MAX_IDS:
+        raise ValueError('Too many ids, ask for at most {} at a time.'.format(BATCH_MAX_IDS))
+    return list(dict.fromkeys(ids))
+
+
+@api.route("/api/customers/<id>", methods=['GET'])
+@cached('customers', 'orders', 'order_items', 'products')
+def customers_orders(id):
+    """
+    Provide JSON of a customer's orders and their corresponding items
+    """
+    if not db.session.query(Customer.id).filter_by(id=id).first():
+        abort(404)
+    items = db.session.query(OrderItem.order_id, OrderItem.product_id, Product.name, OrderItem.quantity) \
+        .join(Order, Order.id == OrderItem.order_id) \
+        .join(Product, Product.id == OrderItem.product_id) \
+        .filter(Order.customer_id == id) \
+        .order_by(Order.id, OrderItem.id)
+    results = [
+        {'order.id': order_id, 'product.id': product_id, 'name': name, 'quantity': quantity}
+        for order_id, product_id, name, quantity in items
+    ]
+    return formats.render(results, ['order.id', 'product.id', 'name', 'quantity'])
+
+
+@api.route("/api/customers/<id>/summary", methods=['GET'])
+@cached('customers', 'orders', 'order_items')
+def customer_summary(id):
+    """
+    Provide JSON of a customer's order count, lifetime quantity, last order date and orders per status,
+    read from the customer_summaries row kept up to date by app/summaries.py
+    """
+    row = db.session.query(CustomerSummary.customer_id, CustomerSummary.order_count, CustomerSummary.total_quantity,
+                           CustomerSummary.last_order_date, CustomerSummary.status_counts) \
+        .filter(CustomerSummary.customer_id == id).first()
+    if row is None:
+        abort(404)
+    customer_id, order_count, total_quantity, last_order_date, status_counts = row
+    return formats.respond({
+        'customer_id': customer_id,
+        'order_count': order_count,
+        'total_quantity': total_quantity,
+        'last_order_date': last_order_date.strftime('%Y-%m-%d') if last_order_date else None,
+        'statuses': json.loads(status_counts),
+    })
+
+
+@api.route("/api/products/categories", methods=['GET'])
+@cached('customers', 'orders', 'order_items', 'products', 'categories')
+@limited(lambda: 'categories')
+def customer_categories():
+    """
+    Return JSON of the quantity of items purchased in a particular 
+    category by a certain customer who placed order
+    """
+    results = [
+        {'id': customer_id, 'name': name, 'category_id': category_id, 'category': category, 'quantity': int(quantity)}
+        for customer_id, name, category_id, category, quantity in aggregates_for(current_app).customer_category_quantities()
+    ]
+    return formats.render(results, ['id', 'name', 'category_id', 'category', 'quantity'])
+
+
+@api.route("/api/products/search", methods=['GET'])
+@cached('products')
+def products_search():
+    """
+    Products whose name contains ?q= (or starts with it, under three characters), best match first.
+    Page with limit/offset (see app/search.py)
+    """
+    return searched('products')
+
+
+@api.route("/api/products", methods=['GET'])
+@cached('products', 'categories')
+def products():
+    """
+    Provide JSON of all current products that can be ordered and their product.ids
+    Pass limit/after/fields to page through them instead (see app/pagination.py)
+    """
+    if request.method == 'GET':
+        if pagination.wants_page():
+            return paginated(pagination.products_page, pagination.PRODUCT_FIELDS)
+        return formats.render(serializers.product_categories(), ['id', 'name', 'categories'])
+
+
+@api.route("/api/orders/bulk", methods=['POST'])
+def orders_bulk():
+    """
+    Accept NDJSON orders (one order per line, items nested) and insert them in batches,
+    returning row counts and timings per batch plus any lines that were rejected
+    """
+    summary = ingest.ingest(request.stream, current_app.config['BULK_BATCH_SIZE'])
+    status = 400 if summary['error_count'] and not summary['orders'] else 200
+    return make_response(jsonify(summary), status)
+
+
+@api.route("/api/orders/stream", methods=['GET'])
+def orders_stream():
+    """
+    Server-Sent Events feed of new orders (with their items), items added to existing orders and
+    status changes, as they are committed. Send Last-Event-ID (or ?after=<id>) to resume after an event,
+    without one the feed starts from now (see app/changes.py)
+    """
+    try:
+        cursor = stream_cursor()
+    except ValueError as e:
+        return make_response(jsonify(error=str(e)), 400)
+    feed = changes.feed()
+    engine = db.get_engine(current_app)
+    heartbeat = current_app.config['CHANGE_FEED_HEARTBEAT']
+
+    def events(cursor):
+        # subscribed before reading the log, so nothing committed in between is missed
+        subscriber = feed.subscribe()
+        try:
+            if cursor is None:
+                with engine.connect() as connection:
+                    cursor = changes.last_id(connection)
+            yield 'retry: 2000\n\n'
+            # what was logged after the cursor, then whatever the feed hands over (skipping the overlap)
+            with engine.connect() as connection:
+                rows = changes.read(connection, cursor)
+                while rows:
+                    for row in rows:
+                        yield sse_event(*row)
+                    cursor = rows[-1][0]
+                    rows = changes.read(connection, cursor)
+            while not (subscriber.overflowed and subscriber.events.empty()):
+                try:
+                    row = subscriber.events.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if row[0] > cursor:
+                    cursor = row[0]
+                    yield sse_event(*row)
+        finally:
+            feed.unsubscribe(subscriber)
+
+    response = Response(events(cursor), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # stop nginx and friends from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def stream_cursor():
+    """The change log id to resume after, from Last-Event-ID or ?after=, raises ValueError if it is malformed"""
+    value = request.headers.get('Last-Event-ID') or request.args.get('after')
+    if value is None:
+        return None
+    try:
+        cursor = int(value)
+    except ValueError:
+        raise ValueError('Invalid event id, it must be an integer.')
+    if cursor < 0:
+        raise ValueError('Invalid event id, it must be at least 0.')
+    return cursor
+
+
+def sse_event(change_id, kind, data):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(change_id, kind, data)
+
+
+@api.route("/api/orders", methods=["GET"])
+@api.route("/api/orders/<start_date>/<end_date>/", methods=['GET'])
+@api.route("/api/orders/<start_date>/<end_date>/<interval>", methods=['GET'])
+@api.route("/api/orders/<start_date>/<end_date>/<interval>/<export>", methods=['GET'])
+@cached('customers', 'orders', 'order_items', 'products')
+@limited(orders_limit)
+def orders_by_date(start_date=None, end_date=None, interval=None, export=None):
+    """
+    Provide a GET request with 'start_date' and 'end_date' 
+    keys in yyyy-mm-dd format and an optional 'interval' key of day, week, month or year
+    and returns list of all products sold in time interval, and how many by day/week/month/year.
+    ?series=1 returns [bucket, product, quantity] rows, one per product per interval instead of averages.
+    /<start>/<end>/?top=N returns the N best selling products in the range instead, ?approx=true estimates
+    them from the daily sketches (with error bounds) rather than adding up the exact totals.
+    Adding /export streams the result as CSV, /<start>/<end>/export exports every order item in the range
+    """
+    if request.method == 'GET':
+        if all(param is None for param in [start_date, end_date, interval]):
+            if pagination.wants_page():
+                return paginated(pagination.orders_page, pagination.ORDER_FIELDS)
+            return formats.render(serializers.order_rows(), ORDER_COLUMNS)
+        try:
+            start_date, end_date, interval, export = range_args(start_date, end_date, interval, export)
+        except ValueError as e:
+            return make_response(jsonify(error=str(e)), 400)
+        series = bool(request.args.get('series'))
+        if export == "export":
+            header, rows = export_rows(start_date, end_date, interval, series)
+            return exports.csv_response(export_name(interval, series) + '.csv', header, rows)
+        if interval is None and 'top' in request.args:
+            try:
+                return formats.respond(top_sellers(start_date, end_date))
+            except ValueError as e:
+                return make_response(jsonify(error=str(e)), 400)
+        if interval is None:
+            results = serializers.order_rows(Order.date.between(as_day(start_date), as_day(end_date)), by_date=True)
+            return formats.render(results, ORDER_COLUMNS)
+        if series:
+            return formats.render(series_rows(start_date, end_date, interval), SERIES_COLUMNS)
+        return formats.render(interval_averages(start_date, end_date, interval),
+                              ['item', 'frequency_bought_per_{}'.format(interval)])
+
+
+def range_args(start_date, end_date, interval, export):
+    """
+    Parse and check the date range URL parts, raises ValueError with a user facing
+    message if they are malformed. /<start>/<end>/export comes in as interval='export'
+    """
+    try:
+        start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d')
+        end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError('Invalid date format, use YYYY-MM-DD (2000-11-20 for Nov 20, 2001)')
+    if interval == 'export' and export is None:
+        interval, export = None, 'export'
+    if interval is not None and interval not in SERIES_INTERVALS:
+        raise ValueError('Invalid interval format (use day, week, month, or year).')
+    if end_date < start_date:
+        raise ValueError('Invalid date range, ending date cannot be before starting date.')
+    return start_date, end_date, interval, export
+
+
+def top_sellers(start_date, end_date):
+    """
+    {top: [...]} of the ?top=N best selling products over the range, exact or (with ?approx=true)
+    merged from the daily sketches with their error bounds. Raises ValueError for a bad ?top=
+    """
+    try:
+        limit = int(request.args['top'])
+    except ValueError:
+        raise ValueError('Invalid top, must be an integer.')
+    if limit < 1:
+        raise ValueError('Invalid top, must be at least 1.')
+    if request.args.get('approx', '').lower() in ('1', 'true', 'yes', 'on'):
+        rows, bounds = sketches.top_products(start_date, end_date, limit)
+        return dict(bounds, top=rows, approx=True)
+    rows = aggregates.top_products(start_date, end_date, min(limit, pagination.MAX_LIMIT))
+    return {'top': [{'product_id': product_id, 'product': name, 'quantity': int(quantity)}
+                    for product_id, name, quantity in rows], 'approx': False}
+
+
+def interval_averages(start_date, end_date, interval):
+    """{product name: average quantity sold per interval} over the range"""
+    items_quantities = {name: int(quantity) for name, quantity
+                        in aggregates_for(current_app).product_quantities(start_date, end_date)}
+    # ranges shorter than one interval count as one, rather than dividing by zero
+    periods = max(int((end_date - start_date).days / {'day': 1, 'week': 7, 'month': 30, 'year': 365.25}[interval]), 1)
+    return {key: value/periods for key,value in items_quantities.items()}
+
+
+def series_rows(start_date, end_date, interval):
+    series = aggregates_for(current_app).product_series(start_date, end_date, interval)
+    return [[bucket, name, int(quantity)] for bucket, name, quantity in series]
+
+
+def export_name(interval, series):
+    if interval is None:
+        return 'orders'
+    return 'sales_per_{}'.format(interval) if series else 'items_per_period'
+
+
+def export_rows(start_date, end_date, interval, series):
+    """(header, rows) of a date range export: every order item, the per-bucket series or the averages"""
+    if interval is None:
+        return exports.ORDER_ITEM_HEADER, exports.order_item_rows(start_date, end_date)
+    if series:
+        return SERIES_COLUMNS, series_rows(start_date, end_date, interval)
+    return (['item', 'frequency_bought_per_{}'.format(interval)],
+            exports.interval_rows(interval_averages(start_date, end_date, interval)))
+
+
+def job_status(job):
+    status = {name: job[name] for name in ('id', 'status', 'rows', 'output', 'error', 'created', 'finished')}
+    status['url'] = url_for('.export_status', job_id=job['id'])
+    return status
+
+
+@api.route("/api/orders/<start_date>/<end_date>/export", methods=['POST'])
+@api.route("/api/orders/<start_date>/<end_date>/<interval>/export", methods=['POST'])
+def export_job(start_date, end_date, interval=None):
+    """
+    Queue the same export as GET .../export as a background job and return its id,
+    poll /api/exports/<job_id> for progress and the file. ?output=ndjson for NDJSON
+    """
+    output = request.args.get('output', 'csv')
+    if output not in exports.OUTPUTS:
+        return make_response(jsonify(error='Invalid output, choose from: {}.'.format(', '.join(exports.OUTPUTS))), 400)
+    try:
+        start_date, end_date, interval, _ = range_args(start_date, end_date, interval, 'export')
+    except ValueError as e:
+        return make_response(jsonify(error=str(e)), 400)
+    series = bool(request.args.get('series')) and interval is not None
+    try:
+        job = exports.jobs.submit((start_date, end_date, interval, series), export_name(interval, series), output,
+                                  lambda: export_rows(start_date, end_date, interval, series))
+    except OverflowError as e:
+        response = make_response(jsonify(error=str(e)), 503)
+        response.headers['Retry-After'] = '30'
+        return response
+    response = make_response(jsonify(job_status(job)), 202)
+    response.headers['Location'] = job_status(job)['url']
+    return response
+
+
+@api.route("/api/exports/<job_id>", methods=['GET'])
+def export_status(job_id):
+    """
+    Progress of a background export while it runs, the file once it is done. A
+    failed export is reported with a 200, the status request itself worked
+    """
+    job = exports.jobs.get(job_id)
+    if job is None:
+        return make_response(jsonify(error='No such export, it may have expired.'), 404)
+    if job['status'] == 'done':
+        response = send_file(job['path'], mimetype=exports.OUTPUTS[job['output']])
+        response.headers['Content-Disposition'] = 'attachment; filename={}'.format(job['filename'])
+        return response
+    return make_response(jsonify(job_status(job)), 200 if job['status'] == 'failed' else 202)
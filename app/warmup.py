@@ -0,0 +1,79 @@
+"""
+Start-up helpers for worker processes. warm_up() pays the first-request costs
+before a worker takes traffic: it configures the mappers, opens pool
+connections, runs the hot read routes once (which also fills the response cache)
+and loads the columnar analytics arrays and in-memory search indexes when
+those are in use.
+
+Pre-fork servers (gunicorn --preload and friends) can build and warm the app in
+the parent. Pooled connections must not be shared with the children, so every
+engine is disposed just before a fork; each child then opens its own
+connections on first use, or up front from the server's post-fork hook with
+warm_connections(app)
+"""
+import os
+import weakref
+from sqlalchemy.orm import configure_mappers
+from app import db, search
+from app.routing import router
+
+# cheap, cacheable routes that touch every model and the hot query shapes
+WARM_UP_URLS = [
+    '/api/customers?limit=1',
+    '/api/products?limit=1',
+    '/api/orders?limit=1',
+    '/api/customers/1',
+]
+
+_apps = weakref.WeakSet()
+
+
+def warm_connections(app, count=None):
+    """Open (and hand back to the pool) up to WARM_UP_CONNECTIONS connections"""
+    count = app.config['WARM_UP_CONNECTIONS'] if count is None else count
+    with app.app_context():
+        connections = [db.engine.connect() for _ in range(count)]
+        for connection in connections:
+            connection.execute('SELECT 1')
+            connection.close()
+
+
+def warm_up(app):
+    """Run the first-request work now instead of on a user's request"""
+    configure_mappers()
+    warm_connections(app)
+    # replicas take reads once probed, so probe now rather than on the first read
+    router.for_app(app).probe()
+    client = app.test_client()
+    for url in app.config['WARM_UP_URLS']:
+        client.get(url).get_data()
+    with app.app_context():
+        if app.config.get('ANALYTICS_ENGINE') == 'columnar':
+            from app.analytics import store
+            store.for_app(app).refresh()
+        if search.backend(app) == 'memory':
+            for index in search.indexes.values():
+                index.load()
+        db.session.remove()
+
+
+def dispose_engines():
+    """Close every pooled connection (primary and replicas) so none is inherited by a forked child"""
+    for app in list(_apps):
+        state = app.extensions.get('sqlalchemy')
+        # only engines that were already created, so a fork never opens a connection
+        for connector in (state.connectors.values() if state is not None else ()):
+            connector.get_engine().dispose()
+        if 'replicas' in app.extensions:
+            router.for_app(app).dispose()
+
+
+def init_app(app):
+    app.config.setdefault('WARM_UP', False)
+    app.config.setdefault('WARM_UP_CONNECTIONS', 2)
+    app.config.setdefault('WARM_UP_URLS', list(WARM_UP_URLS))
+    _apps.add(app)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=dispose_engines)
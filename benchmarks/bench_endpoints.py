@@ -0,0 +1,190 @@
+"""
+Endpoint benchmarks. Seeds a SQLite database per scale tier with the synthetic
+generator, hits every route through the Flask test client and records latency
+percentiles, SQL statements per request and peak Python memory per request.
+Results are compared with a stored baseline and any regression past the
+thresholds makes the run exit non-zero.
+
+    python benchmarks/bench_endpoints.py                      # 1k tier against the baseline
+    python benchmarks/bench_endpoints.py --tiers 1k,100k,1m   # all tiers
+    python benchmarks/bench_endpoints.py --update-baseline    # record a new baseline
+
+Latency baselines are machine specific, record one on the machine you compare on.
+Generated databases are kept in --db-dir so the big tiers only have to be built once
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event
+from app import app, db
+from app import synthetic
+
+# order items per tier, the generator averages ~2.5 items per order
+TIERS = {'1k': 1000, '100k': 100000, '1m': 1000000}
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+START, END = '2015-01-01', '2018-12-31'
+ROUTES = [
+    '/api/customers',
+    '/api/customers/1',
+    '/api/products',
+    '/api/products/categories',
+    '/api/orders',
+    '/api/orders?limit=100',
+    '/api/orders/{}/{}/'.format(START, END),
+    '/api/orders/{}/{}/day'.format(START, END),
+    '/api/orders/{}/{}/month'.format(START, END),
+    '/api/orders/{}/{}/year'.format(START, END),
+    '/api/orders/{}/{}/year/export'.format(START, END),
+    '/api/orders/{}/{}/export'.format(START, END),
+]
+
+
+class StatementCounter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+def seed(tier, db_dir):
+    """Point the app at the tier's database, generating it first if it doesn't exist yet"""
+    path = os.path.join(db_dir, 'bench_{}.db'.format(tier))
+    exists = os.path.exists(path)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    db.session.remove()
+    if not exists:
+        items = TIERS[tier]
+        orders = max(items * 2 // 5, 1)
+        db.create_all()
+        synthetic.generate(customers=max(orders // 20, 10), products=max(min(items // 50, 20000), 20),
+                           categories=12, orders=orders, seed=1)
+    return path
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+def measure(client, url, requests):
+    counter = StatementCounter()
+    event.listen(db.engine, 'before_cursor_execute', counter)
+    try:
+        client.get(url).get_data()
+        timings = []
+        counter.count = 0
+        for _ in range(requests):
+            started = time.perf_counter()
+            response = client.get(url)
+            response.get_data()
+            timings.append((time.perf_counter() - started) * 1000)
+        statements = counter.count / float(requests)
+        tracemalloc.start()
+        client.get(url).get_data()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', counter)
+    return {
+        'status': response.status_code,
+        'p50_ms': round(percentile(timings, 0.50), 3),
+        'p95_ms': round(percentile(timings, 0.95), 3),
+        'p99_ms': round(percentile(timings, 0.99), 3),
+        'queries': statements,
+        'peak_kb': round(peak / 1024.0, 1),
+    }
+
+
+def compare(results, baseline, latency_ratio, memory_ratio, min_ms):
+    """List of human readable regressions of results against baseline"""
+    regressions = []
+    for tier, routes in results.items():
+        for url, current in routes.items():
+            previous = baseline.get(tier, {}).get(url)
+            if previous is None:
+                continue
+            for metric in ('p50_ms', 'p95_ms'):
+                if current[metric] > max(previous[metric] * latency_ratio, previous[metric] + min_ms):
+                    regressions.append('{} {} {}: {} -> {}'.format(tier, url, metric, previous[metric], current[metric]))
+            if current['queries'] > previous['queries']:
+                regressions.append('{} {} queries: {} -> {}'.format(tier, url, previous['queries'], current['queries']))
+            if current['peak_kb'] > previous['peak_kb'] * memory_ratio + 64:
+                regressions.append('{} {} peak_kb: {} -> {}'.format(tier, url, previous['peak_kb'], current['peak_kb']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tiers', default='1k', help='comma separated, any of {}'.format(', '.join(TIERS)))
+    parser.add_argument('--requests', type=int, default=20, help='timed requests per route')
+    parser.add_argument('--db-dir', default=os.path.join(tempfile.gettempdir(), 'customer_api_bench'))
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--latency-ratio', type=float, default=1.5)
+    parser.add_argument('--memory-ratio', type=float, default=1.25)
+    parser.add_argument('--min-ms', type=float, default=2.0, help='ignore latency changes smaller than this')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    tiers = [tier.strip() for tier in args.tiers.split(',') if tier.strip()]
+    unknown = [tier for tier in tiers if tier not in TIERS]
+    if unknown:
+        parser.error('unknown tier(s): {}'.format(', '.join(unknown)))
+    if not os.path.isdir(args.db_dir):
+        os.makedirs(args.db_dir)
+
+    app.config['TESTING'] = True
+    app.config['DEBUG'] = False
+    app.config['RESPONSE_CACHE'] = False
+    app.config['ADMISSION_CONTROL'] = False
+    client = app.test_client()
+    results = {}
+    for tier in tiers:
+        seed(tier, args.db_dir)
+        # the unpaginated routes on the biggest tier are slow on purpose, don't time them 20 times
+        requests = args.requests if TIERS[tier] < 1000000 else max(args.requests // 10, 2)
+        results[tier] = {}
+        print('{} ({} order items)'.format(tier, TIERS[tier]))
+        print('  {:<48} {:>9} {:>9} {:>9} {:>8} {:>10}'.format('route', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'peak KB'))
+        for url in ROUTES:
+            result = results[tier][url] = measure(client, url, requests)
+            print('  {:<48} {p50_ms:>9} {p95_ms:>9} {p99_ms:>9} {queries:>8} {peak_kb:>10}'.format(url, **result))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as existing:
+                baseline = json.load(existing)
+        baseline.update(results)
+        with open(args.baseline, 'w') as output:
+            json.dump(baseline, output, indent=2, sort_keys=True)
+            output.write('\n')
+        print('baseline written to {}'.format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print('no baseline at {}, run with --update-baseline first'.format(args.baseline))
+        return 0
+    with open(args.baseline) as existing:
+        baseline = json.load(existing)
+    regressions = compare(results, baseline, args.latency_ratio, args.memory_ratio, args.min_ms)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    if not regressions:
+        print('no regressions against {}'.format(args.baseline))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
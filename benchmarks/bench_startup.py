@@ -0,0 +1,75 @@
+"""
+Cold start benchmark. Starts fresh Python processes and times importing the
+package, building the app with create_app() (with and without the warm-up)
+and the first few requests, against the 1k tier database of bench_endpoints.py.
+
+    python benchmarks/bench_startup.py              # 5 runs of each mode
+    python benchmarks/bench_startup.py --runs 20 --output startup.json
+
+Each number is the median over the runs, in milliseconds
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.bench_endpoints import seed, percentile
+
+# run in a fresh interpreter, prints one JSON object of timings
+PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import app as package
+imported = time.perf_counter()
+application = package.create_app({'ADMISSION_CONTROL': False})
+created = time.perf_counter()
+client = application.test_client()
+timings = {'import_ms': (imported - started) * 1000, 'create_app_ms': (created - imported) * 1000}
+for n, url in enumerate(sys.argv[1:]):
+    before = time.perf_counter()
+    client.get(url).get_data()
+    timings['{}_ms'.format(url if n else 'first_request')] = (time.perf_counter() - before) * 1000
+timings['total_ms'] = (time.perf_counter() - started) * 1000
+print(json.dumps(timings))
+'''
+URLS = ['/api/customers/2', '/api/products?limit=10', '/api/orders?limit=10']
+
+
+def probe(database, warm_up):
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + database, WARM_UP='on' if warm_up else 'off',
+               ENV='prod', PYTHONPATH=ROOT)
+    output = subprocess.check_output([sys.executable, '-c', PROBE] + URLS, env=env, cwd=ROOT)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--db-dir', default=os.path.join(tempfile.gettempdir(), 'customer_api_bench'))
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+    if not os.path.isdir(args.db_dir):
+        os.makedirs(args.db_dir)
+    database = seed('1k', args.db_dir)
+
+    results = {}
+    for mode, warm in (('cold', False), ('warm', True)):
+        runs = [probe(database, warm) for _ in range(args.runs)]
+        results[mode] = {name: round(percentile([run[name] for run in runs], 0.5), 3) for name in runs[0]}
+    names = list(results['cold'])
+    print('  {:<32} {:>10} {:>10}'.format('median ms', 'cold', 'warm'))
+    for name in names:
+        print('  {:<32} {:>10} {:>10}'.format(name[:-3], results['cold'][name], results['warm'][name]))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,6 @@
+import datetime
 from app import app, db
+from app import changes, rollups, summaries, synthetic
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
@@ -8,5 +10,51 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def rebuild_rollups():
+    """Recompute the daily_product_sales rollup, and its daily sketches, from every order item"""
+    rollups.rebuild(db.session.connection())
+    db.session.commit()
+
+
+@manager.command
+def rebuild_summaries():
+    """Recompute every customer_summaries row from the orders"""
+    summaries.rebuild(db.session.connection())
+    db.session.commit()
+
+
+@manager.option('--dry-run', dest='dry_run', action='store_true', default=False)
+def reconcile_summaries(dry_run):
+    """Check the customer_summaries rows against the orders and fix the ones that drifted"""
+    wrong = summaries.reconcile(db.session.connection(), fix=not dry_run)
+    db.session.commit()
+    print('{} customer summaries {}'.format(len(wrong), 'differ' if dry_run else 'fixed'))
+    for customer_id in wrong[:100]:
+        print(customer_id)
+
+
+@manager.option('--days', dest='days', type=int, default=7)
+def prune_changes(days):
+    """Delete order_changes log entries older than the given number of days"""
+    pruned = changes.prune(db.session.connection(), datetime.datetime.utcnow() - datetime.timedelta(days=days))
+    db.session.commit()
+    print('{} order changes pruned'.format(pruned))
+
+
+@manager.option('--customers', dest='customers', type=int, default=1000)
+@manager.option('--products', dest='products', type=int, default=200)
+@manager.option('--categories', dest='categories', type=int, default=12)
+@manager.option('--orders', dest='orders', type=int, default=10000)
+@manager.option('--seed', dest='seed', type=int, default=0)
+@manager.option('--batch-size', dest='batch_size', type=int, default=synthetic.BATCH_SIZE)
+def generate(customers, products, categories, orders, seed, batch_size):
+    """Load deterministic synthetic customers, products, categories and orders"""
+    counts = synthetic.generate(customers=customers, products=products, categories=categories,
+        orders=orders, seed=seed, batch_size=batch_size)
+    for table, count in sorted(counts.items()):
+        print('{}: {}'.format(table, count))
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
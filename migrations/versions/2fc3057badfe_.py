@@ -0,0 +1,37 @@
+"""add daily_product_sales rollup
+
+Revision ID: 2fc3057badfe
+Revises: 6631bbb62f90
+Create Date: 2026-10-18 09:12:40.512318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2fc3057badfe'
+down_revision = '6631bbb62f90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('daily_product_sales',
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['product_id'], ['products.id'], ),
+    sa.PrimaryKeyConstraint('date', 'product_id')
+    )
+    # backfill from the orders that already exist
+    op.execute(
+        'INSERT INTO daily_product_sales (date, product_id, quantity) '
+        'SELECT orders.date, order_items.product_id, SUM(order_items.quantity) '
+        'FROM order_items JOIN orders ON orders.id = order_items.order_id '
+        'GROUP BY orders.date, order_items.product_id'
+    )
+
+
+def downgrade():
+    op.drop_table('daily_product_sales')
@@ -0,0 +1,35 @@
+"""add indexes for orders.date and the hot foreign keys
+
+Revision ID: 6da451996f91
+Revises: 2fc3057badfe
+Create Date: 2026-10-18 10:03:17.220914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6da451996f91'
+down_revision = '2fc3057badfe'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_orders_date', 'orders', ['date'], unique=False)
+    op.create_index('ix_orders_customer_id', 'orders', ['customer_id'], unique=False)
+    # covers order -> (product, quantity) lookups without touching the table
+    op.create_index('ix_order_items_order_id', 'order_items', ['order_id', 'product_id', 'quantity'], unique=False)
+    op.create_index('ix_order_items_product_id', 'order_items', ['product_id'], unique=False)
+    op.create_index('ix_products_categories_product_id', 'products_categories', ['product_id', 'category_id'], unique=False)
+    op.create_index('ix_products_categories_category_id', 'products_categories', ['category_id', 'product_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_products_categories_category_id', table_name='products_categories')
+    op.drop_index('ix_products_categories_product_id', table_name='products_categories')
+    op.drop_index('ix_order_items_product_id', table_name='order_items')
+    op.drop_index('ix_order_items_order_id', table_name='order_items')
+    op.drop_index('ix_orders_customer_id', table_name='orders')
+    op.drop_index('ix_orders_date', table_name='orders')
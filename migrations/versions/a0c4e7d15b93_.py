@@ -0,0 +1,25 @@
+"""index order_changes.created
+
+Revision ID: a0c4e7d15b93
+Revises: f3b6d2e90a84
+Create Date: 2026-10-18 20:41:09.337512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a0c4e7d15b93'
+down_revision = 'f3b6d2e90a84'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # python manage.py prune_changes deletes by age
+    op.create_index('ix_order_changes_created', 'order_changes', ['created'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_order_changes_created', table_name='order_changes')
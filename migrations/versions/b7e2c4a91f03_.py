@@ -0,0 +1,55 @@
+"""add name search indexes for products and customers
+
+Revision ID: b7e2c4a91f03
+Revises: 6da451996f91
+Create Date: 2026-10-18 14:26:51.108342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2c4a91f03'
+down_revision = '6da451996f91'
+branch_labels = None
+depends_on = None
+
+TABLES = ['products', 'customers']
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table in TABLES:
+            # GiST rather than GIN, it can also return rows in trigram distance (<->) order
+            op.execute('CREATE INDEX ix_{0}_name_trgm ON {0} USING gist (lower(name) gist_trgm_ops)'.format(table))
+    elif dialect == 'sqlite':
+        for table in TABLES:
+            op.execute("CREATE VIRTUAL TABLE {0}_search USING fts5(name, content='{0}', content_rowid='id', "
+                       "tokenize='trigram')".format(table))
+            op.execute('CREATE INDEX ix_{0}_name_lower ON {0} (lower(name))'.format(table))
+            op.execute('CREATE TRIGGER {0}_search_insert AFTER INSERT ON {0} BEGIN '
+                       'INSERT INTO {0}_search (rowid, name) VALUES (new.id, new.name); END'.format(table))
+            op.execute('CREATE TRIGGER {0}_search_delete AFTER DELETE ON {0} BEGIN '
+                       "INSERT INTO {0}_search ({0}_search, rowid, name) VALUES ('delete', old.id, old.name); "
+                       'END'.format(table))
+            op.execute('CREATE TRIGGER {0}_search_update AFTER UPDATE OF id, name ON {0} BEGIN '
+                       "INSERT INTO {0}_search ({0}_search, rowid, name) VALUES ('delete', old.id, old.name); "
+                       'INSERT INTO {0}_search (rowid, name) VALUES (new.id, new.name); END'.format(table))
+            # index the rows that are already there
+            op.execute("INSERT INTO {0}_search ({0}_search) VALUES ('rebuild')".format(table))
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        for table in reversed(TABLES):
+            op.drop_index('ix_{}_name_trgm'.format(table), table_name=table)
+    elif dialect == 'sqlite':
+        for table in reversed(TABLES):
+            for trigger in ('update', 'delete', 'insert'):
+                op.execute('DROP TRIGGER {}_search_{}'.format(table, trigger))
+            op.drop_index('ix_{}_name_lower'.format(table), table_name=table)
+            op.execute('DROP TABLE {}_search'.format(table))
@@ -0,0 +1,31 @@
+"""index short name prefixes on Postgres
+
+Revision ID: c5d9e1f27a46
+Revises: a0c4e7d15b93
+Create Date: 2026-10-18 21:12:40.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d9e1f27a46'
+down_revision = 'a0c4e7d15b93'
+branch_labels = None
+depends_on = None
+
+TABLES = ['products', 'customers']
+
+
+def upgrade():
+    # queries under three characters can't use the trigram index; SQLite already has ix_*_name_lower
+    if op.get_bind().dialect.name == 'postgresql':
+        for table in TABLES:
+            op.execute('CREATE INDEX ix_{0}_name_prefix ON {0} (lower(name) COLLATE "C", id)'.format(table))
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for table in reversed(TABLES):
+            op.drop_index('ix_{}_name_prefix'.format(table), table_name=table)
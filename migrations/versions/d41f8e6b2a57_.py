@@ -0,0 +1,59 @@
+"""add customer_summaries
+
+Revision ID: d41f8e6b2a57
+Revises: b7e2c4a91f03
+Create Date: 2026-10-18 15:02:11.730164
+
+"""
+import datetime
+import json
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41f8e6b2a57'
+down_revision = 'b7e2c4a91f03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    summaries = op.create_table('customer_summaries',
+    sa.Column('customer_id', sa.Integer(), nullable=False),
+    sa.Column('order_count', sa.Integer(), nullable=False),
+    sa.Column('total_quantity', sa.Integer(), nullable=False),
+    sa.Column('last_order_date', sa.Date(), nullable=True),
+    sa.Column('status_counts', sa.Text(), nullable=False),
+    sa.ForeignKeyConstraint(['customer_id'], ['customers.id'], ),
+    sa.PrimaryKeyConstraint('customer_id')
+    )
+    # backfill from the orders that already exist
+    connection = op.get_bind()
+    rows = {customer_id: {'customer_id': customer_id, 'order_count': 0, 'total_quantity': 0,
+                          'last_order_date': None, 'status_counts': {}}
+            for customer_id, in connection.execute('SELECT id FROM customers')}
+    for customer_id, status, count, last in connection.execute(
+            'SELECT customer_id, status, COUNT(*), MAX(date) FROM orders GROUP BY customer_id, status'):
+        if isinstance(last, str):
+            # SQLite hands raw column values back as text
+            last = datetime.datetime.strptime(last[:10], '%Y-%m-%d').date()
+        if customer_id in rows:
+            row = rows[customer_id]
+            row['order_count'] += count
+            row['status_counts'][status] = count
+            if row['last_order_date'] is None or last > row['last_order_date']:
+                row['last_order_date'] = last
+    for customer_id, quantity in connection.execute(
+            'SELECT orders.customer_id, SUM(order_items.quantity) FROM order_items '
+            'JOIN orders ON orders.id = order_items.order_id GROUP BY orders.customer_id'):
+        if customer_id in rows:
+            rows[customer_id]['total_quantity'] = int(quantity or 0)
+    for row in rows.values():
+        row['status_counts'] = json.dumps(row['status_counts'], sort_keys=True)
+    if rows:
+        op.bulk_insert(summaries, list(rows.values()))
+
+
+def downgrade():
+    op.drop_table('customer_summaries')
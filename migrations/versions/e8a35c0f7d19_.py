@@ -0,0 +1,36 @@
+"""add daily_product_sketches
+
+Revision ID: e8a35c0f7d19
+Revises: d41f8e6b2a57
+Create Date: 2026-10-18 16:11:45.093827
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from app import sketches as product_sketches
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8a35c0f7d19'
+down_revision = 'd41f8e6b2a57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    sketches = op.create_table('daily_product_sketches',
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.Column('threshold', sa.Integer(), nullable=False),
+    sa.Column('top', sa.Text(), nullable=False),
+    sa.Column('counts', sa.LargeBinary(), nullable=False),
+    sa.PrimaryKeyConstraint('date')
+    )
+    # backfill from the rollup that already exists, in the layout app/sketches.py reads
+    rollup = sa.table('daily_product_sales', sa.column('date', sa.Date()), sa.column('product_id', sa.Integer()),
+                      sa.column('quantity', sa.Integer()))
+    product_sketches.fill(op.get_bind(), rollup, sketches)
+
+
+def downgrade():
+    op.drop_table('daily_product_sketches')
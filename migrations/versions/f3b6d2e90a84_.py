@@ -0,0 +1,31 @@
+"""add order_changes
+
+Revision ID: f3b6d2e90a84
+Revises: e8a35c0f7d19
+Create Date: 2026-10-18 18:02:31.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b6d2e90a84'
+down_revision = 'e8a35c0f7d19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('order_changes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.Text(), nullable=False),
+    sa.Column('order_id', sa.Integer(), nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.Column('created', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('order_changes')
@@ -0,0 +1,12 @@
+"""
+WSGI entry point for production servers, e.g.
+
+    WARM_UP=on gunicorn --preload --workers 4 wsgi:app
+
+With --preload the app is built and warmed once in the master and forked into
+the workers. Pooled connections are closed before each fork, so every worker
+opens its own
+"""
+from app import create_app
+
+app = create_app()